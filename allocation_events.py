@@ -0,0 +1,104 @@
+import datetime
+import struct
+import sys
+from array import array
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# A record of every allocation the scheduling stages make, so tools can replay or explain a schedule without running
+# the algorithm again. Each event is the task's index in the task list, the day's ordinal, the minutes given and the
+# stage that gave them. Events are buffered in typed arrays and, when writing to a file, flushed in chunks so memory
+# stays bounded however large the schedule.
+work_stage = 0
+subjects_stage = 1
+tasks_stage = 2
+stage_names = {work_stage: 'calc_daily_work', subjects_stage: 'calc_daily_subjects', tasks_stage: 'calc_daily_tasks'}
+
+events_magic = b'AEVT'
+events_version = 2
+header_struct = struct.Struct('<4sH')
+# Number of events in the chunk, followed by that many task ids and day ordinals as little-endian 32-bit integers, that
+# many minutes as 64-bit integers, as one task can be given more minutes than 32 bits hold, then that many stage bytes
+chunk_struct = struct.Struct('<I')
+
+Event = Tuple[int, int, int, int]
+
+
+class AllocationEvents:
+    def __init__(self, filename: Optional[str] = None, chunk_events: int = 64 * 1024):
+        # Without a filename every event is kept in memory
+        self.task_ids = array('I')
+        self.ordinals = array('i')
+        self.minutes = array('q')
+        self.stages = array('B')
+        self.chunk_events = chunk_events
+        self.file = None
+        if filename is not None:
+            self.file = open(filename, 'wb')
+            self.file.write(header_struct.pack(events_magic, events_version))
+
+    def __enter__(self) -> 'AllocationEvents':
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def record(self, stage: int, task_id: int, allocation: Dict[datetime.date, int]) -> None:
+        # All of one task's allocations in a stage, as minutes per day
+        for date, minutes in allocation.items():
+            self.task_ids.append(task_id)
+            self.ordinals.append(date.toordinal())
+            self.minutes.append(minutes)
+        self.stages.extend(bytes([stage]) * len(allocation))
+        if self.file is not None and len(self.stages) >= self.chunk_events:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.file is None or len(self.stages) <= 0:
+            return
+        self.file.write(chunk_struct.pack(len(self.stages)))
+        for column in (self.task_ids, self.ordinals, self.minutes):
+            if sys.byteorder == 'big':
+                column.byteswap()
+            column.tofile(self.file)
+        self.stages.tofile(self.file)
+        for column in (self.task_ids, self.ordinals, self.minutes, self.stages):
+            del column[:]
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.flush()
+            self.file.close()
+            self.file = None
+
+    def __iter__(self) -> Iterator[Event]:
+        # The events still held in memory
+        return zip(self.task_ids, self.ordinals, self.minutes, self.stages)
+
+
+def read_events(filename: str) -> Iterator[Event]:
+    # Events from a file one chunk at a time, as (task id, day ordinal, minutes, stage)
+    with open(filename, 'rb') as events_file:
+        magic, version = header_struct.unpack(events_file.read(header_struct.size))
+        if magic != events_magic or version != events_version:
+            raise ValueError(f'{filename} is not an allocation event file')
+        while True:
+            count_bytes = events_file.read(chunk_struct.size)
+            if len(count_bytes) < chunk_struct.size:
+                return
+            (count,) = chunk_struct.unpack(count_bytes)
+            columns: List[array] = []
+            for typecode in 'Iiq':
+                column = array(typecode)
+                column.fromfile(events_file, count)
+                if sys.byteorder == 'big':
+                    column.byteswap()
+                columns.append(column)
+            stages = array('B')
+            stages.fromfile(events_file, count)
+            yield from zip(*columns, stages)
+
+
+def events_on_day(events: Iterator[Event], date: datetime.date) -> List[Event]:
+    # Everything allocated to a day, in the order it was allocated
+    ordinal = date.toordinal()
+    return [event for event in events if event[1] == ordinal]
@@ -1,22 +1,37 @@
 #!./.venv/bin/python3
+import argparse
+import bisect
+import collections.abc
 import datetime
+import functools
+import hashlib
+import inspect
 import io
 import math
 import os
 import subprocess
-from copy import deepcopy
-from dataclasses import dataclass
-from typing import Dict, List, Tuple, Optional
+import sys
+from array import array
+from dataclasses import dataclass, field, replace
+from typing import Callable, Dict, Iterable, Iterator, List, Mapping, MutableSequence, Sequence, Tuple, Optional
 
 from colorama import Fore, Back, Style
-from tqdm import tqdm
 
+import allocation_events
+import instrumentation
+import schedule_cache
 import sync
+import task_snapshot
 
 weekday_conversion = {0: 'Monday', 1: 'Tuesday', 2: 'Wednesday', 3: 'Thursday', 4: 'Friday', 5: 'Saturday', 6: 'Sunday'}
 
 time_inc = 1 / 60
 day_start_time = datetime.time(5, 0, 0)
+# Dates and times repeat across lines, but watch, batch and the background sync keep the parsers alive, so their caches
+# are bounded
+parser_cache_size = 4096
+# Copies of its day arrays a stage keeps for resuming it, so a resumed stage reruns at most this fraction of its tasks
+stage_checkpoints = 32
 
 
 def round_hours_to_minute(time: float) -> float:
@@ -31,7 +46,16 @@ def ceil_hours_to_minute(time: float) -> float:
     return math.ceil(time * 60) / 60
 
 
-def bool_input(query: str, default: bool = True) -> bool:
+def hours_to_minutes(time: float) -> int:
+    # Round to the nearest whole minute, splitting off whole hours first so only the fraction is rounded
+    whole_hours = math.floor(time)
+    return whole_hours * 60 + round((time - whole_hours) * 60)
+
+
+def bool_input(query: str, default: bool = True, answer: Optional[bool] = None) -> bool:
+    # Only ask if the answer wasn't already given, e.g. on the command line
+    if answer is not None:
+        return answer
     query = query[0].upper() + query[1:]
     if default:
         option_string = '[Y/n]'
@@ -46,53 +70,50 @@ def bool_input(query: str, default: bool = True) -> bool:
         print('Invalid input, please try again')
 
 
-def input_start_date() -> datetime.date:
+def input_start_date(include_today: Optional[bool] = None) -> datetime.date:
     # Get date to start on (i.e. current day, tomorrow)
     initial_date = datetime.datetime.now().date()
     if datetime.datetime.now().time() < day_start_time:
         # Before day start time, so count as yesterday
         initial_date -= datetime.timedelta(days=1)
-    include_today = bool_input('include today')
+    include_today = bool_input('include today', answer=include_today)
     if not include_today:
         initial_date += datetime.timedelta(days=1)
     return initial_date
 
 
+@functools.lru_cache(maxsize=None)
 def get_screen_width(default: int = 30) -> int:
+    # Asked of the terminal once per run, the same one stty would report on
     try:
-        return int(os.popen('stty size', 'r').read().split()[1])
-    except IndexError:
+        return os.get_terminal_size(sys.__stdin__.fileno()).columns
+    except (AttributeError, ValueError, OSError):
         return default
 
 
 def separate_output() -> None:
-    output = ''
-    print(Back.GREEN)
-    for j in range(get_screen_width()):
-        output += ':'
-    for i in range(20):
-        print(output)
-    print(Style.RESET_ALL)
+    sys.stdout.write(Back.GREEN + '\n' + (':' * get_screen_width() + '\n') * 20 + Style.RESET_ALL + '\n')
 
 
 def datetime_to_date_string(input_date: datetime.datetime.date) -> str:
     return str(input_date.day) + '/' + str(input_date.month) + '/' + str(input_date.year)[2:]
 
 
+@functools.lru_cache(maxsize=parser_cache_size)
 def date_string_to_datetime(input_date_string: str) -> datetime.date:
     split_string = input_date_string.split('/')
     try:
         local_day = int(split_string[0])
         month = int(split_string[1])
         year = int('20' + split_string[2])
-        try:
-            return datetime.date(year, month, local_day)
-        except ValueError:
-            print("Invalid date:", year, month, local_day)
-    except IndexError:
-        print("Invalid date-string:", input_date_string)
+        return datetime.date(year, month, local_day)
+    except (IndexError, ValueError):
+        # Callers report the line the date came from
+        return None
 
 
+# Schedules repeat the same few minute counts on every day, so formatting them is cached like parsing
+@functools.lru_cache(maxsize=parser_cache_size)
 def decimal_to_timestring(value: float) -> str:
     hours = round(value - value % 1)
     minutes = round((value - hours) * 60)
@@ -106,6 +127,7 @@ def decimal_to_timestring(value: float) -> str:
         return str(hours) + ":0" + str(minutes)
 
 
+@functools.lru_cache(maxsize=parser_cache_size)
 def timestring_to_decimal(timestring: str) -> float:
     split_time = timestring.split(':')
     hours = float(split_time[0])
@@ -131,51 +153,144 @@ def get_work_on_day(requested_day: datetime.date, weekly_work: Dict[str, float],
     return total_work
 
 
-def load_fixed_tasks(filename: str = 'day_fixed_work.txt') -> Tuple[
-        Dict[datetime.date, Dict[str, float]], Dict[str, float], Dict[datetime.date, float]]:
-    day_fixed_work = io.open(filename)
-    fixed_work_lines = day_fixed_work.readlines()
-    # Bring fixed work data into memory structures
-    tasks = {}
-    one_off_working: Dict[datetime.date, float] = {}
-    regular_working = {'Monday': 0, 'Tuesday': 0, 'Wednesday': 0, 'Thursday': 0, 'Friday': 0, 'Saturday': 0,
-                       'Sunday': 0}
-    for day_info in fixed_work_lines:
+def no_progress(iterable: Iterable, desc: str) -> Iterable:
+    return iterable
+
+
+def tqdm_progress(iterable: Iterable, desc: str) -> Iterable:
+    from tqdm import tqdm
+
+    return tqdm(iterable, desc=desc)
+
+
+@dataclass
+class Diagnostics:
+    # Everything the scheduler would otherwise print while working
+    invalid_lines: List[str] = field(default_factory=list)
+    missed_time: float = 0
+    missed_tasks: Dict[str, float] = field(default_factory=dict)
+    warnings: List[str] = field(default_factory=list)
+    overdue_tasks: List['Task'] = field(default_factory=list)
+    unassigned_hours: Dict[str, float] = field(default_factory=dict)
+
+
+def report_invalid_line(message: str, diagnostics: Optional[Diagnostics]) -> None:
+    if diagnostics is None:
+        print(message)
+    else:
+        diagnostics.invalid_lines.append(message)
+
+
+def format_diagnostics(diagnostics: Diagnostics) -> str:
+    # The diagnostics as the lines the scheduler would have printed, followed by anything only collected
+    lines = list(diagnostics.invalid_lines)
+    lines += diagnostics.warnings
+    for subtitle, hours in diagnostics.unassigned_hours.items():
+        lines.append(f'{subtitle}: {hours}')
+    for _task in diagnostics.overdue_tasks:
+        overdue_days = (_task.due_date - _task.actual_due_date).days - 1
+        plural = 's' if overdue_days > 1 else ''
+        lines.append(f'{_task.title} - {_task.subtitle} is overdue by {overdue_days} day{plural}')
+    if diagnostics.missed_time > 0:
+        lines.append(f'Missed time: {decimal_to_timestring(diagnostics.missed_time)} hours')
+    return ''.join(line + '\n' for line in lines)
+
+
+@dataclass
+class FixedWorkLine:
+    line_number: int
+    weekday: Optional[str]
+    date: Optional[datetime.date]
+    work_time: float
+    title: Optional[str]
+
+
+def parse_fixed_tasks(lines: Iterable[str], diagnostics: Optional[Diagnostics] = None) -> Iterator[FixedWorkLine]:
+    # Turn fixed work lines into records one at a time, parsing each date only once
+    for line_number, day_info in enumerate(lines, 1):
         if day_info == '\n' or day_info[0] == '#':
             continue
 
         _split_info = day_info.split(';')
         day = _split_info[0]
-        work_time = timestring_to_decimal(_split_info[1].split('\n')[0])
-        if day in regular_working.keys():
-            regular_working[day] += work_time
-        elif date_string_to_datetime(day) in one_off_working.keys():
-            one_off_working[date_string_to_datetime(day)] += work_time
-        else:
-            one_off_working[date_string_to_datetime(day)] = work_time
+        try:
+            work_time = timestring_to_decimal(_split_info[1].split('\n')[0])
+        except (IndexError, ValueError):
+            report_invalid_line(f'Line {line_number}: invalid fixed work "{day_info.rstrip()}"', diagnostics)
+            continue
 
-        # Deal with titled work data
         if len(_split_info) >= 3:
-            work_title = _split_info[2].strip()
-            if day in regular_working.keys():
-                # TODO: Deal with regulars
-                pass
+            work_title = sys.intern(_split_info[2].strip())
+        else:
+            work_title = None
+
+        if day in weekday_conversion.values():
+            yield FixedWorkLine(line_number, day, None, work_time, work_title)
+        else:
+            _date = date_string_to_datetime(day)
+            if _date is None:
+                report_invalid_line(f'Line {line_number}: invalid fixed work day "{day}"', diagnostics)
+                continue
+            yield FixedWorkLine(line_number, None, _date, work_time, work_title)
+
+
+@instrumentation.timed
+def load_fixed_tasks(filename: str = 'day_fixed_work.txt', use_snapshot: bool = False,
+                     diagnostics: Optional[Diagnostics] = None) -> Tuple[
+        Dict[datetime.date, Dict[str, float]], Dict[str, float], Dict[datetime.date, float]]:
+    if use_snapshot:
+        snapshot = task_snapshot.read_fixed_snapshot(filename, parser_digest())
+        if snapshot is not None:
+            fixed_work, invalid_lines = snapshot
+            for message in invalid_lines:
+                report_invalid_line(message, diagnostics)
+            return fixed_work
+        source_signature = task_snapshot.source_signature(filename)
+
+    # Bring fixed work data into memory structures
+    tasks = {}
+    one_off_working: Dict[datetime.date, float] = {}
+    regular_working = {'Monday': 0, 'Tuesday': 0, 'Wednesday': 0, 'Thursday': 0, 'Friday': 0, 'Saturday': 0,
+                       'Sunday': 0}
+    # Invalid lines are reported once the whole file is parsed, so the snapshot can keep them
+    parse_diagnostics = Diagnostics()
+    with io.open(filename) as day_fixed_work:
+        # Totals are kept to the minute, like the rest of the scheduler
+        for record in parse_fixed_tasks(day_fixed_work, parse_diagnostics):
+            if record.weekday is not None:
+                regular_working[record.weekday] = round_hours_to_minute(regular_working[record.weekday] +
+                                                                        record.work_time)
+                # TODO: Deal with titled regulars
+                continue
+
+            if record.date in one_off_working:
+                one_off_working[record.date] = round_hours_to_minute(one_off_working[record.date] + record.work_time)
             else:
-                _date = date_string_to_datetime(day)
-                if _date in tasks:
-                    if work_title in tasks[_date]:
-                        tasks[_date][work_title] += work_time
+                one_off_working[record.date] = round_hours_to_minute(record.work_time)
+
+            # Deal with titled work data
+            if record.title is not None:
+                if record.date in tasks:
+                    if record.title in tasks[record.date]:
+                        tasks[record.date][record.title] = round_hours_to_minute(tasks[record.date][record.title] +
+                                                                                 record.work_time)
                     else:
-                        tasks[_date][work_title] = work_time
+                        tasks[record.date][record.title] = round_hours_to_minute(record.work_time)
                 else:
-                    tasks[_date] = {}
-                    tasks[_date][work_title] = work_time
+                    tasks[record.date] = {record.title: round_hours_to_minute(record.work_time)}
 
+    for message in parse_diagnostics.invalid_lines:
+        report_invalid_line(message, diagnostics)
+    if use_snapshot:
+        task_snapshot.write_fixed_snapshot(filename, source_signature, parser_digest(), tasks, regular_working,
+                                           one_off_working, parse_diagnostics.invalid_lines)
     return tasks, regular_working, one_off_working
 
 
-@dataclass
+@dataclass(frozen=True, slots=True)
 class Task:
+    # Immutable so every stage can share the same task list, changes are made with dataclasses.replace. Slotted, with
+    # interned strings and dates shared between tasks, so large task lists stay small
     title: str
     subtitle: str
     required_hours: float
@@ -185,20 +300,130 @@ class Task:
     actual_due_date: datetime.date
 
 
+class PackedStrings:
+    # Strings stored end to end as UTF-8 and numbered in the order they're added, for strings that are rarely repeated
+    def __init__(self):
+        self.data = bytearray()
+        self.ends = array('q')
+
+    def append(self, string: str) -> int:
+        self.data += string.encode()
+        self.ends.append(len(self.data))
+        return len(self.ends) - 1
+
+    def __getitem__(self, string_id: int) -> str:
+        start = self.ends[string_id - 1] if string_id > 0 else 0
+        return self.data[start:self.ends[string_id]].decode()
+
+    def __len__(self) -> int:
+        return len(self.ends)
+
+
+class TaskTable(collections.abc.Sequence):
+    # Tasks held column by column, with titles as ids into an intern table, subtitles packed end to end and dates as
+    # ordinals. Indexing builds the Task, so the table can be used wherever a list of tasks is, and replacing a task
+    # only changes its columns
+    def __init__(self, tasks: Iterable[Task] = ()):
+        self.titles = task_snapshot.StringTable()
+        self.subtitles = PackedStrings()
+        self.title_ids = array('i')
+        self.subtitle_ids = array('i')
+        self.required_hours = array('d')
+        self.min_times = array('d')
+        self.start_ordinals = array('i')
+        self.due_ordinals = array('i')
+        self.actual_due_ordinals = array('i')
+        for _task in tasks:
+            self.append(_task)
+
+    @classmethod
+    def from_columns(cls, columns: task_snapshot.TaskColumns) -> 'TaskTable':
+        # Takes the snapshot's arrays over as they are, each task's subtitle being the next one packed
+        table = cls()
+        for title in columns.titles:
+            table.titles.intern(title)
+        table.subtitles.data = bytearray(columns.subtitle_data)
+        table.subtitles.ends = columns.subtitle_ends
+        table.title_ids = columns.title_ids
+        table.subtitle_ids = array('i', range(len(columns.title_ids)))
+        table.required_hours = columns.required_hours
+        table.min_times = columns.min_times
+        table.start_ordinals = columns.start_ordinals
+        table.due_ordinals = columns.due_ordinals
+        table.actual_due_ordinals = columns.actual_due_ordinals
+        return table
+
+    def columns(self) -> task_snapshot.TaskColumns:
+        # Subtitles that have been replaced leave unused strings behind, so they're packed again in task order
+        subtitles = self.subtitles
+        if len(subtitles) != len(self) or self.subtitle_ids != array('i', range(len(self))):
+            subtitles = PackedStrings()
+            for subtitle_id in self.subtitle_ids:
+                subtitles.append(self.subtitles[subtitle_id])
+        return task_snapshot.TaskColumns(self.titles.strings, bytes(subtitles.data), subtitles.ends, self.title_ids,
+                                         self.required_hours, self.min_times, self.start_ordinals, self.due_ordinals,
+                                         self.actual_due_ordinals)
+
+    def append(self, _task: Task) -> None:
+        self.title_ids.append(self.titles.intern(_task.title))
+        self.subtitle_ids.append(self.subtitles.append(_task.subtitle))
+        self.required_hours.append(_task.required_hours)
+        self.min_times.append(_task.min_time)
+        self.start_ordinals.append(_task.start_date.toordinal())
+        self.due_ordinals.append(_task.due_date.toordinal())
+        self.actual_due_ordinals.append(_task.actual_due_date.toordinal())
+
+    def __len__(self) -> int:
+        return len(self.title_ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[position] for position in range(*index.indices(len(self)))]
+        index = range(len(self))[index]
+        return Task(self.titles.strings[self.title_ids[index]], self.subtitles[self.subtitle_ids[index]],
+                    self.required_hours[index], self.min_times[index],
+                    datetime.date.fromordinal(self.start_ordinals[index]),
+                    datetime.date.fromordinal(self.due_ordinals[index]),
+                    datetime.date.fromordinal(self.actual_due_ordinals[index]))
+
+    def __setitem__(self, index: int, _task: Task) -> None:
+        index = range(len(self))[index]
+        self.title_ids[index] = self.titles.intern(_task.title)
+        if _task.subtitle != self.subtitles[self.subtitle_ids[index]]:
+            self.subtitle_ids[index] = self.subtitles.append(_task.subtitle)
+        self.required_hours[index] = _task.required_hours
+        self.min_times[index] = _task.min_time
+        self.start_ordinals[index] = _task.start_date.toordinal()
+        self.due_ordinals[index] = _task.due_date.toordinal()
+        self.actual_due_ordinals[index] = _task.actual_due_date.toordinal()
+
+    def __eq__(self, other) -> bool:
+        if not isinstance(other, (TaskTable, list)):
+            return NotImplemented
+        return len(self) == len(other) and all(_task == other_task for _task, other_task in zip(self, other))
+
+
 class DateOrderError(Exception):
-    def __init__(self, task: Task, message="Incorrect Date Order"):
+    def __init__(self, task: Task, message="Incorrect Date Order", line_number: Optional[int] = None):
         self.task = task
         self.message = message
+        self.line_number = line_number
         super().__init__(message)
 
 
-def load_flexi_tasks(cur_date: datetime.date, filename: str = 'one-off_tasks', weekends: bool = True) -> List[Task]:
-    one_off_tasks = io.open(filename)
-    one_off_tasks_lines = one_off_tasks.readlines()
-    # Bring task list data into memory structures
-    tasks = []
-    due_dateless_task_indices = []
-    for _index, _task in enumerate(one_off_tasks_lines):
+@dataclass
+class FlexiTaskLine:
+    line_number: int
+    task: Task
+    due_dateless: bool
+
+
+def parse_flexi_tasks(lines: Iterable[str], cur_date: datetime.date, weekends: bool = True,
+                      diagnostics: Optional[Diagnostics] = None) -> Iterator[FlexiTaskLine]:
+    # Turn task lines into records one at a time, parsing each date only once
+    # Equal hours and dates share one object between tasks
+    shared_values: dict = {}
+    for line_number, _task in enumerate(lines, 1):
         split_info = _task.split(';')
 
         if _task[0] == '#' or split_info == '\n' or '\n' in split_info:
@@ -207,29 +432,33 @@ def load_flexi_tasks(cur_date: datetime.date, filename: str = 'one-off_tasks', w
         _title = split_info[0]
         try:
             _required_hours = timestring_to_decimal(split_info[1].split(' ')[1])
-        except IndexError:
-            print(split_info)
+            _due_date = split_info[2].split(' ')[1].split('\n')[0]
+            if len(split_info) >= 4:
+                _min_time = timestring_to_decimal(split_info[3].split(' ')[1])
+            else:
+                _min_time = time_inc
+        except (IndexError, ValueError):
+            report_invalid_line(f'Line {line_number}: invalid task {split_info}', diagnostics)
             continue
 
-        _due_date = split_info[2].split(' ')[1].split('\n')[0]
-        if len(split_info) >= 4:
-            _min_time = timestring_to_decimal(split_info[3].split(' ')[1])
-        else:
-            _min_time = time_inc
-
-        if _due_date == 'none':
-            due_dateless_task_indices.append(_index)
-            _start_date = max(date_string_to_datetime(_due_date[0]), cur_date)
-            _due_date = date_string_to_datetime('1/1/01')
+        due_dateless = _due_date == 'none'
+        if due_dateless:
+            # Placeholder until the latest due date is known
+            _start_date = cur_date
+            _due_date = cur_date + datetime.timedelta(days=1)
         elif len(_due_date.split('-')) > 1:
             _due_date = _due_date.split('-')
-            _start_date = max(date_string_to_datetime(_due_date[0]), cur_date)
+            _start_date = date_string_to_datetime(_due_date[0])
             _due_date = date_string_to_datetime(_due_date[1])
+            if _start_date is not None:
+                _start_date = max(_start_date, cur_date)
         else:
             _start_date = cur_date
             _due_date = date_string_to_datetime(_due_date)
+        if _start_date is None or _due_date is None:
+            report_invalid_line(f'Line {line_number}: invalid dates in task {split_info}', diagnostics)
+            continue
 
-        print(cur_date)
         _actual_due_date = _due_date
         _due_date = max(_due_date, cur_date + datetime.timedelta(days=1))
         if _due_date.weekday() in [6, 5] and not weekends:
@@ -248,291 +477,960 @@ def load_flexi_tasks(cur_date: datetime.date, filename: str = 'one-off_tasks', w
         if _subtitle[-1] == '\n':
             _subtitle = _subtitle[:-1]
 
+        task = Task(sys.intern(_title), sys.intern(_subtitle),
+                    shared_values.setdefault(_required_hours, _required_hours),
+                    shared_values.setdefault(_min_time, _min_time), shared_values.setdefault(_start_date, _start_date),
+                    shared_values.setdefault(_due_date, _due_date),
+                    shared_values.setdefault(_actual_due_date, _actual_due_date))
         if _start_date >= _due_date:
-            raise DateOrderError(Task(_title, _subtitle, _required_hours, _min_time, _start_date, _due_date, _actual_due_date))
-        tasks.append(Task(_title, _subtitle, _required_hours, _min_time, _start_date, _due_date, _actual_due_date))
+            raise DateOrderError(task, line_number=line_number)
+        yield FlexiTaskLine(line_number, task, due_dateless)
+
+
+@instrumentation.timed
+def load_flexi_tasks(cur_date: datetime.date, filename: str = 'one-off_tasks', weekends: bool = True,
+                     use_snapshot: bool = False, diagnostics: Optional[Diagnostics] = None) -> TaskTable:
+    if use_snapshot:
+        snapshot = task_snapshot.read_flexi_snapshot(filename, parser_digest(), cur_date, weekends)
+        if snapshot is not None:
+            columns, invalid_lines = snapshot
+            for message in invalid_lines:
+                report_invalid_line(message, diagnostics)
+            return TaskTable.from_columns(columns)
+        source_signature = task_snapshot.source_signature(filename)
+
+    # Bring task list data into memory structures, reporting invalid lines once the whole file is parsed so the
+    # snapshot can keep them
+    tasks = []
+    due_dateless_indices = []
+    parse_diagnostics = Diagnostics()
+    try:
+        with io.open(filename) as one_off_tasks:
+            for record in parse_flexi_tasks(one_off_tasks, cur_date, weekends, parse_diagnostics):
+                if record.due_dateless:
+                    due_dateless_indices.append(len(tasks))
+                tasks.append(record.task)
+    finally:
+        for message in parse_diagnostics.invalid_lines:
+            report_invalid_line(message, diagnostics)
 
     # Set due date for any tasks without due date to maximum due date
-    max_due_date = sorted(tasks, key=lambda x: x.due_date)[-1].due_date
-    for _index in due_dateless_task_indices:
-        tasks[_index].due_date = max_due_date
+    max_due_date = max((_task.due_date for _task in tasks), default=None)
+    for index in due_dateless_indices:
+        tasks[index] = replace(tasks[index], due_date=max_due_date, actual_due_date=max_due_date)
 
     # Sort tasks by due date
     tasks = sorted(sorted(tasks, key=lambda x: x.actual_due_date), key=lambda x: x.due_date)
-    return tasks
-
-
+    if instrumentation.active is not None:
+        instrumentation.active.count('sorts', 2)
+    table = TaskTable(tasks)
+    if use_snapshot:
+        task_snapshot.write_flexi_snapshot(filename, source_signature, parser_digest(), cur_date, weekends,
+                                           table.columns(), parse_diagnostics.invalid_lines)
+    return table
+
+
+@functools.lru_cache(maxsize=None)
+def parser_digest() -> int:
+    # Identifies the code that turns task files into tasks, so snapshots made by any other version are never read
+    digest = hashlib.sha256()
+    for function in [date_string_to_datetime, timestring_to_decimal, parse_fixed_tasks, load_fixed_tasks, Task,
+                     parse_flexi_tasks, load_flexi_tasks]:
+        digest.update(inspect.getsource(function).encode())
+    return int.from_bytes(digest.digest()[:8], 'little')
+
+
+@instrumentation.timed
 def remove_fixed_from_flexi(fixed, flexi):
-    # Remove set work from task requirements
+    # Remove set work from task requirements, earliest due first, replacing the changed tasks in the list. Each
+    # subtitle's tasks are indexed once, with a cursor past the tasks that have nothing left to remove
+    subtitle_indices: Dict[str, List[int]] = {}
+    for index, _task in enumerate(flexi):
+        subtitle_indices.setdefault(_task.subtitle, []).append(index)
+    cursors: Dict[str, int] = {}
     for _date in fixed:
         for _title in fixed[_date]:
-            time_to_remove = fixed[_date][_title]
-            for _task in flexi:
-                if time_to_remove <= time_inc:
-                    break
-                elif _title == _task.subtitle:
-                    _task.required_hours -= min(time_to_remove, _task.required_hours)
-                    time_to_remove -= min(time_to_remove, _task.required_hours)
+            indices = subtitle_indices.get(_title)
+            if indices is None:
+                continue
+            minutes_to_remove = hours_to_minutes(fixed[_date][_title])
+            cursor = cursors.get(_title, 0)
+            while minutes_to_remove > 0 and cursor < len(indices):
+                _task = flexi[indices[cursor]]
+                required_minutes = hours_to_minutes(_task.required_hours)
+                removed_minutes = min(minutes_to_remove, required_minutes)
+                if removed_minutes > 0:
+                    flexi[indices[cursor]] = replace(_task, required_hours=(required_minutes - removed_minutes) / 60)
+                    minutes_to_remove -= removed_minutes
+                if removed_minutes == required_minutes:
+                    cursor += 1
+            cursors[_title] = cursor
+
+
+class FixedCalendar:
+    # Fixed work for every day of a horizon, expanded from the weekly pattern once with one-off work added on top, so
+    # each day is a single index instead of a get_work_on_day call
+    def __init__(self, weekly_work: Dict[str, float], single_fixed_work: Dict[datetime.date, float],
+                 start_date: datetime.date, end_date: datetime.date):
+        self.weekly_work = weekly_work
+        self.single_fixed_work = single_fixed_work
+        self.start_ordinal = start_date.toordinal()
+        num_days = max(0, (end_date - start_date).days)
+        week = [weekly_work[weekday_conversion[weekday]] for weekday in range(7)]
+        week = week[start_date.weekday():] + week[:start_date.weekday()]
+        self.hours = array('d', (week * (num_days // 7 + 1))[:num_days])
+        for date, one_off_work in single_fixed_work.items():
+            offset = date.toordinal() - self.start_ordinal
+            if 0 <= offset < num_days:
+                self.hours[offset] += one_off_work
+
+    @classmethod
+    def for_tasks(cls, tasks: Iterable[Task], weekly_work: Dict[str, float],
+                  single_fixed_work: Dict[datetime.date, float]) -> 'FixedCalendar':
+        # Covers every day a task could be given work on, including the fallback day before it's due
+        if not isinstance(tasks, TaskTable):
+            tasks = TaskTable(tasks)
+        if len(tasks) <= 0:
+            return cls(weekly_work, single_fixed_work, datetime.date.today(), datetime.date.today())
+        return cls(weekly_work, single_fixed_work,
+                   datetime.date.fromordinal(min(min(tasks.start_ordinals), min(tasks.due_ordinals) - 1)),
+                   datetime.date.fromordinal(max(tasks.due_ordinals)))
+
+    @classmethod
+    def for_dates(cls, dates: Iterable[datetime.date], weekly_work: Dict[str, float],
+                  single_fixed_work: Dict[datetime.date, float]) -> 'FixedCalendar':
+        dates = list(dates)
+        if len(dates) <= 0:
+            return cls(weekly_work, single_fixed_work, datetime.date.today(), datetime.date.today())
+        return cls(weekly_work, single_fixed_work, min(dates), max(dates) + datetime.timedelta(days=1))
+
+    def work_on_day(self, date: datetime.date) -> float:
+        offset = date.toordinal() - self.start_ordinal
+        if 0 <= offset < len(self.hours):
+            return self.hours[offset]
+        return get_work_on_day(date, self.weekly_work, self.single_fixed_work)
+
+    def minutes(self) -> MutableSequence[int]:
+        # A 64-bit array, or a list if some day has more fixed work than one can hold
+        minutes = [hours_to_minutes(hours) for hours in self.hours]
+        if all(abs(day_minutes) < 2 ** 62 for day_minutes in minutes):
+            return array('q', minutes)
+        return minutes
+
+
+def get_available_days(_task: Task, include_weekends: bool) -> List[datetime.date]:
+    # Get list of days which could possibly be used, falling back to the day before it's due
+    _available_days = [_task.start_date + datetime.timedelta(days=x)
+                       for x in range(0, (_task.due_date - _task.start_date).days)]
+    if not include_weekends:
+        _available_days = [_date for _date in _available_days if _date.weekday() not in [6, 5]]
+    if len(_available_days) <= 0:
+        _available_days = [_task.due_date - datetime.timedelta(days=1)]
+    return _available_days
+
+
+class StageRecord:
+    # What a stage did with each task, so a later run can resume it part way through: copies of the stage's day arrays
+    # taken every so many tasks, the minutes each task couldn't place and its warning, and, for the stage whose output
+    # they are, rows of task index, day ordinal, minutes and whether the task was finished, in task order
+    def __init__(self):
+        self.checkpoint_indices: List[int] = []
+        self.checkpoints: List[tuple] = []
+        self.unplaced_minutes = array('q')
+        self.warnings: List[str] = []
+        self.task_indices = array('i')
+        self.ordinals = array('i')
+        self.minutes = array('q')
+        self.completes = bytearray()
+
+    def add_checkpoint(self, index: int, *day_arrays) -> None:
+        # The day arrays as they stood before the task at index was run
+        self.checkpoint_indices.append(index)
+        self.checkpoints.append(day_arrays)
+
+    def add_row(self, index: int, ordinal: int, minutes: int, complete: bool) -> None:
+        self.task_indices.append(index)
+        self.ordinals.append(ordinal)
+        self.minutes.append(minutes)
+        self.completes.append(complete)
+
+    def end_task(self, unplaced_minutes: int, warning: str = '') -> None:
+        self.unplaced_minutes.append(unplaced_minutes)
+        self.warnings.append(warning)
+
+    def truncate(self, num_tasks: int) -> None:
+        # Keep only what the first tasks did. Rows are in task order, so theirs come first
+        num_rows = bisect.bisect_left(self.task_indices, num_tasks)
+        del self.task_indices[num_rows:]
+        del self.ordinals[num_rows:]
+        del self.minutes[num_rows:]
+        del self.completes[num_rows:]
+        del self.unplaced_minutes[num_tasks:]
+        del self.warnings[num_tasks:]
+        num_checkpoints = bisect.bisect_right(self.checkpoint_indices, num_tasks)
+        del self.checkpoint_indices[num_checkpoints:]
+        del self.checkpoints[num_checkpoints:]
+
+    def resume_from(self, start: int) -> Tuple[int, Optional[tuple]]:
+        # The index of the last copy taken at or before start and its day arrays, dropping everything after it
+        position = bisect.bisect_right(self.checkpoint_indices, start) - 1
+        if position < 0:
+            self.truncate(0)
+            return 0, None
+        self.truncate(self.checkpoint_indices[position])
+        return self.checkpoint_indices[position], self.checkpoints[position]
+
+
+def checkpoint_interval(num_tasks: int) -> int:
+    # Tasks run between copies of a stage's day arrays
+    return max(1, num_tasks // stage_checkpoints)
+
+
+def copy_day_offsets(source: Sequence[int], source_ordinal: int, target: MutableSequence[int],
+                     target_ordinal: int) -> range:
+    # Copy the days two arrays starting on different days share, returning their offsets in the target
+    offset = source_ordinal - target_ordinal
+    days = range(max(0, offset), min(len(target), offset + len(source)))
+    target[days.start:days.stop] = source[days.start - offset:days.stop - offset]
+    return days
+
+
+@instrumentation.timed
+def calc_daily_work(_tasks: List[Task], regular_tasks: Dict[str, float], single_fixed_work: Dict[datetime.date, float],
+                    include_weekends: bool, progress: Callable[[Iterable, str], Iterable] = no_progress,
+                    events: Optional[allocation_events.AllocationEvents] = None,
+                    record: Optional[StageRecord] = None, start: int = 0) -> \
+        Tuple[Dict[datetime.date, float], Dict[datetime.date, float]]:
+    # Work out how many hours to work a day, holding the whole horizon as integer minutes indexed by day offset and
+    # only writing to dictionaries of its own. With a record, the auto work is copied every so often and the run
+    # resumes from the last copy taken before start
+    resume_index, checkpoint = record.resume_from(start) if record is not None else (0, None)
+    if len(_tasks) <= 0:
+        return {}, {}
+    calendar = FixedCalendar.for_tasks(_tasks, regular_tasks, single_fixed_work)
+    horizon_start = datetime.date.fromordinal(calendar.start_ordinal)
+    num_days = len(calendar.hours)
+    first_weekday = horizon_start.weekday()
+
+    work_on_days = calendar.minutes()
+    auto_work = array('q', bytes(8 * num_days))
+    has_total_work = bytearray(num_days)
+    if checkpoint is not None:
+        checkpoint_ordinal, checkpoint_auto_work, checkpoint_has_total_work = checkpoint
+        copy_day_offsets(checkpoint_has_total_work, checkpoint_ordinal, has_total_work, calendar.start_ordinal)
+        for day in copy_day_offsets(checkpoint_auto_work, checkpoint_ordinal, auto_work, calendar.start_ordinal):
+            work_on_days[day] += auto_work[day]
+    interval = checkpoint_interval(len(_tasks))
+    profile = instrumentation.active
+    for _index, _task in enumerate(progress(_tasks[resume_index:] if resume_index > 0 else _tasks,
+                                            'Calculating total hours'), resume_index):
+        if record is not None and _index % interval == 0 and _index > resume_index:
+            record.add_checkpoint(_index, calendar.start_ordinal, array('q', auto_work), bytearray(has_total_work))
+        if profile is not None:
+            profile.begin_task('calc_daily_work', _index, _task)
+        first_day = (_task.start_date - horizon_start).days
+        last_day = (_task.due_date - horizon_start).days
+        if include_weekends:
+            available_days = range(first_day, last_day)
+        else:
+            available_days = [x for x in range(first_day, last_day) if (first_weekday + x) % 7 not in [6, 5]]
+        if len(available_days) <= 0:
+            available_days = range(last_day - 1, last_day)
+
+        # Contiguous windows work on slices directly, weekday-only windows gather their days
+        if isinstance(available_days, range):
+            window = slice(available_days.start, available_days.stop)
+            has_total_work[window] = b'\x01' * len(available_days)
+            added = level_minutes(work_on_days[window], hours_to_minutes(_task.required_hours),
+                                  hours_to_minutes(_task.min_time))
+        else:
+            for day in available_days:
+                has_total_work[day] = 1
+            added = level_minutes([work_on_days[x] for x in available_days], hours_to_minutes(_task.required_hours),
+                                  hours_to_minutes(_task.min_time))
+        for day, minutes in zip(available_days, added):
+            if minutes > 0:
+                work_on_days[day] += minutes
+                auto_work[day] += minutes
+        if record is not None:
+            record.end_task(0)
+        if profile is not None:
+            profile.end_task()
+
+        if events is not None:
+            events.record(allocation_events.work_stage, _index,
+                          {horizon_start + datetime.timedelta(days=day): minutes
+                           for day, minutes in zip(available_days, added) if minutes > 0})
+
+    _auto_work_per_day = {horizon_start + datetime.timedelta(days=x): auto_work[x] / 60
+                          for x in range(num_days) if auto_work[x] > 0}
+    _work_on_days_to_due = {horizon_start + datetime.timedelta(days=x): work_on_days[x] / 60
+                            for x in range(num_days) if has_total_work[x]}
+    return _auto_work_per_day, _work_on_days_to_due
 
 
-def calc_daily_work(_tasks: List[Task], regular_tasks: Dict[str, float], single_fixed_work: Dict[datetime.date, float],
-                    include_weekends: bool) -> Tuple[Dict[datetime.date, float], Dict[datetime.date, float]]:
-    # Work out how many hours to work a day
-    _tasks = deepcopy(_tasks)
-    regular_tasks = deepcopy(regular_tasks)
-    single_fixed_work = deepcopy(single_fixed_work)
-
-    include_weekends = deepcopy(include_weekends)
-    _auto_work_per_day: Dict[datetime.date, float] = {}
-    _work_on_days_to_due = {}
-    for _index, _task in enumerate(tqdm(_tasks, desc='Calculating total hours')):
-        _required_hours = _task.required_hours
-        # Get list of days which could possibly be used
-        _available_days = [_task.start_date + datetime.timedelta(days=x)
-                           for x in range(0, (_task.due_date - _task.start_date).days)]
-
-        # Get total work on each day and slate weekends for removal if necessary
-        indices_to_delete = []
-        for day_index, _date in enumerate(_available_days):
-            if _date.weekday() in [6, 5] and not include_weekends:
-                indices_to_delete.append(day_index)
-                continue
-            if _date in _auto_work_per_day:
-                _work_on_days_to_due[_date] = get_work_on_day(_date, regular_tasks, single_fixed_work) + \
-                                              _auto_work_per_day[_date]
-            else:
-                _work_on_days_to_due[_date] = get_work_on_day(_date, regular_tasks, single_fixed_work)
-
-        # Can't delete while iterating over list, so actually remove weekends now
-        for deletable_index in reversed(indices_to_delete):
-            del _available_days[deletable_index]
-
-        if len(_available_days) <= 0:
-            _date = _task.due_date - datetime.timedelta(days=1)
-            _available_days = [_date]
-            if _date in _auto_work_per_day:
-                _work_on_days_to_due[_date] = get_work_on_day(_date, regular_tasks, single_fixed_work) + \
-                                              _auto_work_per_day[_date]
-            else:
-                _work_on_days_to_due[_date] = get_work_on_day(_date, regular_tasks, single_fixed_work)
-
-        # Add hours to day with smallest amount of work so far
-        iter = 0
-        while _required_hours > 0 and len(_work_on_days_to_due) > 0:
-            iter += 1
-            time_sorted_work_amounts = sorted(_available_days, key=lambda x: _work_on_days_to_due[x])
-            min_work_day = time_sorted_work_amounts[0]
-            min_work_amount = _work_on_days_to_due[min_work_day]
-            second_min_work_day: Optional[datetime.date] = None
-            num_mins = 0
-            for day in time_sorted_work_amounts:
-                if round_hours_to_minute(_work_on_days_to_due[day] - _work_on_days_to_due[min_work_day]) >= time_inc:
-                    second_min_work_day = day
-                    break
-                else:
-                    num_mins += 1
-            if second_min_work_day is not None:
-                optimal_split = min(
-                    max(min((_work_on_days_to_due[second_min_work_day] - _work_on_days_to_due[min_work_day]),
-                            ceil_hours_to_minute(_required_hours / num_mins)), _task.min_time), _required_hours)
-            else:
-                optimal_split = min(max(floor_hours_to_minute(_required_hours / len(_available_days)), _task.min_time),
-                                    _required_hours)
-            # optimal_split = ceil_hours_to_minute(_required_hours / math.floor(_required_hours / optimal_split) - 1e-10)
-            for day in time_sorted_work_amounts:
-                if _work_on_days_to_due[day] > min_work_amount or _required_hours < optimal_split:
-                    break
-                else:
-                    if day in _auto_work_per_day:
-                        _auto_work_per_day[day] += optimal_split
-                        _work_on_days_to_due[day] += optimal_split
-                    elif day in _work_on_days_to_due:
-                        _auto_work_per_day[day] = optimal_split
-                        _work_on_days_to_due[day] += optimal_split
-                    else:
-                        _auto_work_per_day[day] = optimal_split
-                        _work_on_days_to_due[day] += optimal_split
-                    _required_hours = round_hours_to_minute(_required_hours - optimal_split)
+def level_minutes(loads: List[int], required_minutes: int, min_time: int) -> List[int]:
+    # Water-fill the least loaded days, returning the minutes added to each day
+    added = [0] * len(loads)
+    if required_minutes <= 0 or len(loads) <= 0:
+        return added
+    min_time = max(min_time, 1)
+    time_sorted_indices = sorted(range(len(loads)), key=loads.__getitem__)
+
+    # Find the most days that can share a common water level while each still gets at least min_time. The most loaded
+    # of them can fall a minute short of it if there's a spare minute to top up each one
+    num_days = 1
+    level_total = loads[time_sorted_indices[0]] + required_minutes
+    num_short = 0
+    running_total = required_minutes
+    count = 0
+    num_tied = 0
+    for count, index in enumerate(time_sorted_indices, 1):
+        if count * min_time > required_minutes:
+            break
+        running_total += loads[index]
+        num_tied = num_tied + 1 if count > 1 and loads[index] == loads[time_sorted_indices[count - 2]] else 1
+        share = running_total // count - loads[index]
+        if share >= min_time:
+            num_days, level_total, num_short = count, running_total, 0
+        elif share == min_time - 1 and num_tied <= running_total % count:
+            num_days, level_total, num_short = count, running_total, num_tied
+    if instrumentation.active is not None:
+        instrumentation.active.count('leveling_iterations', count)
+        instrumentation.active.count('sorts', 2)
+
+    # Spare minutes top up the days that are short first, the rest go to the earliest days
+    level, spare_minutes = divmod(level_total, num_days)
+    for index in time_sorted_indices[num_days - num_short:num_days]:
+        added[index] = level - loads[index] + 1
+    spare_minutes -= num_short
+    for position, index in enumerate(sorted(time_sorted_indices[:num_days - num_short])):
+        added[index] = level - loads[index] + (1 if position < spare_minutes else 0)
+
+    return added
+
+
+def spread_minutes(capacities: List[int], required_minutes: int, min_time: int) -> List[int]:
+    # Take minutes from the days' capacities, returning the minutes taken from each day. An even share of at least
+    # min_time goes on each day with room for it, then whatever is left goes on the earliest days, so later tasks keep
+    # the room near their own due dates
+    added = [0] * len(capacities)
+    if not capacities:
+        return added
+    min_time = max(min_time, 1)
+    remaining = required_minutes
+    share = max(required_minutes // len(capacities), min_time)
+    for index, capacity in enumerate(capacities):
+        if remaining < share:
+            break
+        if capacity >= share:
+            added[index] = share
+            remaining -= share
+    # Days already given work or with room for min_time come first, so pieces under min_time are only a last resort
+    for only_whole_pieces in (True, False):
+        for index, capacity in enumerate(capacities):
+            if remaining <= 0:
+                return added
+            room = capacity - added[index]
+            if room > 0 and (not only_whole_pieces or added[index] > 0 or room >= min(min_time, remaining)):
+                minutes = min(room, remaining)
+                added[index] += minutes
+                remaining -= minutes
+    return added
+
+
+def place_task_minutes(_task: Task, capacities: List[int]) -> Tuple[List[int], int, str]:
+    # Spread a single task's minutes over the room left on its available days, returning the minutes taken from each
+    # day, the minutes that couldn't be placed and any warning for the task
+    warning_str = ''
+    if len(capacities) <= 0:
+        if _task.required_hours > 1:
+            warning_str += 'Do ' + str(_task.required_hours) + ' hours of ' + _task.subtitle + ' now!\n'
+        else:
+            warning_str += 'Do ' + str(_task.required_hours) + ' hour of ' + _task.subtitle + ' now!\n'
+        return [], 0, warning_str
+
+    required_minutes = hours_to_minutes(_task.required_hours)
+    min_minutes = hours_to_minutes(_task.min_time)
+    added = spread_minutes(capacities, required_minutes, min_minutes)
+    if instrumentation.active is not None:
+        instrumentation.active.count('min_time_shortfalls', sum(1 for minutes in added if 0 < minutes < min_minutes))
+
+    unplaced_minutes = required_minutes - sum(added)
+    if unplaced_minutes > 0:
+        warning_str += "Not enough time for " + _task.title + " (" + _task.subtitle + ") with " + \
+                       str(unplaced_minutes / 60) + " hour(s) extra.\n"
+    return added, max(0, unplaced_minutes), warning_str
+
+
+class DailyTitles(collections.abc.Mapping):
+    # The minutes given to each title, as an array per title id running from the first day any of its tasks can start.
+    # Reads as a mapping of date to {title: hours} for the days with work, through an index of the title ids with
+    # minutes on each day, grouped by day in date order
+    def __init__(self, titles: task_snapshot.StringTable, first_ordinals: MutableSequence[int],
+                 minutes: List[MutableSequence[int]]):
+        self.titles = titles
+        self.first_ordinals = first_ordinals
+        self.minutes = minutes
+        day_titles: Dict[int, List[int]] = {}
+        for title_id, (first, title_minutes) in enumerate(zip(first_ordinals, minutes)):
+            for offset, day_minutes in enumerate(title_minutes):
+                if day_minutes > 0:
+                    day_titles.setdefault(first + offset, []).append(title_id)
+        self.day_ordinals = array('i', sorted(day_titles))
+        self.day_ends = array('q')
+        self.day_title_ids = array('i')
+        for ordinal in self.day_ordinals:
+            self.day_title_ids.extend(day_titles[ordinal])
+            self.day_ends.append(len(self.day_title_ids))
+
+    @classmethod
+    def from_dict(cls, daily_titles: Mapping[datetime.date, Dict[str, float]]) -> 'DailyTitles':
+        titles = task_snapshot.StringTable()
+        spans: List[List[int]] = []
+        for date, day_titles in daily_titles.items():
+            for title in day_titles:
+                title_id = titles.intern(title)
+                if title_id >= len(spans):
+                    spans.append([date.toordinal(), date.toordinal()])
+                spans[title_id] = [min(spans[title_id][0], date.toordinal()), max(spans[title_id][1], date.toordinal())]
+        minutes = [array('q', bytes(8 * (last - first + 1))) for first, last in spans]
+        for date, day_titles in daily_titles.items():
+            for title, hours in day_titles.items():
+                title_id = titles.ids[title]
+                minutes[title_id][date.toordinal() - spans[title_id][0]] = hours_to_minutes(hours)
+        return cls(titles, array('i', (first for first, _ in spans)), minutes)
+
+    def __getitem__(self, date: datetime.date) -> Dict[str, float]:
+        ordinal = date.toordinal()
+        position = bisect.bisect_left(self.day_ordinals, ordinal)
+        if position >= len(self.day_ordinals) or self.day_ordinals[position] != ordinal:
+            raise KeyError(date)
+        day_titles = {}
+        for title_id in self.day_title_ids[self.day_ends[position - 1] if position > 0 else 0:self.day_ends[position]]:
+            day_titles[self.titles.strings[title_id]] = \
+                self.minutes[title_id][ordinal - self.first_ordinals[title_id]] / 60
+        return day_titles
+
+    def __iter__(self) -> Iterator[datetime.date]:
+        return (datetime.date.fromordinal(ordinal) for ordinal in self.day_ordinals)
+
+    def __len__(self) -> int:
+        return len(self.day_ordinals)
+
+
+@instrumentation.timed
+def calc_daily_subjects(tasks: Iterable[Task], auto_work_per_day: Dict[datetime.date, float],
+                        progress: Callable[[Iterable, str], Iterable] = no_progress,
+                        diagnostics: Optional[Diagnostics] = None,
+                        events: Optional[allocation_events.AllocationEvents] = None,
+                        record: Optional[StageRecord] = None, start: int = 0) -> Tuple[DailyTitles, float]:
+    # Assign subjects to each day. With a record, the minutes taken from each day and given to each title are copied
+    # every so often and the run resumes from the last copy taken before start, reporting only the tasks it runs
+
+    # Minutes are taken out of an array of the auto work by day, the tasks themselves are immutable
+    if not isinstance(tasks, TaskTable):
+        tasks = TaskTable(tasks)
+    horizon_start = min(auto_work_per_day, default=datetime.date.today()).toordinal()
+    num_days = max(auto_work_per_day, default=datetime.date.today()).toordinal() + 1 - horizon_start
+    remaining = array('q', bytes(8 * num_days))
+    has_auto_work = bytearray(num_days)
+    for date, hours in auto_work_per_day.items():
+        remaining[date.toordinal() - horizon_start] = hours_to_minutes(hours)
+        has_auto_work[date.toordinal() - horizon_start] = 1
+
+    # Each title's days run from the earliest start of its tasks to the latest due date
+    first_ordinals = array('i', [datetime.date.max.toordinal()] * len(tasks.titles.strings))
+    end_ordinals = array('i', [0] * len(tasks.titles.strings))
+    for title_id, start_ordinal, due_ordinal in zip(tasks.title_ids, tasks.start_ordinals, tasks.due_ordinals):
+        first_ordinals[title_id] = min(first_ordinals[title_id], start_ordinal)
+        end_ordinals[title_id] = max(end_ordinals[title_id], due_ordinal)
+    title_minutes = [array('q', bytes(8 * max(0, end - first))) for first, end in zip(first_ordinals, end_ordinals)]
+
+    resume_index, checkpoint = record.resume_from(start) if record is not None else (0, None)
+    auto_minutes = array('q', remaining) if record is not None else remaining
+    if checkpoint is not None:
+        checkpoint_ordinal, taken, checkpoint_titles = checkpoint
+        offset = checkpoint_ordinal - horizon_start
+        for day in range(max(0, offset), min(num_days, offset + len(taken))):
+            remaining[day] -= taken[day - offset]
+        for title, (title_ordinal, minutes) in checkpoint_titles.items():
+            if title in tasks.titles.ids:
+                title_id = tasks.titles.ids[title]
+                copy_day_offsets(minutes, title_ordinal, title_minutes[title_id], first_ordinals[title_id])
+    warning_str = ''
+    missed_time = 0
+    profile = instrumentation.active
+    interval = checkpoint_interval(len(tasks))
+    for index, _task in enumerate(progress(tasks[resume_index:] if resume_index > 0 else tasks, 'Assigning subjects'),
+                                  resume_index):
+        if record is not None and index % interval == 0 and index > resume_index:
+            record.add_checkpoint(index, horizon_start,
+                                  array('q', (auto - left for auto, left in zip(auto_minutes, remaining))),
+                                  {title: (first_ordinals[title_id], array('q', title_minutes[title_id]))
+                                   for title_id, title in enumerate(tasks.titles.strings)})
+        if profile is not None:
+            profile.begin_task('calc_daily_subjects', index, _task)
+        days = [day for day in range(max(0, tasks.start_ordinals[index] - horizon_start),
+                                     min(num_days, tasks.due_ordinals[index] - horizon_start)) if has_auto_work[day]]
+        added, unplaced_minutes, task_warning = place_task_minutes(_task, [remaining[day] for day in days])
+        title_id = tasks.title_ids[index]
+        title_offset = horizon_start - first_ordinals[title_id]
+        for day, minutes in zip(days, added):
+            if minutes > 0:
+                remaining[day] -= minutes
+                title_minutes[title_id][day + title_offset] += minutes
+        if record is not None:
+            record.end_task(unplaced_minutes, task_warning)
+        if profile is not None:
+            profile.end_task()
+        if events is not None:
+            events.record(allocation_events.subjects_stage, index,
+                          {datetime.date.fromordinal(horizon_start + day): minutes
+                           for day, minutes in zip(days, added) if minutes > 0})
+        task_missed_time = unplaced_minutes / 60
+        missed_time += task_missed_time
+        warning_str += task_warning
+        if diagnostics is not None:
+            if task_missed_time > 0:
+                diagnostics.missed_tasks[_task.subtitle] = round_hours_to_minute(
+                    diagnostics.missed_tasks.get(_task.subtitle, 0) + task_missed_time)
+            if task_warning:
+                diagnostics.warnings.append(task_warning.rstrip('\n'))
+    if diagnostics is None:
+        print(warning_str)
+    else:
+        diagnostics.missed_time += missed_time
+    return DailyTitles(tasks.titles, first_ordinals, title_minutes), missed_time
 
-    return _auto_work_per_day, _work_on_days_to_due
 
+complete_prefix = "(Complete) "
 
-def calc_daily_subjects(tasks: List[Task], auto_work_per_day: Dict[datetime.date, float]) -> \
-        Tuple[Dict[datetime.date, Dict[str, float]], float]:
-    # Assign subjects to each day
 
-    # Ensure mutable objects aren't mutated
-    tasks = deepcopy(tasks)
-    auto_work_per_day = deepcopy(auto_work_per_day)
+def subtitle_label(task: Task, date: datetime.date, complete: bool) -> str:
+    # The task's subtitle as shown on a day, marked if it's finished that day or due or overdue
+    return ordinal_subtitle_label(task.subtitle, task.due_date.toordinal(), task.actual_due_date.toordinal(),
+                                  date.toordinal(), complete)
 
-    _daily_titles = {}
-    warning_str = ''
-    missed_time = 0
-    for index, _task in enumerate(tqdm(tasks, desc='Assigning subjects')):
-        available_days = [_task.start_date + datetime.timedelta(days=x) for x in
-                          range(0, (_task.due_date - _task.start_date).days) if
-                          _task.start_date + datetime.timedelta(days=x) in auto_work_per_day]
-
-        _required_hours = _task.required_hours
-        failed_min_time = 0
-        while _required_hours >= time_inc and len(available_days) > 0:
-            previous_hours = _required_hours
-            work_to_add = max(round_hours_to_minute(_required_hours / len(available_days)), _task.min_time)
-            for date in available_days:
-                if _required_hours >= work_to_add and auto_work_per_day[date] >= work_to_add:
-                    auto_work_per_day[date] = round_hours_to_minute(auto_work_per_day[date] - work_to_add)
-                    _required_hours = round_hours_to_minute(_required_hours - work_to_add)
-                    if date in _daily_titles:
-                        if _task.title in _daily_titles[date]:
-                            _daily_titles[date][_task.title] += work_to_add
-                        else:
-                            _daily_titles[date][_task.title] = work_to_add
-                    else:
-                        _daily_titles[date] = {_task.title: work_to_add}
-
-            if previous_hours == _required_hours:
-                if failed_min_time > 50:
-                    warning_str += "Not enough time for " + _task.title + " (" + _task.subtitle + ") with " + \
-                                   str(_required_hours) + " hour(s) extra.\n"
-                    missed_time += _required_hours
-                    break
-                _task.min_time = time_inc
-                assert len(available_days) > 0
-                failed_min_time += 1
-        if len(available_days) <= 0:
-            if _required_hours > 1:
-                warning_str += 'Do ' + str(_required_hours) + ' hours of ' + _task.subtitle + ' now!\n'
-            else:
-                warning_str += 'Do ' + str(_required_hours) + ' hour of ' + _task.subtitle + ' now!\n'
-    print(warning_str)
-    return _daily_titles, missed_time
-
-
-def calc_daily_tasks(tasks: List[Task], subject_distribution: Dict[datetime.date, Dict[str, float]]) -> \
-        Dict[datetime.date, Dict[str, int]]:
-    # Assign specific tasks to dates
-    tasks = deepcopy(tasks)
-    subject_distribution = deepcopy(subject_distribution)
-    _daily_subtitles = {}
-    for task in tqdm(tasks, desc="Assigning tasks"):
-        required_hours = task.required_hours
-        for date in sorted(filter(lambda x: x >= task.start_date, subject_distribution)):
-            if (task.title in subject_distribution[date] and required_hours > 0
-                    and subject_distribution[date][task.title]) > 0:
-                auto_work_to_add = min(required_hours, subject_distribution[date][task.title])
-                required_hours -= auto_work_to_add
-                subject_distribution[date][task.title] -= auto_work_to_add
-                output_subtitle = task.subtitle
-                overdue = task.due_date - task.actual_due_date
-
-                # Ensure they close cleanly to zero
-                if 0 < required_hours < time_inc:
-                    print('Minimising ' + task.subtitle + ': required hours = ' + str(required_hours))
-                    required_hours = 0
-                if 0 < subject_distribution[date][task.title] < time_inc:
-                    print('Minimising ' + task.subtitle + ': daily titles = ' +
-                          str(subject_distribution[date][task.title]))
-                    subject_distribution[date][task.title] = 0
-
-                if required_hours <= 0:
-                    output_subtitle = "(Complete) " + output_subtitle
-                if overdue.days > 1:
-                    output_subtitle = f'(OVERDUE {str(overdue.days - 1)} DAY{"S" if overdue.days > 2 else ""}) {output_subtitle}'
-                elif overdue.days == 1:
-                    output_subtitle = "(DUE TODAY) " + output_subtitle
-                elif task.due_date == date + datetime.timedelta(days=1):
-                    if task.due_date == datetime.datetime.now().date() + datetime.timedelta(days=1):
-                        output_subtitle = "(DUE TOMORROW) " + output_subtitle
-                    else:
-                        output_subtitle = "(DUE NEXT DAY) " + output_subtitle
-                if date in _daily_subtitles:
-                    if output_subtitle in _daily_subtitles[date]:
-                        _daily_subtitles[date][output_subtitle] += auto_work_to_add
-                    else:
-                        _daily_subtitles[date][output_subtitle] = auto_work_to_add
-                else:
-                    _daily_subtitles[date] = {output_subtitle: auto_work_to_add}
-        if required_hours >= time_inc:
-            print('%s: %s' % (task.subtitle, required_hours))
-    return _daily_subtitles
 
+def ordinal_subtitle_label(subtitle: str, due_ordinal: int, actual_due_ordinal: int, ordinal: int,
+                           complete: bool) -> str:
+    # subtitle_label for a task held as columns of a TaskTable, without building the Task
+    output_subtitle = subtitle
+    overdue_days = due_ordinal - actual_due_ordinal
+    if complete:
+        output_subtitle = complete_prefix + output_subtitle
+    if overdue_days > 1:
+        output_subtitle = f'(OVERDUE {str(overdue_days - 1)} DAY{"S" if overdue_days > 2 else ""}) {output_subtitle}'
+    elif overdue_days == 1:
+        output_subtitle = "(DUE TODAY) " + output_subtitle
+    elif due_ordinal == ordinal + 1:
+        if due_ordinal == datetime.datetime.now().date().toordinal() + 1:
+            output_subtitle = "(DUE TOMORROW) " + output_subtitle
+        else:
+            output_subtitle = "(DUE NEXT DAY) " + output_subtitle
+    return output_subtitle
 
-def print_results(_daily_subtitles: Dict[datetime.date, Dict[str, int]],
-                  _work_on_days_to_due: Dict[datetime.date, float],
-                  weekly_work: Dict[str, float],
-                  single_fixed_work: Dict[datetime.date, float]) -> None:
-    # Display results
-    screen_width = get_screen_width()
-    actual_hours_sum = 0
-    for _date in sorted(_daily_subtitles, reverse=reverse_output):
-        total_auto = 0
-        for _task in _daily_subtitles[_date]:
-            total_auto += _daily_subtitles[_date][_task]
-
-        # Create correct number of title dashes
-        output = '{0} {1} ({2} auto/{3} total)'.format(weekday_conversion[_date.weekday()], str(_date),
-                                                       decimal_to_timestring(total_auto),
-                                                       decimal_to_timestring(_work_on_days_to_due[_date]))
-        cur_side_left = True
-        if len(output) >= screen_width:
-            output = '-' * screen_width + '\n' + output + '\n' + '.' * screen_width
-        while len(output) < screen_width:
-            if cur_side_left:
-                output = '-' + output
+
+def report_unassigned_hours(subtitle: str, hours: float, diagnostics: Optional[Diagnostics]) -> None:
+    if diagnostics is None:
+        print('%s: %s' % (subtitle, hours))
+    else:
+        diagnostics.unassigned_hours[subtitle] = hours
+
+
+class DailySubtitles(collections.abc.Mapping):
+    # The minutes given to each task on each day, as rows of day ordinal, task index, minutes and whether the task was
+    # finished, grouped by day in date order. Reads as a mapping of date to {subtitle: hours}, with the labels only made
+    # when a day is read
+    def __init__(self, tasks: TaskTable, row_ordinals: MutableSequence[int], task_indices: MutableSequence[int],
+                 minutes: MutableSequence[int], completes: bytearray):
+        self.tasks = tasks
+        order = sorted(range(len(row_ordinals)), key=row_ordinals.__getitem__)
+        if instrumentation.active is not None:
+            instrumentation.active.count('sorts')
+        self.task_indices = array('i', (task_indices[row] for row in order))
+        self.minutes = array('q', (minutes[row] for row in order))
+        self.completes = bytearray(completes[row] for row in order)
+        self.day_ordinals = array('i')
+        self.day_ends = array('q')
+        for position, row in enumerate(order):
+            if len(self.day_ordinals) > 0 and self.day_ordinals[-1] == row_ordinals[row]:
+                self.day_ends[-1] = position + 1
             else:
-                output = output + '-'
+                self.day_ordinals.append(row_ordinals[row])
+                self.day_ends.append(position + 1)
+
+    def __getitem__(self, date: datetime.date) -> Dict[str, float]:
+        position = bisect.bisect_left(self.day_ordinals, date.toordinal())
+        if position >= len(self.day_ordinals) or self.day_ordinals[position] != date.toordinal():
+            raise KeyError(date)
+        # Every day's labels are made when it's read, so its rows are taken as slices of the columns. Only rows due the
+        # next day or overdue go through ordinal_subtitle_label, the rest at most need marking as complete
+        rows = slice(self.day_ends[position - 1] if position > 0 else 0, self.day_ends[position])
+        subtitle_data, subtitle_ends = self.tasks.subtitles.data, self.tasks.subtitles.ends
+        subtitle_ids = self.tasks.subtitle_ids
+        due_ordinals, actual_due_ordinals = self.tasks.due_ordinals, self.tasks.actual_due_ordinals
+        next_ordinal = date.toordinal() + 1
+        label_minutes: Dict[str, int] = {}
+        for index, minutes, complete in zip(self.task_indices[rows], self.minutes[rows], self.completes[rows]):
+            subtitle_id = subtitle_ids[index]
+            label = subtitle_data[subtitle_ends[subtitle_id - 1] if subtitle_id > 0 else 0:
+                                  subtitle_ends[subtitle_id]].decode()
+            due_ordinal = due_ordinals[index]
+            if due_ordinal == next_ordinal or due_ordinal != actual_due_ordinals[index]:
+                label = ordinal_subtitle_label(label, due_ordinal, actual_due_ordinals[index], next_ordinal - 1,
+                                               complete)
+            elif complete:
+                label = complete_prefix + label
+            label_minutes[label] = label_minutes.get(label, 0) + minutes
+        return {label: day_minutes / 60 for label, day_minutes in label_minutes.items()}
+
+    def __iter__(self) -> Iterator[datetime.date]:
+        return (datetime.date.fromordinal(ordinal) for ordinal in self.day_ordinals)
+
+    def __len__(self) -> int:
+        return len(self.day_ordinals)
+
+
+@instrumentation.timed
+def calc_daily_tasks(tasks: Iterable[Task], subject_distribution: Mapping[datetime.date, Dict[str, float]],
+                     progress: Callable[[Iterable, str], Iterable] = no_progress,
+                     diagnostics: Optional[Diagnostics] = None,
+                     events: Optional[allocation_events.AllocationEvents] = None,
+                     record: Optional[StageRecord] = None, start: int = 0) -> DailySubtitles:
+    # Assign specific tasks to dates, taking minutes from a copy of each title's days. The days with minutes for each
+    # title are listed once, with a cursor per title past the days used up at the front. With a record, the tasks
+    # before start are taken from its rows and the rest are run, added to them and reported
+    if not isinstance(tasks, TaskTable):
+        tasks = TaskTable(tasks)
+    if not isinstance(subject_distribution, DailyTitles):
+        subject_distribution = DailyTitles.from_dict(subject_distribution)
+    title_map = [subject_distribution.titles.ids.get(title, -1) for title in tasks.titles.strings]
+    title_minutes = [array('q', minutes) for minutes in subject_distribution.minutes]
+    if record is None:
+        record = StageRecord()
+    record.truncate(start)
+    for index, ordinal, minutes in zip(record.task_indices, record.ordinals, record.minutes):
+        title_id = title_map[tasks.title_ids[index]]
+        title_minutes[title_id][ordinal - subject_distribution.first_ordinals[title_id]] -= minutes
+    title_days = [array('i', (day for day, minutes in enumerate(day_minutes) if minutes > 0))
+                  for day_minutes in title_minutes]
+    cursors = [0] * len(title_days)
+
+    profile = instrumentation.active
+    for index, task in enumerate(progress(tasks[start:] if start > 0 else tasks, "Assigning tasks"), start):
+        if profile is not None:
+            profile.begin_task('calc_daily_tasks', index, task)
+        # Counted in whole minutes, as the subject stage placed them, so days and tasks close exactly to zero
+        required_minutes = hours_to_minutes(tasks.required_hours[index])
+        task_minutes: Dict[datetime.date, int] = {}
+        title_id = title_map[tasks.title_ids[index]]
+        if title_id >= 0:
+            day_minutes = title_minutes[title_id]
+            days = title_days[title_id]
+            first = subject_distribution.first_ordinals[title_id]
+            cursor = cursors[title_id]
+            while cursor < len(days) and day_minutes[days[cursor]] <= 0:
+                cursor += 1
+            cursors[title_id] = cursor
+            position = max(cursor, bisect.bisect_left(days, tasks.start_ordinals[index] - first))
+            while required_minutes > 0 and position < len(days):
+                day = days[position]
+                if day_minutes[day] > 0:
+                    minutes = min(required_minutes, day_minutes[day])
+                    required_minutes -= minutes
+                    day_minutes[day] -= minutes
+                    record.add_row(index, first + day, minutes, required_minutes <= 0)
+                    if events is not None:
+                        task_minutes[datetime.date.fromordinal(first + day)] = minutes
+                position += 1
+        if required_minutes > 0:
+            report_unassigned_hours(task.subtitle, required_minutes / 60, diagnostics)
+        record.end_task(max(0, required_minutes))
+        if profile is not None:
+            profile.end_task()
+        if events is not None:
+            events.record(allocation_events.tasks_stage, index, task_minutes)
+    return DailySubtitles(tasks, record.ordinals, record.task_indices, record.minutes, record.completes)
 
-            cur_side_left = not cur_side_left
 
-        print(Fore.GREEN)
-        print(output)
-        print(Style.RESET_ALL)
+@dataclass
+class ScheduleDay:
+    date: datetime.date
+    subtitles: Dict[str, float]
+    auto_hours: float
+    total_hours: float
+    fixed_hours: float
+
+    @property
+    def excess_hours(self) -> float:
+        return self.auto_hours + self.fixed_hours - self.total_hours
+
+
+def schedule_days(_daily_subtitles: Mapping[datetime.date, Dict[str, float]],
+                  _work_on_days_to_due: Dict[datetime.date, float], weekly_work: Dict[str, float],
+                  single_fixed_work: Dict[datetime.date, float], reverse_output: bool = False) -> \
+        Iterator[ScheduleDay]:
+    # Each scheduled day with its totals, one at a time, for the text output and the exporters. Days are only read
+    # once, as the stages' outputs build each day's subtitles when it's read
+    calendar = FixedCalendar.for_dates(_daily_subtitles, weekly_work, single_fixed_work)
+    for _date in sorted(_daily_subtitles, reverse=reverse_output):
+        subtitles = _daily_subtitles[_date]
+        total_auto = 0
+        for hours in subtitles.values():
+            total_auto += hours
+        yield ScheduleDay(_date, subtitles, total_auto, _work_on_days_to_due[_date], calendar.work_on_day(_date))
+
+
+def render_day(day: ScheduleDay, screen_width: int, colour: bool = True) -> str:
+    # Header centred in dashes, or fenced on lines of its own if it doesn't fit, then the day's tasks
+    green, red, reset = (Fore.GREEN, Fore.RED, Style.RESET_ALL) if colour else ('', '', '')
+    header = '{0} {1} ({2} auto/{3} total)'.format(weekday_conversion[day.date.weekday()], str(day.date),
+                                                   decimal_to_timestring(day.auto_hours),
+                                                   decimal_to_timestring(day.total_hours))
+    if len(header) >= screen_width:
+        header = '-' * screen_width + '\n' + header + '\n' + '.' * screen_width
+    else:
+        padding = screen_width - len(header)
+        header = '-' * ((padding + 1) // 2) + header + '-' * (padding // 2)
+    parts = [green, '\n', header, '\n', reset, '\n']
+    for subtitle, hours in day.subtitles.items():
+        parts += [subtitle, ': ', decimal_to_timestring(hours), '\n']
+
+    # Show if there's a miss-match in work amounts
+    excess_work = day.excess_hours
+    if round_hours_to_minute(excess_work) > 0:
+        parts += [red, decimal_to_timestring(excess_work), ' hours of extra work', reset, '\n']
+    elif round_hours_to_minute(excess_work) < 0:
+        parts += [red, 'Missing ', decimal_to_timestring(-excess_work), ' hours of work', reset, '\n']
+    return ''.join(parts)
+
+
+def render_results(_daily_subtitles: Dict[datetime.date, Dict[str, int]],
+                   _work_on_days_to_due: Dict[datetime.date, float],
+                   weekly_work: Dict[str, float],
+                   single_fixed_work: Dict[datetime.date, float], reverse_output: bool = True,
+                   colour: bool = True) -> str:
+    screen_width = get_screen_width()
+    return ''.join(render_day(day, screen_width, colour)
+                   for day in schedule_days(_daily_subtitles, _work_on_days_to_due, weekly_work, single_fixed_work,
+                                            reverse_output))
 
-        for _task in _daily_subtitles[_date]:
-            print(_task + ': ' + decimal_to_timestring(_daily_subtitles[_date][_task]))
-            actual_hours_sum += _daily_subtitles[_date][_task]
 
-        # Show if there's a miss-match in work amounts
-        excess_work = total_auto + get_work_on_day(_date, weekly_work, single_fixed_work) - _work_on_days_to_due[_date]
-        if round_hours_to_minute(excess_work) > 0:
-            print(Fore.RED + decimal_to_timestring(excess_work) + ' hours of extra work' + Style.RESET_ALL)
-        elif round_hours_to_minute(excess_work) < 0:
-            print(Fore.RED + 'Missing ' + decimal_to_timestring(-excess_work) + ' hours of work' + Style.RESET_ALL)
+@instrumentation.timed
+def print_results(_daily_subtitles: Dict[datetime.date, Dict[str, int]],
+                  _work_on_days_to_due: Dict[datetime.date, float],
+                  weekly_work: Dict[str, float],
+                  single_fixed_work: Dict[datetime.date, float], reverse_output: bool = True,
+                  colour: Optional[bool] = None) -> None:
+    # Display results, built up in one buffer and written at once, only coloured on a terminal unless told otherwise
+    if colour is None:
+        colour = sys.stdout.isatty()
+    sys.stdout.write(render_results(_daily_subtitles, _work_on_days_to_due, weekly_work, single_fixed_work,
+                                    reverse_output, colour))
+
+
+def find_overdue_tasks(flexi_tasks: List[Task]) -> List[Task]:
+    # Tasks whose due date was moved past the one given, as they couldn't be done in time
+    return [_task for _task in flexi_tasks if (_task.due_date - _task.actual_due_date).days > 1]
+
+
+def all_calcs(flexi_tasks, regular_fixed, one_off_fixed, weekends, events=None, diagnostics=None,
+              progress=no_progress):
+    if diagnostics is not None:
+        diagnostics.overdue_tasks += find_overdue_tasks(flexi_tasks)
+    flexi_per_day, work_on_days_to_due = calc_daily_work(flexi_tasks, regular_fixed, one_off_fixed, weekends,
+                                                         progress, events=events)
+    daily_titles, _ = calc_daily_subjects(flexi_tasks, flexi_per_day, progress, diagnostics, events)
+    daily_subtitles = calc_daily_tasks(flexi_tasks, daily_titles, progress, diagnostics, events)
+    return daily_subtitles, work_on_days_to_due
 
 
-def all_calcs(flexi_tasks, regular_fixed, one_off_fixed, weekends):
-    flexi_per_day, work_on_days_to_due = calc_daily_work(flexi_tasks, regular_fixed, one_off_fixed, weekends)
-    daily_titles, _ = calc_daily_subjects(flexi_tasks, flexi_per_day)
-    daily_subtitles = calc_daily_tasks(flexi_tasks, daily_titles)
-    return daily_subtitles, work_on_days_to_due
+@dataclass
+class ScheduleResult:
+    daily_subtitles: Mapping[datetime.date, Dict[str, float]]
+    work_on_days_to_due: Dict[datetime.date, float]
+    regular_fixed: Dict[str, float]
+    one_off_fixed: Dict[datetime.date, float]
+    diagnostics: Diagnostics
+
+
+def calc_schedule(flexi_tasks: List[Task], regular_fixed: Dict[str, float], one_off_fixed: Dict[datetime.date, float],
+                  weekends: bool = True, progress: Callable[[Iterable, str], Iterable] = no_progress,
+                  diagnostics: Optional[Diagnostics] = None) -> ScheduleResult:
+    # Same as all_calcs, but anything that would be printed is collected in the diagnostics instead
+    if diagnostics is None:
+        diagnostics = Diagnostics()
+    diagnostics.overdue_tasks += find_overdue_tasks(flexi_tasks)
+    flexi_per_day, work_on_days_to_due = calc_daily_work(flexi_tasks, regular_fixed, one_off_fixed, weekends, progress)
+    daily_titles, _ = calc_daily_subjects(flexi_tasks, flexi_per_day, progress, diagnostics)
+    daily_subtitles = calc_daily_tasks(flexi_tasks, daily_titles, progress, diagnostics)
+    return ScheduleResult(daily_subtitles, work_on_days_to_due, regular_fixed, one_off_fixed, diagnostics)
+
+
+def schedule_files(cur_date: datetime.date, task_filename: str = 'one-off_tasks',
+                   fixed_filename: str = 'day_fixed_work.txt', weekends: bool = True,
+                   progress: Callable[[Iterable, str], Iterable] = no_progress,
+                   use_snapshot: bool = False) -> ScheduleResult:
+    # Load, schedule and report on a pair of task files without any terminal output. Raises DateOrderError for tasks
+    # due before they start
+    diagnostics = Diagnostics()
+    fixed_tasks, regular_fixed, one_off_fixed = load_fixed_tasks(fixed_filename, use_snapshot, diagnostics)
+    flexi_tasks = load_flexi_tasks(cur_date, task_filename, weekends, use_snapshot, diagnostics)
+    remove_fixed_from_flexi(fixed_tasks, flexi_tasks)
+    return calc_schedule(flexi_tasks, regular_fixed, one_off_fixed, weekends, progress, diagnostics)
 
 
 if __name__ == '__main__':
-    # Sync with Google Drive
-    print("Updating data from drive")
-    sync.safe_sync()
+    parser = argparse.ArgumentParser(description='Schedule flexible tasks around fixed work')
+    parser.add_argument('--profile', nargs='?', const='profile.json', metavar='FILE',
+                        help='recalculate the whole schedule and write stage timings, loop counters and the slowest '
+                             'tasks to FILE as JSON (default: %(const)s)')
+    parser.add_argument('--events', metavar='FILE',
+                        help='recalculate the whole schedule and record every allocation each stage makes to FILE')
+    parser.add_argument('--optimal', action='store_true',
+                        help='recalculate the whole schedule with the exact solver, giving the lowest possible peak '
+                             'day but ignoring minimum session lengths')
+    parser.add_argument('--include-today', action=argparse.BooleanOptionalAction,
+                        help='schedule work for today as well as the following days')
+    parser.add_argument('--weekends', action=argparse.BooleanOptionalAction, help='schedule work on weekends')
+    parser.add_argument('--reverse-output', action=argparse.BooleanOptionalAction, help='print later dates first')
+    parser.add_argument('--clear', action=argparse.BooleanOptionalAction, help='clear the terminal history first')
+    parser.add_argument('--separate', action=argparse.BooleanOptionalAction,
+                        help='separate the output from previous commands')
+    parser.add_argument('--sync', action=argparse.BooleanOptionalAction, default=True,
+                        help='update the task files from Google Drive first (default: %(default)s)')
+    parser.add_argument('--sync-ttl', type=float, default=sync.default_ttl_minutes, metavar='MINUTES',
+                        help="skip syncing if the last sync was this recent and the files haven't changed since "
+                             "(default: %(default)s, 0 always syncs)")
+    parser.add_argument('--sync-timeout', type=float, default=sync.default_timeout, metavar='SECONDS',
+                        help='longest to wait for the sync before scheduling from the local files, which are synced in '
+                             'the background meanwhile (default: %(default)s)')
+    parser.add_argument('-y', '--yes', action='store_true',
+                        help="don't ask any questions, using the defaults for anything not given as a flag")
+    parser.add_argument('--batch', nargs='+', metavar='DIR',
+                        help=f'schedule each directory unattended, writing {{DIR}}/schedule.txt and '
+                             f'{{DIR}}/diagnostics.txt')
+    parser.add_argument('--jobs', type=int, help='processes to use for --batch (default: one per CPU)')
+    parser.add_argument('--watch', action='store_true',
+                        help='keep schedule.txt up to date as the task files change, syncing once edits settle')
+    parser.add_argument('--progress', action='store_true',
+                        help='show a progress bar for each stage of the calculation (needs tqdm)')
+    parser.add_argument('--export', nargs='+', default=[], metavar='FILE',
+                        help='also write the schedule to each FILE as JSON Lines, CSV or iCalendar, going by its '
+                             'extension (.jsonl, .csv or .ics)')
+    arguments = parser.parse_args()
+    if arguments.export:
+        import export
+        for export_filename in arguments.export:
+            if export.export_format(export_filename) is None:
+                parser.error(f'unknown export format for {export_filename}, use one of '
+                             f'{", ".join(export.export_formats)}')
+    if arguments.yes or arguments.batch or arguments.watch:
+        for option, default in [('include_today', True), ('weekends', True), ('reverse_output', True),
+                                ('clear', False), ('separate', False)]:
+            if getattr(arguments, option) is None:
+                setattr(arguments, option, default)
+
+    if arguments.batch:
+        import batch
+        batch_results = batch.schedule_directories(arguments.batch, input_start_date(arguments.include_today),
+                                                   arguments.weekends, arguments.reverse_output, arguments.jobs)
+        for batch_result in batch_results:
+            print(f'{batch_result.directory}: {"done" if batch_result.succeeded else batch_result.message}')
+        exit(0 if all(batch_result.succeeded for batch_result in batch_results) else 1)
+
+    if arguments.watch:
+        import watch
+        if arguments.sync:
+            sync.safe_sync(arguments.sync_ttl, arguments.sync_timeout)
+        try:
+            watch.watch(arguments.include_today, arguments.weekends, arguments.reverse_output, arguments.sync)
+        except KeyboardInterrupt:
+            pass
+        exit()
+
+    # Sync with Google Drive, in the background while the questions are answered if already signed in
+    background_sync = None
+    if arguments.sync:
+        print("Updating data from drive")
+        if sync.can_sync_in_background():
+            background_sync = sync.BackgroundSync(arguments.sync_ttl, arguments.sync_timeout)
+        else:
+            sync.safe_sync(arguments.sync_ttl, arguments.sync_timeout)
 
     # Input choices
-    start_date = input_start_date()
-    weekends = bool_input('include weekends')
-    reverse_output = bool_input('reverse output')
-    if bool_input('clear terminal history'):
+    start_date = input_start_date(arguments.include_today)
+    weekends = bool_input('include weekends', answer=arguments.weekends)
+    reverse_output = bool_input('reverse output', answer=arguments.reverse_output)
+    if bool_input('clear terminal history', answer=arguments.clear):
         subprocess.call('reset')
-    elif bool_input('separate output'):
+    elif bool_input('separate output', answer=arguments.separate):
         separate_output()
 
-    # Load data
-    fixed_tasks, regular_fixed, one_off_fixed = load_fixed_tasks()
-    try:
-        flexi_tasks = load_flexi_tasks(start_date)
-    except DateOrderError as e:
-        print(f"{e.task.title} - {e.task.subtitle} has a due date before the start date ({e.task.due_date} <= {e.task.start_date})")
-        exit()
-    remove_fixed_from_flexi(fixed_tasks, flexi_tasks)
-
-    print("All input data imported")
-
-    # Calculate task distribution
-    result, work_on_days_to_due = all_calcs(flexi_tasks, regular_fixed, one_off_fixed, weekends)
-
-    print_results(result, work_on_days_to_due, regular_fixed, one_off_fixed)
+    if background_sync is not None and not background_sync.finish():
+        print('Sync is taking too long, scheduling from the local files')
+
+    # Reuse the stored schedule if nothing has changed since it was calculated, unless profiling, recording or solving
+    # a full run
+    progress = tqdm_progress if arguments.progress else no_progress
+    full_run = arguments.profile or arguments.events or arguments.optimal
+    if arguments.profile:
+        instrumentation.start()
+    schedule_key = schedule_cache.cache_key(start_date, weekends)
+    cached_schedule = None if full_run else schedule_cache.load_schedule(schedule_key)
+    if cached_schedule is not None:
+        result, work_on_days_to_due = cached_schedule.daily_subtitles, cached_schedule.work_on_days_to_due
+        regular_fixed, one_off_fixed = cached_schedule.regular_fixed, cached_schedule.one_off_fixed
+        diagnostics = cached_schedule.diagnostics
+    else:
+        # Load data, keeping what's reported with the schedule so a reused schedule reports it too
+        diagnostics = Diagnostics()
+        fixed_tasks, regular_fixed, one_off_fixed = load_fixed_tasks(use_snapshot=True, diagnostics=diagnostics)
+        try:
+            flexi_tasks = load_flexi_tasks(start_date, use_snapshot=True, diagnostics=diagnostics)
+        except DateOrderError as e:
+            sys.stdout.write(format_diagnostics(diagnostics))
+            print(f"Line {e.line_number}: {e.task.title} - {e.task.subtitle} has a due date before the start date "
+                  f"({e.task.due_date} <= {e.task.start_date})")
+            exit()
+        remove_fixed_from_flexi(fixed_tasks, flexi_tasks)
+
+        print("All input data imported")
+
+        # Calculate task distribution, reusing the previous run's allocations for anything unaffected by edits
+        if arguments.optimal:
+            import optimal
+            optimal_schedule = optimal.solve(flexi_tasks, regular_fixed, one_off_fixed, weekends)
+            result, work_on_days_to_due = optimal_schedule.daily_subtitles, optimal_schedule.work_on_days_to_due
+            print(f'Lowest possible peak day: {decimal_to_timestring(optimal_schedule.peak_minutes / 60)}')
+        elif arguments.events:
+            with allocation_events.AllocationEvents(arguments.events) as events:
+                result, work_on_days_to_due = all_calcs(flexi_tasks, regular_fixed, one_off_fixed, weekends, events,
+                                                        diagnostics, progress)
+            print(f'Allocation events written to {arguments.events}')
+        elif arguments.profile:
+            result, work_on_days_to_due = all_calcs(flexi_tasks, regular_fixed, one_off_fixed, weekends,
+                                                    diagnostics=diagnostics, progress=progress)
+        else:
+            import incremental
+            result, work_on_days_to_due = incremental.incremental_calcs(flexi_tasks, regular_fixed, one_off_fixed,
+                                                                        weekends, diagnostics=diagnostics,
+                                                                        progress=progress)
+        # The exact solver's schedule isn't the one the stages give, so it's never reused
+        if not arguments.optimal:
+            schedule_cache.store_schedule(schedule_key, ScheduleResult(result, work_on_days_to_due, regular_fixed,
+                                                                       one_off_fixed, diagnostics))
+
+    sys.stdout.write(format_diagnostics(diagnostics))
+    print_results(result, work_on_days_to_due, regular_fixed, one_off_fixed, reverse_output)
+    for export_filename in arguments.export:
+        export.export_schedule(export_filename, result, work_on_days_to_due, regular_fixed, one_off_fixed)
+        print(f'Schedule exported to {export_filename}')
+    # Give a slow sync one more budget to finish its uploads before exiting
+    if background_sync is not None:
+        background_sync.finish(arguments.sync_timeout)
+    if arguments.profile:
+        instrumentation.write_report(instrumentation.stop(), arguments.profile)
+        print(f'Profile written to {arguments.profile}')
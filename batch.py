@@ -0,0 +1,75 @@
+import datetime
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from typing import List, Optional
+
+import auto_scheduler
+import incremental
+import schedule_cache
+
+# Scheduling many task directories at once, each with its own task files, saved state, cache, output and diagnostics
+task_filename = 'one-off_tasks'
+fixed_filename = 'day_fixed_work.txt'
+output_filename = 'schedule.txt'
+diagnostics_filename = 'diagnostics.txt'
+
+
+@dataclass
+class BatchResult:
+    directory: str
+    succeeded: bool
+    message: str = ''
+
+
+def schedule_directory(directory: str, start_date: datetime.date, weekends: bool = True,
+                       reverse_output: bool = True) -> BatchResult:
+    # The engine's diagnostics go to the diagnostics file, and the schedule itself goes to the output file
+    if not os.path.isdir(directory):
+        return BatchResult(directory, False, 'Not a directory')
+    tasks_path = os.path.join(directory, task_filename)
+    fixed_path = os.path.join(directory, fixed_filename)
+    cache_path = os.path.join(directory, schedule_cache.cache_dir)
+    diagnostics = auto_scheduler.Diagnostics()
+    message = ''
+    try:
+        schedule_key = schedule_cache.cache_key(start_date, weekends, tasks_path, fixed_path)
+        schedule = schedule_cache.load_schedule(schedule_key, cache_path)
+        if schedule is None:
+            fixed_tasks, regular_fixed, one_off_fixed = auto_scheduler.load_fixed_tasks(fixed_path, True, diagnostics)
+            flexi_tasks = auto_scheduler.load_flexi_tasks(start_date, tasks_path, weekends, True, diagnostics)
+            auto_scheduler.remove_fixed_from_flexi(fixed_tasks, flexi_tasks)
+            result, work_on_days_to_due = incremental.incremental_calcs(
+                flexi_tasks, regular_fixed, one_off_fixed, weekends,
+                os.path.join(directory, incremental.state_filename), diagnostics)
+            schedule = auto_scheduler.ScheduleResult(result, work_on_days_to_due, regular_fixed, one_off_fixed,
+                                                     diagnostics)
+            schedule_cache.store_schedule(schedule_key, schedule, cache_path)
+    except auto_scheduler.DateOrderError as e:
+        message = f"Line {e.line_number}: {e.task.title} - {e.task.subtitle} has a due date before the start " \
+                  f"date ({e.task.due_date} <= {e.task.start_date})"
+    except Exception as e:
+        # One directory's bad files shouldn't stop the rest of the batch
+        message = f'{type(e).__name__}: {e}'
+    with open(os.path.join(directory, diagnostics_filename), 'w') as diagnostics_file:
+        if message:
+            diagnostics_file.write(auto_scheduler.format_diagnostics(diagnostics) + message + '\n')
+            return BatchResult(directory, False, message)
+        diagnostics_file.write(auto_scheduler.format_diagnostics(schedule.diagnostics))
+    # The output is read back from a file rather than shown on a terminal, so it's written without colour codes
+    with open(os.path.join(directory, output_filename), 'w') as output_file:
+        output_file.write(auto_scheduler.render_results(schedule.daily_subtitles, schedule.work_on_days_to_due,
+                                                        schedule.regular_fixed, schedule.one_off_fixed,
+                                                        reverse_output, colour=False))
+    return BatchResult(directory, True)
+
+
+def schedule_directories(directories: List[str], start_date: datetime.date, weekends: bool = True,
+                         reverse_output: bool = True, jobs: Optional[int] = None) -> List[BatchResult]:
+    # Each directory is independent, so the batch takes as long as the slowest one given enough workers
+    if jobs == 1 or len(directories) <= 1:
+        return [schedule_directory(directory, start_date, weekends, reverse_output) for directory in directories]
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(schedule_directory, directory, start_date, weekends, reverse_output)
+                   for directory in directories]
+        return [future.result() for future in futures]
@@ -0,0 +1,195 @@
+#!./.venv/bin/python3
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from copy import deepcopy
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Tuple
+
+import auto_scheduler
+
+benchmark_version = 1
+subjects = ['Maths', 'Physics', 'Chemistry', 'History', 'English', 'Music', 'Art', 'Biology', 'Housework',
+            'Programming', 'Reading', 'Exercise']
+
+# Every workload starts on this day so generated results don't depend on when they're run
+benchmark_start_date = datetime.date(2030, 1, 7)
+
+
+@dataclass
+class Workload:
+    name: str
+    num_tasks: int
+    horizon_days: int
+    max_window_days: int
+    min_time_choices: Tuple[int, ...]
+    weekends: bool
+    seed: int = 0
+
+
+workloads = {
+    '1k': Workload('1k', 1000, 365, 30, (1,), True),
+    '1k-weekdays': Workload('1k-weekdays', 1000, 365, 30, (15, 30, 60), False),
+    '1k-wide': Workload('1k-wide', 1000, 365, 365, (1, 15), True),
+    '1k-long-horizon': Workload('1k-long-horizon', 1000, 3 * 365, 60, (1, 30), True),
+    '10k': Workload('10k', 10000, 2 * 365, 60, (1, 15, 30), True),
+    '100k': Workload('100k', 100000, 5 * 365, 90, (1, 15, 30, 60), True),
+}
+default_workloads = ['1k', '1k-weekdays', '1k-wide', '1k-long-horizon']
+
+
+def format_date(date: datetime.date) -> str:
+    return auto_scheduler.datetime_to_date_string(date)
+
+
+def format_minutes(minutes: int) -> str:
+    return f'{minutes // 60}:{minutes % 60:02d}'
+
+
+def generate_workload(workload: Workload, directory: str) -> Tuple[str, str]:
+    # Write matching task and fixed work files for the workload, returning their paths
+    generator = random.Random(workload.seed)
+    task_filename = os.path.join(directory, 'one-off_tasks')
+    fixed_filename = os.path.join(directory, 'day_fixed_work.txt')
+    subtitles = []
+    with open(task_filename, 'w') as task_file:
+        for index in range(workload.num_tasks):
+            title = generator.choice(subjects)
+            subtitle = f'{title} item {index}'
+            subtitles.append(subtitle)
+            window_days = generator.randint(1, min(workload.max_window_days, workload.horizon_days))
+            start_date = benchmark_start_date + datetime.timedelta(
+                days=generator.randint(0, workload.horizon_days - window_days))
+            due_date = start_date + datetime.timedelta(days=window_days)
+            if not workload.weekends and due_date.weekday() >= 5:
+                # The parser pulls weekend due dates back to Friday, which can land on the start date
+                due_date += datetime.timedelta(days=7 - due_date.weekday())
+            min_time = generator.choice(workload.min_time_choices)
+            required_minutes = generator.randint(min_time, max(min_time, window_days * 90))
+            task_file.write(f'{title}; {format_minutes(required_minutes)}; {format_date(start_date)}-'
+                            f'{format_date(due_date)}; {format_minutes(min_time)}; {subtitle}\n')
+
+    with open(fixed_filename, 'w') as fixed_file:
+        for weekday in auto_scheduler.weekday_conversion.values():
+            fixed_file.write(f'{weekday};{format_minutes(generator.randint(0, 4 * 60))}\n')
+        # Log some work already done against existing tasks
+        for _ in range(workload.num_tasks // 10):
+            date = benchmark_start_date + datetime.timedelta(days=generator.randint(0, workload.horizon_days))
+            fixed_file.write(f'{format_date(date)};{format_minutes(generator.randint(5, 120))};'
+                             f'{generator.choice(subtitles)}\n')
+    return task_filename, fixed_filename
+
+
+def time_call(function: Callable, repeats: int, setup: Callable = lambda: ()) -> Tuple[float, object]:
+    # Best of several runs, with fresh arguments from setup for each one
+    best_time = None
+    result = None
+    for _ in range(repeats):
+        arguments = setup()
+        start_time = time.perf_counter()
+        result = function(*arguments)
+        elapsed = time.perf_counter() - start_time
+        if best_time is None or elapsed < best_time:
+            best_time = elapsed
+    return best_time, result
+
+
+def run_workload(workload: Workload, repeats: int = 3) -> Dict[str, float]:
+    timings = {}
+    # Progress bars and schedule output are part of the timings but shouldn't reach the terminal
+    with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stdout(io.StringIO()), \
+            contextlib.redirect_stderr(io.StringIO()):
+        task_filename, fixed_filename = generate_workload(workload, directory)
+        fixed_tasks, regular_fixed, one_off_fixed = auto_scheduler.load_fixed_tasks(fixed_filename)
+
+        timings['load_flexi_tasks'], flexi_tasks = time_call(
+            lambda: auto_scheduler.load_flexi_tasks(benchmark_start_date, task_filename, workload.weekends), repeats)
+        timings['remove_fixed_from_flexi'], _ = time_call(
+            lambda tasks: auto_scheduler.remove_fixed_from_flexi(fixed_tasks, tasks), repeats,
+            lambda: (deepcopy(flexi_tasks),))
+        auto_scheduler.remove_fixed_from_flexi(fixed_tasks, flexi_tasks)
+
+        timings['calc_daily_work'], (auto_work_per_day, work_on_days_to_due) = time_call(
+            lambda: auto_scheduler.calc_daily_work(flexi_tasks, regular_fixed, one_off_fixed, workload.weekends),
+            repeats)
+        timings['calc_daily_subjects'], (daily_titles, _) = time_call(
+            lambda: auto_scheduler.calc_daily_subjects(flexi_tasks, auto_work_per_day), repeats)
+        timings['calc_daily_tasks'], daily_subtitles = time_call(
+            lambda: auto_scheduler.calc_daily_tasks(flexi_tasks, daily_titles), repeats)
+        timings['print_results'], _ = time_call(
+            lambda: auto_scheduler.print_results(daily_subtitles, work_on_days_to_due, regular_fixed, one_off_fixed),
+            repeats)
+    return timings
+
+
+def run_benchmarks(names: List[str], repeats: int = 3) -> Dict:
+    results = {}
+    for name in names:
+        print(f'Running {name}', file=sys.stderr)
+        results[name] = run_workload(workloads[name], repeats)
+    return {'version': benchmark_version, 'python': platform.python_version(), 'results': results}
+
+
+def compare_results(current: Dict, baseline: Dict, threshold: float = 0.25,
+                    min_difference: float = 0.005) -> List[str]:
+    # List every stage that got slower than the baseline by more than the threshold
+    regressions = []
+    if baseline.get('version') != current.get('version'):
+        return regressions
+    for name, timings in current['results'].items():
+        for stage, seconds in timings.items():
+            baseline_seconds = baseline['results'].get(name, {}).get(stage)
+            if baseline_seconds is None:
+                continue
+            if seconds > baseline_seconds * (1 + threshold) and seconds - baseline_seconds > min_difference:
+                regressions.append(f'{name} {stage}: {seconds:.4f}s vs {baseline_seconds:.4f}s baseline '
+                                   f'({seconds / baseline_seconds - 1:+.0%})')
+    return regressions
+
+
+def main(arguments: List[str]) -> int:
+    parser = argparse.ArgumentParser(description='Time each stage of the scheduling pipeline on generated workloads')
+    parser.add_argument('workloads', nargs='*', default=default_workloads,
+                        help=f'workloads to run, from {", ".join(workloads)} (default: %(default)s)')
+    parser.add_argument('--repeats', type=int, default=3, help='runs per stage, the fastest is kept')
+    parser.add_argument('--output', default='bench_output.json', help='file to write results to')
+    parser.add_argument('--baseline', default='bench_baseline.json', help='results to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='also store the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=0.25, help='allowed slowdown before failing, as a fraction')
+    options = parser.parse_args(arguments)
+    unknown_workloads = [name for name in options.workloads if name not in workloads]
+    if unknown_workloads:
+        parser.error(f'unknown workloads: {", ".join(unknown_workloads)}')
+
+    results = run_benchmarks(options.workloads, options.repeats)
+    with open(options.output, 'w') as output_file:
+        json.dump(results, output_file, indent=2)
+    for name, timings in results['results'].items():
+        print(name + ': ' + ', '.join(f'{stage} {seconds:.4f}s' for stage, seconds in timings.items()))
+
+    if options.save_baseline:
+        with open(options.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        return 0
+    try:
+        with open(options.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    except FileNotFoundError:
+        print(f'No baseline at {options.baseline}, run with --save-baseline to create one')
+        return 0
+    regressions = compare_results(results, baseline, options.threshold)
+    for regression in regressions:
+        print('Regression: ' + regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
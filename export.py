@@ -0,0 +1,82 @@
+import csv
+import datetime
+import json
+import os
+from typing import Callable, Dict, IO, Iterable, Optional
+
+import auto_scheduler
+from auto_scheduler import ScheduleDay
+
+# The schedule in formats other tools can read. Days are written as they're produced, so nothing holds the whole
+# export in memory. Times are whole minutes throughout
+
+
+def write_jsonl(days: Iterable[ScheduleDay], output: IO[str]) -> None:
+    # One object per day
+    for day in days:
+        output.write(json.dumps({'date': day.date.isoformat(),
+                                 'auto_minutes': auto_scheduler.hours_to_minutes(day.auto_hours),
+                                 'fixed_minutes': auto_scheduler.hours_to_minutes(day.fixed_hours),
+                                 'total_minutes': auto_scheduler.hours_to_minutes(day.total_hours),
+                                 'tasks': [{'subtitle': subtitle, 'minutes': auto_scheduler.hours_to_minutes(hours)}
+                                           for subtitle, hours in day.subtitles.items()]}) + '\n')
+
+
+def write_csv(days: Iterable[ScheduleDay], output: IO[str]) -> None:
+    # One row per task per day
+    writer = csv.writer(output)
+    writer.writerow(['date', 'subtitle', 'minutes'])
+    for day in days:
+        writer.writerows([day.date.isoformat(), subtitle, auto_scheduler.hours_to_minutes(hours)]
+                         for subtitle, hours in day.subtitles.items())
+
+
+def ics_text(text: str) -> str:
+    return text.replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+def ics_line(line: str) -> str:
+    # Lines longer than 75 characters are folded onto continuation lines starting with a space
+    folded = [line[:75]] + [' ' + line[position:position + 74] for position in range(75, len(line), 74)]
+    return '\r\n'.join(folded) + '\r\n'
+
+
+def write_ics(days: Iterable[ScheduleDay], output: IO[str], stamp: Optional[datetime.datetime] = None) -> None:
+    # An all day event per task per day
+    if stamp is None:
+        stamp = datetime.datetime.now(datetime.timezone.utc)
+    stamp_text = stamp.astimezone(datetime.timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    output.write(ics_line('BEGIN:VCALENDAR') + ics_line('VERSION:2.0') +
+                 ics_line('PRODID:-//auto-scheduler//schedule//EN'))
+    for day in days:
+        next_day = day.date + datetime.timedelta(days=1)
+        for index, (subtitle, hours) in enumerate(day.subtitles.items()):
+            output.write(ics_line('BEGIN:VEVENT') +
+                         ics_line(f'UID:{day.date:%Y%m%d}-{index}@auto-scheduler') +
+                         ics_line(f'DTSTAMP:{stamp_text}') +
+                         ics_line(f'DTSTART;VALUE=DATE:{day.date:%Y%m%d}') +
+                         ics_line(f'DTEND;VALUE=DATE:{next_day:%Y%m%d}') +
+                         ics_line(f'SUMMARY:{ics_text(subtitle)} ({auto_scheduler.decimal_to_timestring(hours)})') +
+                         ics_line('END:VEVENT'))
+    output.write(ics_line('END:VCALENDAR'))
+
+
+export_formats: Dict[str, Callable[[Iterable[ScheduleDay], IO[str]], None]] = {
+    '.jsonl': write_jsonl, '.csv': write_csv, '.ics': write_ics}
+
+
+def export_format(filename: str) -> Optional[Callable[[Iterable[ScheduleDay], IO[str]], None]]:
+    return export_formats.get(os.path.splitext(filename)[1].lower())
+
+
+def export_schedule(filename: str, daily_subtitles: Dict[datetime.date, Dict[str, float]],
+                    work_on_days_to_due: Dict[datetime.date, float], weekly_work: Dict[str, float],
+                    single_fixed_work: Dict[datetime.date, float]) -> None:
+    # Write the schedule in the format given by the file's extension, earliest day first
+    writer = export_format(filename)
+    if writer is None:
+        raise ValueError(f'Unknown export format for {filename}, use one of {", ".join(export_formats)}')
+    with open(filename + '.tmp', 'w', newline='') as output:
+        writer(auto_scheduler.schedule_days(daily_subtitles, work_on_days_to_due, weekly_work, single_fixed_work),
+               output)
+    os.replace(filename + '.tmp', filename)
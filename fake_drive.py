@@ -0,0 +1,115 @@
+import datetime
+import email.parser
+import hashlib
+import json
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+# A local stand-in for the parts of the Drive v3 API that sync uses, so syncing can be tested offline
+
+
+class FakeDrive:
+    def __init__(self):
+        self.files: Dict[str, dict] = {}
+        self.requests: List[str] = []
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), self.handler_class())
+        self.thread: Optional[threading.Thread] = None
+
+    @property
+    def api_endpoint(self) -> str:
+        return f'http://127.0.0.1:{self.server.server_address[1]}/'
+
+    def __enter__(self) -> 'FakeDrive':
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def add_file(self, name: str, content: bytes, modified_time: datetime.datetime) -> str:
+        with self.lock:
+            file_id = f'file{len(self.files)}'
+            self.files[file_id] = {'id': file_id, 'name': name, 'content': content,
+                                   'modifiedTime': format_time(modified_time)}
+        return file_id
+
+    def file_named(self, name: str) -> Optional[dict]:
+        return next((file for file in self.files.values() if file['name'] == name), None)
+
+    def metadata(self, file: dict) -> dict:
+        return {'id': file['id'], 'name': file['name'], 'modifiedTime': file['modifiedTime'],
+                'md5Checksum': hashlib.md5(file['content']).hexdigest()}
+
+    def handler_class(self):
+        drive = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args) -> None:
+                pass
+
+            def send_json(self, body: dict) -> None:
+                self.send_bytes(json.dumps(body).encode(), 'application/json')
+
+            def send_bytes(self, body: bytes, content_type: str) -> None:
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def read_upload(self):
+                # Metadata and content of a multipart upload
+                body = self.rfile.read(int(self.headers['Content-Length']))
+                message = email.parser.BytesParser().parsebytes(
+                    b'Content-Type: ' + self.headers['Content-Type'].encode() + b'\r\n\r\n' + body)
+                metadata_part, media_part = message.get_payload()
+                return json.loads(metadata_part.get_payload()), media_part.get_payload(decode=True)
+
+            def route(self) -> List[str]:
+                path = urllib.parse.urlparse(self.path).path
+                with drive.lock:
+                    drive.requests.append(f'{self.command} {path}')
+                return [part for part in path.split('/') if part]
+
+            def do_GET(self) -> None:
+                parts = self.route()
+                if parts == ['drive', 'v3', 'files']:
+                    with drive.lock:
+                        self.send_json({'files': [drive.metadata(file) for file in drive.files.values()]})
+                elif parts[:3] == ['drive', 'v3', 'files'] and len(parts) == 4 and parts[3] in drive.files:
+                    self.send_bytes(drive.files[parts[3]]['content'], 'application/octet-stream')
+                else:
+                    self.send_error(404)
+
+            def do_POST(self) -> None:
+                if self.route() != ['upload', 'drive', 'v3', 'files']:
+                    self.send_error(404)
+                    return
+                metadata, content = self.read_upload()
+                file_id = drive.add_file(metadata['name'], content, datetime.datetime.now(datetime.timezone.utc))
+                self.send_json({'id': file_id})
+
+            def do_PATCH(self) -> None:
+                parts = self.route()
+                if parts[:4] != ['upload', 'drive', 'v3', 'files'] or len(parts) != 5 or parts[4] not in drive.files:
+                    self.send_error(404)
+                    return
+                metadata, content = self.read_upload()
+                with drive.lock:
+                    file = drive.files[parts[4]]
+                    file['content'] = content
+                    file['modifiedTime'] = metadata.get('modifiedTime',
+                                                        format_time(datetime.datetime.now(datetime.timezone.utc)))
+                    self.send_json({'modifiedTime': file['modifiedTime']})
+
+        return Handler
+
+
+def format_time(time: datetime.datetime) -> str:
+    return time.astimezone(datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.') + \
+        f'{time.microsecond // 1000:03d}Z'
@@ -0,0 +1,195 @@
+import datetime
+import itertools
+import pickle
+from dataclasses import dataclass, field, fields
+from typing import Callable, Dict, Iterable, Iterator, Mapping, Optional, Tuple
+
+import auto_scheduler
+import task_snapshot
+from auto_scheduler import StageRecord, TaskTable
+
+state_filename = '.schedule_state'
+
+
+@dataclass
+class ScheduleState:
+    # Inputs of the last run, used to decide what can be reused
+    regular_fixed: Dict[str, float] = field(default_factory=dict)
+    weekends: bool = True
+    today: Optional[datetime.date] = None
+    one_off_fixed: Dict[datetime.date, float] = field(default_factory=dict)
+    tasks: Optional[task_snapshot.TaskColumns] = None
+
+    # Each stage's output, with its record so the stage can be resumed after the tasks it reuses
+    work_record: StageRecord = field(default_factory=StageRecord)
+    auto_work_per_day: Dict[datetime.date, float] = field(default_factory=dict)
+    work_on_days_to_due: Dict[datetime.date, float] = field(default_factory=dict)
+    subject_record: StageRecord = field(default_factory=StageRecord)
+    daily_titles: Optional[auto_scheduler.DailyTitles] = None
+    task_record: StageRecord = field(default_factory=StageRecord)
+    daily_subtitles: Optional[auto_scheduler.DailySubtitles] = None
+
+
+def load_state(filename: str = state_filename) -> Optional[ScheduleState]:
+    try:
+        with open(filename, 'rb') as state_file:
+            state = pickle.load(state_file)
+    except (OSError, EOFError, AttributeError, pickle.UnpicklingError):
+        return None
+    # States saved before a field was added can't be reused
+    if not isinstance(state, ScheduleState) or \
+            any(not hasattr(state, state_field.name) for state_field in fields(ScheduleState)):
+        return None
+    return state
+
+
+def save_state(state: ScheduleState, filename: str = state_filename) -> None:
+    with open(filename, 'wb') as state_file:
+        pickle.dump(state, state_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def task_rows(columns: Optional[task_snapshot.TaskColumns]) -> Iterator[tuple]:
+    # Each task's fields as a plain tuple, read straight from the columns
+    if columns is None:
+        return iter(())
+    subtitle_starts = itertools.chain([0], columns.subtitle_ends)
+    return zip((columns.titles[title_id] for title_id in columns.title_ids),
+               (columns.subtitle_data[start:end] for start, end in zip(subtitle_starts, columns.subtitle_ends)),
+               columns.required_hours, columns.min_times, columns.start_ordinals, columns.due_ordinals,
+               columns.actual_due_ordinals)
+
+
+def common_prefix_length(old_tasks: Iterable[tuple], new_tasks: Iterable[tuple]) -> int:
+    length = 0
+    for old_task, new_task in zip(old_tasks, new_tasks):
+        if old_task != new_task:
+            break
+        length += 1
+    return length
+
+
+def leading_tasks_due_by(tasks: TaskTable, limit: int, cutoff: Optional[datetime.date]) -> int:
+    # Tasks are in due date order, so those due by the cutoff form a prefix
+    if cutoff is None:
+        return limit
+    count = 0
+    while count < limit and tasks.due_ordinals[count] <= cutoff.toordinal():
+        count += 1
+    return count
+
+
+def leading_tasks_complete_before(record: StageRecord, limit: int, cutoff: Optional[datetime.date]) -> int:
+    # Tasks that were finished before the cutoff, up to the first that wasn't. A task's last row is the day it finished
+    count = 0
+    row = 0
+    while count < limit and record.unplaced_minutes[count] <= 0:
+        while row < len(record.task_indices) and record.task_indices[row] == count:
+            row += 1
+        finished = record.ordinals[row - 1] if row > 0 and record.task_indices[row - 1] == count else None
+        if cutoff is not None and finished is not None and finished >= cutoff.toordinal():
+            break
+        count += 1
+    return count
+
+
+def first_changed_date(dates, old: Mapping, new: Mapping) -> Optional[datetime.date]:
+    return min((date for date in dates if old.get(date) != new.get(date)), default=None)
+
+
+def report_stages(tasks: TaskTable, state: ScheduleState, diagnostics: Optional[auto_scheduler.Diagnostics]) -> None:
+    # Every task's warnings, missed time and unassigned hours, reused or not, in the order all_calcs reports them
+    def subtitle(index: int) -> str:
+        return tasks.subtitles[tasks.subtitle_ids[index]]
+
+    subjects = state.subject_record
+    if diagnostics is None:
+        print(''.join(subjects.warnings))
+    else:
+        diagnostics.overdue_tasks += auto_scheduler.find_overdue_tasks(tasks)
+        for index, (unplaced_minutes, warning_str) in enumerate(zip(subjects.unplaced_minutes, subjects.warnings)):
+            if unplaced_minutes > 0:
+                diagnostics.missed_tasks[subtitle(index)] = auto_scheduler.round_hours_to_minute(
+                    diagnostics.missed_tasks.get(subtitle(index), 0) + unplaced_minutes / 60)
+            if warning_str:
+                diagnostics.warnings.append(warning_str.rstrip('\n'))
+        diagnostics.missed_time += sum(unplaced_minutes / 60 for unplaced_minutes in subjects.unplaced_minutes)
+    for index, unplaced_minutes in enumerate(state.task_record.unplaced_minutes):
+        if unplaced_minutes > 0:
+            auto_scheduler.report_unassigned_hours(subtitle(index), unplaced_minutes / 60, diagnostics)
+
+
+def reschedule(state: Optional[ScheduleState], flexi_tasks: Iterable[auto_scheduler.Task],
+               regular_fixed: Dict[str, float], one_off_fixed: Dict[datetime.date, float], weekends: bool,
+               diagnostics: Optional[auto_scheduler.Diagnostics] = None,
+               progress: Callable[[Iterable, str], Iterable] = auto_scheduler.no_progress) -> ScheduleState:
+    # Rerun each stage from the first task affected by changes since the state was saved, resuming it from its record
+    # of the tasks before. A stage with nothing to rerun keeps its saved output. The saved state's records are taken
+    # over by the new state
+    today = datetime.datetime.now().date()
+    if state is None or state.regular_fixed != regular_fixed or state.weekends != weekends or state.today != today:
+        state = ScheduleState(regular_fixed=regular_fixed, weekends=weekends, today=today)
+    tasks = flexi_tasks if isinstance(flexi_tasks, TaskTable) else TaskTable(flexi_tasks)
+    new = ScheduleState(regular_fixed=dict(regular_fixed), weekends=weekends, today=today,
+                        one_off_fixed=dict(one_off_fixed), tasks=tasks.columns(),
+                        work_record=state.work_record, subject_record=state.subject_record,
+                        task_record=state.task_record)
+    # The stages report to a scratch set of diagnostics, as only the tasks they rerun are reported there
+    stage_diagnostics = auto_scheduler.Diagnostics()
+
+    # Tasks before the first edit, and due before any changed fixed work, keep their daily work
+    work_prefix = common_prefix_length(task_rows(state.tasks), task_rows(new.tasks))
+    work_prefix = leading_tasks_due_by(tasks, work_prefix,
+                                       first_changed_date(set(state.one_off_fixed) | set(one_off_fixed),
+                                                          state.one_off_fixed, one_off_fixed))
+    if work_prefix == len(tasks) == len(new.work_record.unplaced_minutes):
+        new.auto_work_per_day, new.work_on_days_to_due = state.auto_work_per_day, state.work_on_days_to_due
+        first_changed_work = None
+    else:
+        new.auto_work_per_day, new.work_on_days_to_due = auto_scheduler.calc_daily_work(
+            tasks, regular_fixed, one_off_fixed, weekends, progress, record=new.work_record,
+            start=work_prefix)
+        first_changed_work = first_changed_date(set(state.auto_work_per_day) | set(new.auto_work_per_day),
+                                                state.auto_work_per_day, new.auto_work_per_day)
+
+    # Tasks due before the first day with different auto work took the same minutes from it as before
+    subject_prefix = leading_tasks_due_by(tasks, work_prefix, first_changed_work)
+    if subject_prefix == len(tasks) == len(new.subject_record.unplaced_minutes) and \
+            state.daily_titles is not None:
+        new.daily_titles = state.daily_titles
+        first_changed_titles = None
+    else:
+        new.daily_titles, _ = auto_scheduler.calc_daily_subjects(tasks, new.auto_work_per_day, progress,
+                                                                 stage_diagnostics,
+                                                                 record=new.subject_record,
+                                                                 start=subject_prefix)
+        first_changed_titles = first_changed_date(set(state.daily_titles or {}) | set(new.daily_titles),
+                                                  state.daily_titles or {}, new.daily_titles)
+
+    # Tasks that were finished before the first day with different titles took the same minutes as before
+    task_prefix = leading_tasks_complete_before(new.task_record, subject_prefix, first_changed_titles)
+    if task_prefix == len(tasks) == len(new.task_record.unplaced_minutes) and \
+            state.daily_subtitles is not None:
+        new.daily_subtitles = state.daily_subtitles
+    else:
+        new.daily_subtitles = auto_scheduler.calc_daily_tasks(tasks, new.daily_titles, progress, stage_diagnostics,
+                                                              record=new.task_record, start=task_prefix)
+
+    report_stages(tasks, new, diagnostics)
+    return new
+
+
+def schedule_results(state: ScheduleState) -> Tuple[auto_scheduler.DailySubtitles, Dict[datetime.date, float]]:
+    return state.daily_subtitles, state.work_on_days_to_due
+
+
+def incremental_calcs(flexi_tasks: Iterable[auto_scheduler.Task], regular_fixed: Dict[str, float],
+                      one_off_fixed: Dict[datetime.date, float], weekends: bool,
+                      filename: str = state_filename,
+                      diagnostics: Optional[auto_scheduler.Diagnostics] = None,
+                      progress: Callable[[Iterable, str], Iterable] = auto_scheduler.no_progress) -> \
+        Tuple[auto_scheduler.DailySubtitles, Dict[datetime.date, float]]:
+    # Same results as auto_scheduler.all_calcs, reusing whatever the last run's saved state allows
+    state = reschedule(load_state(filename), flexi_tasks, regular_fixed, one_off_fixed, weekends, diagnostics,
+                       progress)
+    save_state(state, filename)
+    return schedule_results(state)
@@ -0,0 +1,88 @@
+import functools
+import json
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+# Opt-in counters and timings for the scheduling stages. Nothing is recorded unless a profile is active, and the
+# engine only checks for one once per task or stage call, never inside its inner loops.
+
+
+class Profile:
+    def __init__(self, slowest_tasks: int = 20):
+        self.counters: Dict[str, int] = {}
+        self.stage_seconds: Dict[str, float] = {}
+        self.stage_calls: Dict[str, int] = {}
+        self.task_records: List[dict] = []
+        self.current_task: Optional[dict] = None
+        self.slowest_tasks = slowest_tasks
+
+    def count(self, name: str, amount: int = 1) -> None:
+        # Counts go to the run totals and to whichever task is being worked on
+        self.counters[name] = self.counters.get(name, 0) + amount
+        if self.current_task is not None:
+            task_counters = self.current_task['counters']
+            task_counters[name] = task_counters.get(name, 0) + amount
+
+    @contextmanager
+    def stage(self, name: str):
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stage_seconds[name] = self.stage_seconds.get(name, 0) + time.perf_counter() - start_time
+            self.stage_calls[name] = self.stage_calls.get(name, 0) + 1
+
+    def begin_task(self, stage: str, index: int, task) -> None:
+        self.current_task = {'stage': stage, 'index': index, 'title': task.title, 'subtitle': task.subtitle,
+                             'counters': {}, 'start_time': time.perf_counter()}
+
+    def end_task(self) -> None:
+        record = self.current_task
+        record['seconds'] = time.perf_counter() - record.pop('start_time')
+        self.task_records.append(record)
+        self.current_task = None
+
+    def report(self) -> dict:
+        # Totals for the run, plus the tasks that took longest in each stage with their own counters
+        stage_tasks: Dict[str, List[dict]] = {}
+        for record in self.task_records:
+            stage_tasks.setdefault(record['stage'], []).append(record)
+        slowest = {stage: [{key: value for key, value in record.items() if key != 'stage'}
+                           for record in sorted(records, key=lambda record: record['seconds'],
+                                                reverse=True)[:self.slowest_tasks]]
+                   for stage, records in stage_tasks.items()}
+        return {'stage_seconds': self.stage_seconds, 'stage_calls': self.stage_calls, 'counters': self.counters,
+                'slowest_tasks': slowest}
+
+
+active: Optional[Profile] = None
+
+
+def start(slowest_tasks: int = 20) -> Profile:
+    global active
+    active = Profile(slowest_tasks)
+    return active
+
+
+def stop() -> Optional[Profile]:
+    global active
+    profile, active = active, None
+    return profile
+
+
+def timed(function):
+    # Record the wall time of every call to a stage function under its name while a profile is active
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if active is None:
+            return function(*args, **kwargs)
+        with active.stage(function.__name__):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def write_report(profile: Profile, filename: str) -> None:
+    with open(filename, 'w') as report_file:
+        json.dump(profile.report(), report_file, indent=2)
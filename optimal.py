@@ -0,0 +1,154 @@
+import datetime
+import heapq
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+import auto_scheduler
+from auto_scheduler import Task
+
+# An exact alternative to the three scheduling stages, giving the smallest possible peak of fixed plus flexible work on
+# any day. The peak is binary searched, and each candidate is checked with a max-flow from the tasks, through the days
+# in their windows, to the days' room under the peak. Every window is a run of consecutive days, skipping weekends when
+# they're excluded, so the network is convex and assigning each day's room to the tasks due soonest finds its maximum
+# flow exactly. Each check is O((T + D) log T) for T tasks over D days, so the whole solve is polynomial, with no
+# retries. Minimum session lengths are not taken into account.
+
+
+@dataclass
+class OptimalSchedule:
+    peak_minutes: int
+    # Minutes of each task on each day, in the same order as the tasks
+    assignments: List[Dict[datetime.date, int]]
+    daily_subtitles: Dict[datetime.date, Dict[str, float]]
+    work_on_days_to_due: Dict[datetime.date, float]
+
+
+@dataclass
+class FlowNetwork:
+    required: List[int]
+    # First and last day offset each task can be given work on
+    windows: List[Tuple[int, int]]
+    fixed: List[int]
+    # Days any task's window can include. Others are only used by tasks falling back to the day before they're due
+    open_days: bytearray
+    # Tasks in order of their first day, leaving out those pinned to a closed day
+    release_order: List[int]
+    pinned: Dict[int, List[int]]
+    # Most fixed minutes on any day a task can use, which no schedule can go below
+    fixed_peak: int
+
+
+def build_network(tasks: List[Task], calendar: auto_scheduler.FixedCalendar, weekends: bool) -> FlowNetwork:
+    horizon_start = datetime.date.fromordinal(calendar.start_ordinal)
+    num_days = len(calendar.hours)
+    open_days = bytearray(1 if weekends or (horizon_start + datetime.timedelta(days=x)).weekday() < 5 else 0
+                          for x in range(num_days))
+    required = []
+    windows = []
+    pinned: Dict[int, List[int]] = {}
+    for index, task in enumerate(tasks):
+        available_days = auto_scheduler.get_available_days(task, weekends)
+        first = available_days[0].toordinal() - calendar.start_ordinal
+        last = available_days[-1].toordinal() - calendar.start_ordinal
+        required.append(max(0, auto_scheduler.hours_to_minutes(task.required_hours)))
+        windows.append((first, last))
+        if not open_days[first]:
+            pinned.setdefault(first, []).append(index)
+    release_order = sorted((index for index in range(len(tasks)) if open_days[windows[index][0]]),
+                           key=lambda index: windows[index][0])
+
+    fixed = list(calendar.minutes())
+    # Count the windows covering each day from where they start and end
+    window_changes = [0] * (num_days + 1)
+    for first, last in windows:
+        window_changes[first] += 1
+        window_changes[last + 1] -= 1
+    fixed_peak = 0
+    covering = 0
+    for day in range(num_days):
+        covering += window_changes[day]
+        if covering > 0 and (open_days[day] or day in pinned):
+            fixed_peak = max(fixed_peak, fixed[day])
+    return FlowNetwork(required, windows, fixed, open_days, release_order, pinned, fixed_peak)
+
+
+def assign_under_peak(network: FlowNetwork, peak: int, assignments: Optional[List[Dict[int, int]]] = None) -> bool:
+    # Whether every task fits with no day over the peak, filling the assignments if given. Each day's room goes to the
+    # tasks that can use it with the earliest last day, which gives the maximum flow for windows of consecutive days
+    remaining = list(network.required)
+    due_heap: List[Tuple[int, int]] = []
+    position = 0
+    for day in range(len(network.fixed)):
+        room = max(0, peak - network.fixed[day])
+        if not network.open_days[day]:
+            for index in network.pinned.get(day, []):
+                minutes = min(room, remaining[index])
+                room -= minutes
+                remaining[index] -= minutes
+                if assignments is not None and minutes > 0:
+                    assignments[index][day] = minutes
+                if remaining[index] > 0:
+                    return False
+            continue
+
+        while position < len(network.release_order) and network.windows[network.release_order[position]][0] <= day:
+            index = network.release_order[position]
+            if remaining[index] > 0:
+                heapq.heappush(due_heap, (network.windows[index][1], index))
+            position += 1
+        while room > 0 and len(due_heap) > 0:
+            _, index = due_heap[0]
+            minutes = min(room, remaining[index])
+            room -= minutes
+            remaining[index] -= minutes
+            if assignments is not None:
+                assignments[index][day] = minutes
+            if remaining[index] <= 0:
+                heapq.heappop(due_heap)
+        if len(due_heap) > 0 and due_heap[0][0] <= day:
+            # Work is left on a task's last day, so nothing can fit under this peak
+            return False
+    return len(due_heap) <= 0
+
+
+def minimum_peak(network: FlowNetwork) -> int:
+    # The feasible peaks are every value from the smallest one up, so binary search for it
+    low = network.fixed_peak
+    high = max(network.fixed, default=0) + sum(network.required)
+    while low < high:
+        middle = (low + high) // 2
+        if assign_under_peak(network, middle):
+            high = middle
+        else:
+            low = middle + 1
+    return low
+
+
+def solve(tasks: List[Task], regular_fixed: Dict[str, float], one_off_fixed: Dict[datetime.date, float],
+          weekends: bool = True) -> OptimalSchedule:
+    # Assign every task's minutes to days directly, in place of calc_daily_work, calc_daily_subjects and
+    # calc_daily_tasks
+    calendar = auto_scheduler.FixedCalendar.for_tasks(tasks, regular_fixed, one_off_fixed)
+    network = build_network(tasks, calendar, weekends)
+    peak = minimum_peak(network)
+    day_assignments: List[Dict[int, int]] = [{} for _ in tasks]
+    assign_under_peak(network, peak, day_assignments)
+
+    horizon_start = datetime.date.fromordinal(calendar.start_ordinal)
+    assignments = [{horizon_start + datetime.timedelta(days=day): minutes for day, minutes in sorted(days.items())}
+                   for days in day_assignments]
+    daily_subtitles: Dict[datetime.date, Dict[str, float]] = {}
+    auto_minutes: Dict[datetime.date, int] = {}
+    for task, assignment, required_minutes in zip(tasks, assignments, network.required):
+        for date, minutes in assignment.items():
+            required_minutes -= minutes
+            label = auto_scheduler.subtitle_label(task, date, required_minutes <= 0)
+            day_subtitles = daily_subtitles.setdefault(date, {})
+            day_subtitles[label] = day_subtitles.get(label, 0) + minutes / 60
+            auto_minutes[date] = auto_minutes.get(date, 0) + minutes
+
+    work_on_days_to_due = {}
+    for task in tasks:
+        for date in auto_scheduler.get_available_days(task, weekends):
+            work_on_days_to_due[date] = calendar.work_on_day(date) + auto_minutes.get(date, 0) / 60
+    return OptimalSchedule(peak, assignments, daily_subtitles, work_on_days_to_due)
@@ -0,0 +1,79 @@
+import datetime
+import hashlib
+import os
+import pickle
+from typing import Any, Optional
+
+# Bump when the cached data changes shape; edits to the engine files invalidate entries on their own
+cache_version = 2
+# Every module the cached schedules depend on, including how the inputs are parsed and the key is made
+engine_files = ['auto_scheduler.py', 'incremental.py', 'task_snapshot.py', 'allocation_events.py',
+                'instrumentation.py', 'optimal.py', 'schedule_cache.py']
+
+cache_dir = '.schedule_cache'
+max_cache_bytes = 64 * 1024 * 1024
+
+
+def engine_digest() -> str:
+    # Hash the scheduling code so results computed by an older algorithm are never reused
+    digest = hashlib.sha256(str(cache_version).encode())
+    source_dir = os.path.dirname(os.path.abspath(__file__))
+    for filename in engine_files:
+        try:
+            with open(os.path.join(source_dir, filename), 'rb') as source_file:
+                digest.update(source_file.read())
+        except FileNotFoundError:
+            digest.update(filename.encode())
+    return digest.hexdigest()
+
+
+def cache_key(start_date: datetime.date, weekends: bool, task_filename: str = 'one-off_tasks',
+              fixed_filename: str = 'day_fixed_work.txt') -> str:
+    digest = hashlib.sha256(engine_digest().encode())
+    for filename in [task_filename, fixed_filename]:
+        with open(filename, 'rb') as input_file:
+            file_contents = input_file.read()
+        digest.update(len(file_contents).to_bytes(8, 'little'))
+        digest.update(file_contents)
+    # Due date labels depend on the current day as well as the start date
+    digest.update(f'{start_date.isoformat()};{datetime.date.today().isoformat()};{weekends}'.encode())
+    return digest.hexdigest()
+
+
+def load_schedule(key: str, directory: str = cache_dir) -> Optional[Any]:
+    entry_path = os.path.join(directory, key)
+    try:
+        with open(entry_path, 'rb') as entry_file:
+            version, schedule = pickle.load(entry_file)
+    except (OSError, EOFError, AttributeError, ValueError, pickle.UnpicklingError):
+        return None
+    if version != cache_version:
+        return None
+    # Mark as recently used so eviction keeps it
+    os.utime(entry_path)
+    return schedule
+
+
+def store_schedule(key: str, schedule: Any, directory: str = cache_dir, max_bytes: int = max_cache_bytes) -> None:
+    os.makedirs(directory, exist_ok=True)
+    temp_path = os.path.join(directory, key + '.tmp')
+    with open(temp_path, 'wb') as entry_file:
+        pickle.dump((cache_version, schedule), entry_file, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(temp_path, os.path.join(directory, key))
+    evict_entries(directory, max_bytes)
+
+
+def evict_entries(directory: str = cache_dir, max_bytes: int = max_cache_bytes) -> None:
+    # Remove the least recently used entries until the rest fit in the limit
+    entries = [(entry.path, entry.stat()) for entry in os.scandir(directory)
+               if entry.is_file() and not entry.name.endswith('.tmp')]
+    entries.sort(key=lambda entry: entry[1].st_mtime_ns, reverse=True)
+    total_bytes = 0
+    for path, stat in entries:
+        total_bytes += stat.st_size
+        if total_bytes <= max_bytes:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -3,31 +3,175 @@ from __future__ import print_function
 import os.path
 import os
 import datetime
+import socket
+import functools
+import hashlib
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import timezone
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
-from google_auth_oauthlib.flow import InstalledAppFlow, Flow
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google.auth.exceptions import RefreshError
-from httplib2.error import ServerNotFoundError
+from typing import Dict, List, Optional
+
+# The Google client libraries are slow to import, so they're only imported once a sync is actually going to happen
 
 # If modifying these scopes, delete the file token.json.
 SCOPES = ['https://www.googleapis.com/auth/drive.appdata']
 
-def safe_sync():
+# Files kept in the Drive app data folder, with the name used for them in messages
+synced_files = {'one-off_tasks': 'task list', 'day_fixed_work.txt': 'fixed work list'}
+drive_time_format = '%Y-%m-%dT%H:%M:%S.%fZ'
+
+# Content digest of each file as of its last sync, with the local stat it was taken from. It's rewritten after every
+# successful sync, so its modification time is when the last one finished
+manifest_filename = '.sync_manifest.json'
+default_ttl_minutes = 10
+
+# While offline, when to next try the network and which files have local changes waiting to be uploaded
+journal_filename = '.sync_journal.json'
+max_retry_minutes = 60
+default_timeout = 5.0
+
+
+def locally_changed(filename: str, manifest: Dict[str, dict]) -> bool:
+    # Whether the file has been written since the manifest entry was made, going by its stat alone
+    entry = manifest.get(filename)
+    try:
+        local_stat = os.stat(filename)
+    except FileNotFoundError:
+        return entry is not None
+    return entry is None or entry.get('mtime_ns') != local_stat.st_mtime_ns or entry.get('size') != local_stat.st_size
+
+
+def sync_is_fresh(ttl_minutes: float, manifest_file: str = manifest_filename) -> bool:
+    # Whether the last sync was recent enough to skip, provided no synced file has been written since
+    try:
+        synced_at = os.path.getmtime(manifest_file)
+    except OSError:
+        return False
+    if time.time() - synced_at >= ttl_minutes * 60:
+        return False
+    manifest = load_manifest(manifest_file)
+    return not any(locally_changed(filename, manifest) for filename in synced_files)
+
+
+def pending_files(manifest_file: str = manifest_filename) -> List[str]:
+    manifest = load_manifest(manifest_file)
+    return [filename for filename in synced_files if locally_changed(filename, manifest)]
+
+
+def record_offline(journal: dict, manifest_file: str = manifest_filename, journal_file: str = journal_filename) -> dict:
+    # Back off exponentially so repeated offline runs don't each wait for the connection to time out
+    failures = journal.get('failures', 0) + 1
+    journal = {'failures': failures, 'offline_since': journal.get('offline_since', time.time()),
+               'retry_after': time.time() + min(2 ** (failures - 1), max_retry_minutes) * 60,
+               'pending': pending_files(manifest_file)}
+    save_manifest(journal, journal_file)
+    return journal
+
+
+class DownloadGate:
+    # Lets downloads replace the local files until they're about to be read, after which they're left for the next
+    # sync so the files never change while the schedule is made from them
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.closed = False
+        self.held_back = False
+
+    def replace(self, temp_filename: str, filename: str) -> bool:
+        with self.lock:
+            if self.closed:
+                self.held_back = True
+                return False
+            os.replace(temp_filename, filename)
+            return True
+
+    def close(self) -> None:
+        with self.lock:
+            self.closed = True
+
+
+def safe_sync(ttl_minutes: float = 0, timeout: Optional[float] = default_timeout, interactive: bool = True,
+              api_endpoint: Optional[str] = None, creds=None, manifest_file: str = manifest_filename,
+              journal_file: str = journal_filename, gate: Optional[DownloadGate] = None) -> bool:
+    # Sync without ever raising for connection problems, returning whether a sync completed. While offline, local
+    # changes are journalled and sent in one batch once a retry gets through. Anything else, like missing credentials
+    # or an unwritable file, is raised
+    if ttl_minutes > 0 and sync_is_fresh(ttl_minutes, manifest_file):
+        print('Synced less than {} minutes ago, skipping'.format(ttl_minutes))
+        return True
+
+    journal = load_manifest(journal_file)
+    if time.time() < journal.get('retry_after', 0):
+        journal['pending'] = pending_files(manifest_file)
+        save_manifest(journal, journal_file)
+        print('Offline, not retrying sync until {:%H:%M} ({} file(s) waiting to upload)'.format(
+            datetime.datetime.fromtimestamp(journal['retry_after']), len(journal['pending'])))
+        return False
+
+    from google.auth.exceptions import RefreshError, TransportError
+    from httplib2.error import HttpLib2Error
     try:
-        update()
-    except RefreshError:
-        os.remove('token.json')
         try:
-            update()
-        except ServerNotFoundError:
-            print('No connection to sync server') 
-    except ServerNotFoundError:
-        print('No connection to sync server') 
+            update(creds, api_endpoint, manifest_file, timeout, gate)
+        except RefreshError:
+            os.remove('token.json')
+            if not interactive:
+                print('Google Drive sign-in has expired, it will be asked for on the next interactive run')
+                return False
+            update(creds, api_endpoint, manifest_file, timeout, gate)
+    except (HttpLib2Error, TransportError, ConnectionError, TimeoutError, socket.gaierror):
+        journal = record_offline(journal, manifest_file, journal_file)
+        print('No connection to sync server, retrying after {:%H:%M}'.format(
+            datetime.datetime.fromtimestamp(journal['retry_after'])))
+        return False
+
+    if journal:
+        if journal.get('pending'):
+            print('Synced {} file(s) changed while offline'.format(len(journal['pending'])))
+        os.remove(journal_file)
+    return True
+
+
+class BackgroundSync:
+    # A sync running on its own thread, so scheduling can go ahead from local files if the network is slow
+    def __init__(self, ttl_minutes: float = 0, timeout: float = default_timeout, **kwargs):
+        self.deadline = time.monotonic() + timeout
+        self.gate = DownloadGate()
+        self.thread = threading.Thread(target=safe_sync, daemon=True,
+                                       kwargs=dict(kwargs, ttl_minutes=ttl_minutes, timeout=timeout,
+                                                   interactive=False, gate=self.gate))
+        self.thread.start()
+
+    def finish(self, extra_time: float = 0) -> bool:
+        # Wait for whatever is left of the timeout budget, returning whether the sync is done. If it isn't, any
+        # downloads still to come are held back, so the local files can be read from here on
+        self.thread.join(max(0.0, self.deadline + extra_time - time.monotonic()))
+        if self.thread.is_alive():
+            self.gate.close()
+            return False
+        return True
+
+
+def can_sync_in_background(token_file: str = 'token.json') -> bool:
+    # Signing in needs the terminal, so only syncs with saved credentials that are valid, or can be refreshed without
+    # the user, can run in the background
+    if not os.path.exists(token_file):
+        return False
+    from google.oauth2.credentials import Credentials
+
+    try:
+        creds = Credentials.from_authorized_user_file(token_file, SCOPES)
+    except (OSError, ValueError):
+        return False
+    return creds.valid or bool(creds.expired and creds.refresh_token)
+
+
+def get_credentials():
+    from google.auth.transport.requests import Request
+    from google.oauth2.credentials import Credentials
+    from google_auth_oauthlib.flow import Flow
 
-def update():
     creds = None
     # The file token.json stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first
@@ -55,96 +199,154 @@ def update():
         # Save the credentials for the next run
         with open('token.json', 'w') as token:
             token.write(creds.to_json())
+    return creds
 
-    service = build('drive', 'v3', credentials=creds)
 
-    response = service.files().list(spaces='appDataFolder',
-                                    fields='nextPageToken, files(id, name, modifiedTime)',
-                                    pageSize=10).execute()
+@functools.lru_cache(maxsize=None)
+def discovery_document(api_endpoint: Optional[str] = None) -> str:
+    # The Drive discovery document bundled with googleapiclient, so building a service never fetches it
+    from googleapiclient.discovery_cache import get_static_doc
+
+    document = json.loads(get_static_doc('drive', 'v3'))
+    if api_endpoint is not None:
+        # Uploads are addressed from the root URL, so it has to move along with the base URL
+        document['rootUrl'] = api_endpoint
+        document['baseUrl'] = api_endpoint + document['servicePath']
+    return json.dumps(document)
+
+
+def build_service(creds, api_endpoint: Optional[str] = None, timeout: Optional[float] = None):
+    # Each thread needs its own service, as httplib2 connections can't be shared between threads
+    import httplib2
+    from google_auth_httplib2 import AuthorizedHttp
+    from googleapiclient.discovery import build_from_document
 
+    return build_from_document(discovery_document(api_endpoint),
+                               http=AuthorizedHttp(creds, http=httplib2.Http(timeout=timeout)))
+
+
+def load_manifest(filename: str = manifest_filename) -> Dict[str, dict]:
     try:
-        task_local_modified = datetime.datetime.fromtimestamp(os.path.getmtime('one-off_tasks'), tz=timezone.utc)
-    except FileNotFoundError:
-        task_local_modified = datetime.datetime.fromtimestamp(0, tz=timezone.utc)
+        with open(filename) as manifest_file:
+            return json.load(manifest_file)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_manifest(manifest: Dict[str, dict], filename: str = manifest_filename) -> None:
+    with open(filename + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(filename + '.tmp', filename)
+
+
+def local_entry(filename: str, previous_entry: Optional[dict]) -> Optional[dict]:
+    # Digest of the local file, only rehashed if it has been written since the manifest entry was made
     try:
-        fixed_local_modified = datetime.datetime.fromtimestamp(os.path.getmtime('day_fixed_work.txt'), tz=timezone.utc)
+        local_stat = os.stat(filename)
     except FileNotFoundError:
-        fixed_local_modified = datetime.datetime.fromtimestamp(0, tz=timezone.utc)
-
-    tasks_exist = False
-    fixed_exist = False
-    task_drive_modified, task_id, fixed_drive_modified, fixed_id = None, None, None, None
-    for file in response.get('files', []):
-        if file.get('name') == 'one-off_tasks':
-            tasks_exist = True
-            task_id = file.get('id')
-            task_drive_modified = datetime.datetime.strptime(file.get('modifiedTime'),
-                                                             '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=timezone.utc)
-        elif file.get('name') == 'day_fixed_work.txt':
-            fixed_exist = True
-            fixed_id = file.get('id')
-            fixed_drive_modified = datetime.datetime.strptime(file.get('modifiedTime'),
-                                                              '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=timezone.utc)
-
-    if not tasks_exist:
-        print('Creating flexible task list')
+        return None
+    if previous_entry is not None and previous_entry.get('mtime_ns') == local_stat.st_mtime_ns and \
+            previous_entry.get('size') == local_stat.st_size:
+        return dict(previous_entry)
+    with open(filename, 'rb') as local_file:
+        digest = hashlib.md5(local_file.read()).hexdigest()
+    return {'md5': digest, 'mtime_ns': local_stat.st_mtime_ns, 'size': local_stat.st_size}
+
+
+def sync_file(service, filename: str, label: str, drive_file: Optional[dict],
+              manifest_entry: Optional[dict] = None, gate: Optional[DownloadGate] = None) -> Optional[dict]:
+    # Transfer the file only if its content differs from Drive's, returning its new manifest entry
+    from googleapiclient.http import MediaFileUpload
+
+    local = local_entry(filename, manifest_entry)
+    if local is None and drive_file is None:
+        return None
+
+    if drive_file is None:
+        print('Creating ' + label)
         file_metadata = {
-            'name': 'one-off_tasks',
+            'name': filename,
             'parents': ['appDataFolder']
         }
-        media = MediaFileUpload('one-off_tasks',
-                                resumable=True)
-        file = service.files().create(body=file_metadata,
-                                      media_body=media,
-                                      fields='id').execute()
-    elif task_local_modified - task_drive_modified > datetime.timedelta(seconds=1):
-        print('Uploading modified task list')
-        media = MediaFileUpload('one-off_tasks',
-                                resumable=True)
-        metadata = {'modifiedTime': task_local_modified.strftime('%Y-%m-%dT%H:%M:%S.%fZ')}
-        service.files().update(
-            fileId=task_id,
-            body=metadata,
-            media_body=media,
-            fields='modifiedTime').execute()
-    elif task_local_modified - task_drive_modified < datetime.timedelta(seconds=-1):
-        print('Downloading task list')
-        downloaded_file = service.files().get_media(fileId=task_id).execute()
-        with open("one-off_tasks", "wb") as out_file:
-            out_file.write(downloaded_file)
-        os.utime('one-off_tasks', (task_drive_modified.timestamp(), task_drive_modified.timestamp()))
+        media = MediaFileUpload(filename)
+        service.files().create(body=file_metadata,
+                               media_body=media,
+                               fields='id').execute()
+        return local
+
+    drive_md5 = drive_file.get('md5Checksum')
+    if local is not None and local['md5'] == drive_md5:
+        print('No update required for ' + label)
+        return local
+
+    # Whichever side still matches the last sync is the one that hasn't changed
+    drive_modified = datetime.datetime.strptime(drive_file.get('modifiedTime'),
+                                                drive_time_format).replace(tzinfo=timezone.utc)
+    synced_md5 = manifest_entry.get('md5') if manifest_entry is not None else None
+    if local is None or (synced_md5 is not None and local['md5'] == synced_md5):
+        upload = False
+    elif synced_md5 is not None and drive_md5 == synced_md5:
+        upload = True
     else:
-        print('No update required for task list')
+        # Both changed or there's no record of the last sync, so the newer edit wins
+        upload = datetime.datetime.fromtimestamp(local['mtime_ns'] / 1e9, tz=timezone.utc) > drive_modified
 
-    if not fixed_exist:
-        print('Creating fixed work list')
-        file_metadata = {
-            'name': 'day_fixed_work.txt',
-            'parents': ['appDataFolder']
-        }
-        media = MediaFileUpload('day_fixed_work.txt',
-                                resumable=True)
-        file = service.files().create(body=file_metadata,
-                                      media_body=media,
-                                      fields='id').execute()
-    elif fixed_local_modified - fixed_drive_modified > datetime.timedelta(seconds=1):
-        print('Uploading modified fixed work list')
-        media = MediaFileUpload('day_fixed_work.txt',
-                                resumable=True)
-        metadata = {'modifiedTime': fixed_local_modified.strftime('%Y-%m-%dT%H:%M:%S.%fZ')}
+    if upload:
+        print('Uploading modified ' + label)
+        local_modified = datetime.datetime.fromtimestamp(local['mtime_ns'] / 1e9, tz=timezone.utc)
+        media = MediaFileUpload(filename)
+        metadata = {'modifiedTime': local_modified.strftime(drive_time_format)}
         service.files().update(
-            fileId=fixed_id,
+            fileId=drive_file.get('id'),
             body=metadata,
             media_body=media,
             fields='modifiedTime').execute()
-    elif fixed_local_modified - fixed_drive_modified < datetime.timedelta(seconds=-1):
-        print('Downloading fixed work list')
-        downloaded_file = service.files().get_media(fileId=fixed_id).execute()
-        with open("day_fixed_work.txt", "wb") as out_file:
-            out_file.write(downloaded_file)
-        os.utime('day_fixed_work.txt', (fixed_drive_modified.timestamp(), fixed_drive_modified.timestamp()))
-    else:
-        print('No update required for fixed list')
+        return local
+
+    print('Downloading ' + label)
+    downloaded_file = service.files().get_media(fileId=drive_file.get('id')).execute()
+    # Written in full to one side first, so the file is never seen half written
+    temp_filename = filename + '.tmp'
+    with open(temp_filename, "wb") as out_file:
+        out_file.write(downloaded_file)
+    os.utime(temp_filename, (drive_modified.timestamp(), drive_modified.timestamp()))
+    if gate is None:
+        os.replace(temp_filename, filename)
+    elif not gate.replace(temp_filename, filename):
+        # The last sync's entry is kept, so the next sync downloads it again
+        os.remove(temp_filename)
+        print('Leaving the download of ' + label + ' for the next sync')
+        return manifest_entry
+    return local_entry(filename, None)
+
+
+def update(creds=None, api_endpoint: Optional[str] = None, manifest_file: str = manifest_filename,
+           timeout: Optional[float] = None, gate: Optional[DownloadGate] = None):
+    if creds is None:
+        creds = get_credentials()
+
+    service = build_service(creds, api_endpoint, timeout)
+    response = service.files().list(spaces='appDataFolder',
+                                    fields='nextPageToken, files(id, name, modifiedTime, md5Checksum)',
+                                    pageSize=10).execute()
+    drive_files = {file.get('name'): file for file in response.get('files', [])}
+    manifest = load_manifest(manifest_file)
+
+    # The files are independent, so transfer them at the same time
+    with ThreadPoolExecutor(max_workers=len(synced_files)) as executor:
+        futures = {filename: executor.submit(sync_file, build_service(creds, api_endpoint, timeout), filename, label,
+                                             drive_files.get(filename), manifest.get(filename), gate)
+                   for filename, label in synced_files.items()}
+        for filename, future in futures.items():
+            entry = future.result()
+            if entry is None:
+                manifest.pop(filename, None)
+            else:
+                manifest[filename] = entry
+    # The manifest's modification time is when the last sync finished, so it's left alone if a download is still to
+    # come and the next run syncs again instead of waiting out the TTL
+    if gate is None or not gate.held_back:
+        save_manifest(manifest, manifest_file)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,256 @@
+import datetime
+import mmap
+import os
+import struct
+import sys
+from array import array
+from dataclasses import dataclass
+from typing import Dict, List, MutableSequence, Optional, Tuple
+
+# Binary snapshots of parsed task files, so unchanged files can be loaded without parsing text. Dates are stored as
+# ordinals and strings through an interned string table. Flexi tasks are stored column by column, as the task table
+# holds them, with hours as the parser's own floats. Fixed work times are stored as integer minutes. The lines the
+# parser rejected are kept too, so they're still reported when the snapshot is used. Each snapshot records the digest
+# of the parser that made it and is only read by that same parser.
+snapshot_magic = b'ASNP'
+snapshot_version = 3
+flexi_kind = 1
+fixed_kind = 2
+
+# Magic, version, parser digest, kind, source mtime, source size, start date ordinal, weekends, three section counts and
+# the offset of the string table. The last count is always the number of invalid line messages
+header_struct = struct.Struct('<4sHQBqqi?IIIQ')
+# The flexi task columns in the order they're stored, one value per task, followed by the packed subtitles
+task_column_typecodes = [('title_ids', 'i'), ('subtitle_ends', 'q'), ('required_hours', 'd'), ('min_times', 'd'),
+                         ('start_ordinals', 'i'), ('due_ordinals', 'i'), ('actual_due_ordinals', 'i')]
+# Date ordinal, minutes
+one_off_struct = struct.Struct('<iq')
+# Date ordinal, title id, minutes
+titled_struct = struct.Struct('<iIq')
+weekly_struct = struct.Struct('<7q')
+length_struct = struct.Struct('<I')
+# String id of an invalid line message
+message_struct = struct.Struct('<I')
+
+weekdays = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+
+
+class StringTable:
+    def __init__(self):
+        self.ids: Dict[str, int] = {}
+        self.strings: List[str] = []
+
+    def intern(self, string: str) -> int:
+        if string not in self.ids:
+            self.ids[string] = len(self.strings)
+            self.strings.append(string)
+        return self.ids[string]
+
+    def to_bytes(self) -> bytes:
+        encoded = [string.encode() for string in self.strings]
+        return b''.join(length_struct.pack(len(string)) + string for string in encoded)
+
+
+@dataclass
+class TaskColumns:
+    # A task table's columns: titles in id order, each task's subtitle packed end to end in task order, hours as floats
+    # and dates as ordinals
+    titles: List[str]
+    subtitle_data: bytes
+    subtitle_ends: MutableSequence[int]
+    title_ids: MutableSequence[int]
+    required_hours: MutableSequence[float]
+    min_times: MutableSequence[float]
+    start_ordinals: MutableSequence[int]
+    due_ordinals: MutableSequence[int]
+    actual_due_ordinals: MutableSequence[int]
+
+
+def snapshot_path(filename: str) -> str:
+    directory, basename = os.path.split(filename)
+    return os.path.join(directory, '.' + basename + '.snapshot')
+
+
+def source_signature(filename: str) -> Tuple[int, int]:
+    source_stat = os.stat(filename)
+    return source_stat.st_mtime_ns, source_stat.st_size
+
+
+def rounded_hours(minutes: int) -> float:
+    # Builds the same float as round_hours_to_minute
+    return minutes / 60
+
+
+def exact_minutes(hours: float) -> Optional[int]:
+    # Only values that come back bit for bit can be stored, anything else means the file can't be snapshotted
+    minutes = round(hours * 60)
+    if rounded_hours(minutes) != hours:
+        return None
+    return minutes
+
+
+def column_bytes(values: array) -> bytes:
+    # Columns are stored little endian whatever the machine
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+def unpack_column(view: memoryview, offset: int, typecode: str, count: int) -> array:
+    values = array(typecode)
+    values.frombytes(view[offset:offset + count * values.itemsize])
+    if len(values) != count:
+        raise struct.error('snapshot column cut short')
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def pack_messages(invalid_lines: List[str], strings: StringTable) -> bytes:
+    return b''.join(message_struct.pack(strings.intern(message)) for message in invalid_lines)
+
+
+def unpack_messages(view: memoryview, offset: int, count: int, strings: List[str]) -> List[str]:
+    records = view[offset:offset + count * message_struct.size]
+    return [strings[message] for (message,) in message_struct.iter_unpack(records)]
+
+
+def write_snapshot(filename: str, signature: Tuple[int, int], parser_digest: int, kind: int, start_ordinal: int,
+                   weekends: bool, counts: Tuple[int, int, int], body: bytes, strings: StringTable) -> None:
+    header = header_struct.pack(snapshot_magic, snapshot_version, parser_digest, kind, signature[0], signature[1],
+                                start_ordinal, weekends, counts[0], counts[1], counts[2],
+                                header_struct.size + len(body))
+    path = snapshot_path(filename)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as snapshot_file:
+        snapshot_file.write(header)
+        snapshot_file.write(body)
+        snapshot_file.write(strings.to_bytes())
+    os.replace(temp_path, path)
+
+
+def read_snapshot(filename: str, parser_digest: int, kind: int, start_ordinal: int, weekends: bool, reader):
+    # Map the snapshot and hand it to the reader if it still matches the source file, parser and options
+    try:
+        signature = source_signature(filename)
+        snapshot_file = open(snapshot_path(filename), 'rb')
+    except OSError:
+        return None
+    with snapshot_file:
+        try:
+            buffer = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+        with buffer, memoryview(buffer) as view:
+            try:
+                magic, version, snapshot_parser, snapshot_kind, mtime_ns, size, snapshot_start, snapshot_weekends, \
+                    count_a, count_b, count_c, strings_offset = header_struct.unpack_from(view, 0)
+                if magic != snapshot_magic or version != snapshot_version or snapshot_parser != parser_digest or \
+                        snapshot_kind != kind or (mtime_ns, size) != signature or snapshot_start != start_ordinal or \
+                        snapshot_weekends != weekends:
+                    return None
+                strings = read_strings(view, strings_offset)
+                return reader(view, (count_a, count_b, count_c), strings)
+            except (struct.error, IndexError, UnicodeDecodeError):
+                return None
+
+
+def read_strings(view: memoryview, offset: int) -> List[str]:
+    strings = []
+    while offset < len(view):
+        (length,) = length_struct.unpack_from(view, offset)
+        offset += length_struct.size
+        # Interned so titles match those from the other task file, and parsed ones, by identity
+        strings.append(sys.intern(str(view[offset:offset + length], 'utf-8')))
+        offset += length
+    return strings
+
+
+def date_from_ordinal(ordinal: int, dates: Dict[int, datetime.date]) -> datetime.date:
+    # Share date objects between records instead of building one per field
+    if ordinal not in dates:
+        dates[ordinal] = datetime.date.fromordinal(ordinal)
+    return dates[ordinal]
+
+
+def write_flexi_snapshot(filename: str, signature: Tuple[int, int], parser_digest: int, cur_date: datetime.date,
+                         weekends: bool, columns: TaskColumns, invalid_lines: List[str]) -> None:
+    # Titles take the first ids in the string table, so they come back as the task table's titles
+    strings = StringTable()
+    for title in columns.titles:
+        strings.intern(title)
+    body = bytearray()
+    for name, typecode in task_column_typecodes:
+        body += column_bytes(array(typecode, getattr(columns, name)))
+    body += columns.subtitle_data
+    body += pack_messages(invalid_lines, strings)
+    write_snapshot(filename, signature, parser_digest, flexi_kind, cur_date.toordinal(), weekends,
+                   (len(columns.title_ids), len(columns.titles), len(invalid_lines)), bytes(body), strings)
+
+
+def read_flexi_snapshot(filename: str, parser_digest: int, cur_date: datetime.date,
+                        weekends: bool) -> Optional[Tuple[TaskColumns, List[str]]]:
+    # The task table's columns and the invalid line messages
+    def reader(view: memoryview, counts: Tuple[int, int, int], strings: List[str]) -> Tuple[TaskColumns, List[str]]:
+        offset = header_struct.size
+        columns = {}
+        for name, typecode in task_column_typecodes:
+            columns[name] = unpack_column(view, offset, typecode, counts[0])
+            offset += counts[0] * columns[name].itemsize
+        subtitle_size = columns['subtitle_ends'][-1] if counts[0] > 0 else 0
+        subtitle_data = bytes(view[offset:offset + subtitle_size])
+        offset += subtitle_size
+        return TaskColumns(strings[:counts[1]], subtitle_data, **columns), \
+            unpack_messages(view, offset, counts[2], strings)
+
+    return read_snapshot(filename, parser_digest, flexi_kind, cur_date.toordinal(), weekends, reader)
+
+
+def write_fixed_snapshot(filename: str, signature: Tuple[int, int], parser_digest: int,
+                         tasks: Dict[datetime.date, Dict[str, float]], regular_working: Dict[str, float],
+                         one_off_working: Dict[datetime.date, float], invalid_lines: List[str]) -> bool:
+    strings = StringTable()
+    weekly_minutes = [exact_minutes(regular_working[weekday]) for weekday in weekdays]
+    one_off_minutes = [(date.toordinal(), exact_minutes(hours)) for date, hours in one_off_working.items()]
+    titled_minutes = [(date.toordinal(), strings.intern(title), exact_minutes(hours))
+                      for date in tasks for title, hours in tasks[date].items()]
+    if None in weekly_minutes or any(minutes is None for _, minutes in one_off_minutes) or \
+            any(minutes is None for _, _, minutes in titled_minutes):
+        return False
+    try:
+        body = weekly_struct.pack(*weekly_minutes) + \
+            b''.join(one_off_struct.pack(*record) for record in one_off_minutes) + \
+            b''.join(titled_struct.pack(*record) for record in titled_minutes) + \
+            pack_messages(invalid_lines, strings)
+    except struct.error:
+        # Times too big even for 64 bits of minutes are left to the text parser
+        return False
+    write_snapshot(filename, signature, parser_digest, fixed_kind, 0, False,
+                   (len(one_off_minutes), len(titled_minutes), len(invalid_lines)), body, strings)
+    return True
+
+
+def read_fixed_snapshot(filename: str, parser_digest: int) -> Optional[Tuple[Tuple[
+        Dict[datetime.date, Dict[str, float]], Dict[str, float], Dict[datetime.date, float]], List[str]]]:
+    # The fixed work and the invalid line messages
+    def reader(view: memoryview, counts: Tuple[int, int, int], strings: List[str]):
+        dates: Dict[int, datetime.date] = {}
+        offset = header_struct.size
+        regular_working = {weekday: rounded_hours(minutes)
+                           for weekday, minutes in zip(weekdays, weekly_struct.unpack_from(view, offset))}
+        offset += weekly_struct.size
+        one_off_records = view[offset:offset + counts[0] * one_off_struct.size]
+        one_off_working = {date_from_ordinal(ordinal, dates): rounded_hours(minutes)
+                           for ordinal, minutes in one_off_struct.iter_unpack(one_off_records)}
+        offset += counts[0] * one_off_struct.size
+        tasks: Dict[datetime.date, Dict[str, float]] = {}
+        for ordinal, title, minutes in titled_struct.iter_unpack(view[offset:offset + counts[1] * titled_struct.size]):
+            date = date_from_ordinal(ordinal, dates)
+            if date not in tasks:
+                tasks[date] = {}
+            tasks[date][strings[title]] = rounded_hours(minutes)
+        offset += counts[1] * titled_struct.size
+        return (tasks, regular_working, one_off_working), unpack_messages(view, offset, counts[2], strings)
+
+    return read_snapshot(filename, parser_digest, fixed_kind, 0, False, reader)
@@ -1,13 +1,33 @@
+import csv
 import datetime
+import json
 import math
+import os
+import shutil
+import subprocess
 import sys
+import threading
+import time
 from io import StringIO
+from dataclasses import FrozenInstanceError, replace
 from math import ceil
 from typing import List, Dict
 
 from hypothesis import example, assume, settings, Verbosity, given, note, strategies as st
 
+import allocation_events
 import auto_scheduler
+import batch
+import benchmark
+import export
+import fake_drive
+import incremental
+import instrumentation
+import optimal
+import plot_auto_scheduler
+import schedule_cache
+import sync
+import watch
 from auto_scheduler import Task, DateOrderError
 
 shared_due_date = st.shared(st.dates(min_value=datetime.date(2021, 1, 2), max_value=datetime.date(2025, 12, 31)))
@@ -89,6 +109,114 @@ def test_getting_work(requested_day, weekly_work, single_fixed_work):
     assert auto_scheduler.get_work_on_day(requested_day, weekly_work, single_fixed_work) == answer
 
 
+@given(safe_dates, st.integers(min_value=0, max_value=60), st.fixed_dictionaries(weekly_mapping),
+       st.dictionaries(safe_dates, sensible_times))
+def test_fixed_calendar_matches_work_on_day(start_date, num_days, weekly_work, single_fixed_work):
+    end_date = start_date + datetime.timedelta(days=num_days)
+    calendar = auto_scheduler.FixedCalendar(weekly_work, single_fixed_work, start_date, end_date)
+    # Days past either end of the horizon are worked out directly
+    for offset in range(-8, num_days + 8):
+        date = start_date + datetime.timedelta(days=offset)
+        assert calendar.work_on_day(date) == auto_scheduler.get_work_on_day(date, weekly_work, single_fixed_work)
+
+
+def test_parsers_report_line_numbers():
+    cur_date = datetime.date(2021, 1, 4)
+    lines = ['# Comment\n', '\n', 'Maths; 2:30; 1/2/21; 0:30; Assignment\n', 'broken line\n', 'Physics; 1; 5/1/21\n']
+    records = list(auto_scheduler.parse_flexi_tasks(lines, cur_date))
+    assert [record.line_number for record in records] == [3, 5]
+    assert records[0].task == Task('Maths', 'Assignment', 2.5, 0.5, cur_date, datetime.date(2021, 2, 1),
+                                   datetime.date(2021, 2, 1))
+
+    try:
+        list(auto_scheduler.parse_flexi_tasks(lines + ['Late; 1; 10/1/21-6/1/21\n'], cur_date))
+    except DateOrderError as e:
+        assert e.line_number == 6
+    else:
+        assert False
+
+    fixed_records = list(auto_scheduler.parse_fixed_tasks(['Monday;1\n', '# Comment\n', '4/1/21;0:45;Maths\n']))
+    assert [(record.line_number, record.weekday, record.date, record.title) for record in fixed_records] == \
+           [(1, 'Monday', None, None), (3, None, datetime.date(2021, 1, 4), 'Maths')]
+    assert auto_scheduler.date_string_to_datetime.cache_info().maxsize == auto_scheduler.parser_cache_size
+    assert auto_scheduler.timestring_to_decimal.cache_info().maxsize == auto_scheduler.parser_cache_size
+
+
+def test_snapshot_matches_text_parse(tmp_path):
+    cur_date = datetime.date(2021, 1, 4)
+    task_file = tmp_path / 'one-off_tasks'
+    fixed_file = tmp_path / 'day_fixed_work.txt'
+    task_file.write_text('Maths; 2:13; 1/2/21; 0:20; Assignment\nbroken line\nPhysics; 1:07; 6/1/21-5/3/21\n')
+    fixed_file.write_text('Monday;1:20\nMonday;0:20\nBlursday;1\n4/1/21;0:45;Assignment\n')
+
+    parsed_diagnostics = auto_scheduler.Diagnostics()
+    snapshot_diagnostics = auto_scheduler.Diagnostics()
+    parsed_tasks = auto_scheduler.load_flexi_tasks(cur_date, str(task_file), use_snapshot=True,
+                                                   diagnostics=parsed_diagnostics)
+    snapshot_tasks = auto_scheduler.load_flexi_tasks(cur_date, str(task_file), use_snapshot=True,
+                                                     diagnostics=snapshot_diagnostics)
+    assert (tmp_path / '.one-off_tasks.snapshot').exists()
+    assert snapshot_tasks == parsed_tasks
+    # Invalid lines are still reported when the snapshot is used
+    assert len(parsed_diagnostics.invalid_lines) == 1
+    assert snapshot_diagnostics.invalid_lines == parsed_diagnostics.invalid_lines
+    # Tasks are held as title ids, packed subtitles and date ordinals, with each title stored once
+    assert isinstance(snapshot_tasks, auto_scheduler.TaskTable) and isinstance(parsed_tasks, auto_scheduler.TaskTable)
+    assert parsed_tasks.titles.strings == ['Maths', 'Physics'] and list(parsed_tasks.title_ids) == [0, 1]
+    assert parsed_tasks.due_ordinals[0] == parsed_tasks.actual_due_ordinals[0] == datetime.date(2021, 2, 1).toordinal()
+
+    parsed_diagnostics = auto_scheduler.Diagnostics()
+    snapshot_diagnostics = auto_scheduler.Diagnostics()
+    parsed_fixed = auto_scheduler.load_fixed_tasks(str(fixed_file), use_snapshot=True, diagnostics=parsed_diagnostics)
+    assert (tmp_path / '.day_fixed_work.txt.snapshot').exists()
+    snapshot_fixed = auto_scheduler.load_fixed_tasks(str(fixed_file), use_snapshot=True,
+                                                     diagnostics=snapshot_diagnostics)
+    assert snapshot_fixed == parsed_fixed
+    assert len(parsed_diagnostics.invalid_lines) == 1
+    assert snapshot_diagnostics.invalid_lines == parsed_diagnostics.invalid_lines
+    assert next(iter(snapshot_fixed[0][cur_date])) is sys.intern(parsed_tasks[0].subtitle)
+
+    # A changed source file, parser or start date must not be served from the old snapshot
+    task_file.write_text('Chemistry; 3; 1/2/21\n')
+    sys.stdout = StringIO()
+    changed_tasks = auto_scheduler.load_flexi_tasks(cur_date, str(task_file), use_snapshot=True)
+    sys.stdout = sys.__stdout__
+    assert [task.title for task in changed_tasks] == ['Chemistry']
+    parser_digest = auto_scheduler.parser_digest()
+    assert auto_scheduler.task_snapshot.read_flexi_snapshot(str(task_file), parser_digest, cur_date, True) is not None
+    assert auto_scheduler.task_snapshot.read_flexi_snapshot(str(task_file), parser_digest + 1, cur_date, True) is None
+    assert auto_scheduler.task_snapshot.read_flexi_snapshot(str(task_file), parser_digest,
+                                                            cur_date + datetime.timedelta(days=1), True) is None
+
+
+def test_snapshot_holds_oversized_times(tmp_path):
+    # Times past 32 bits of minutes are stored, ones past 64 bits are left to the text parser
+    cur_date = datetime.date(2021, 1, 4)
+    task_file = tmp_path / 'one-off_tasks'
+    task_file.write_text('Maths; 100000000; 1/2/21; 0:20; Assignment\n')
+    for fixed_hours, snapshotted in [(10 ** 8, True), (10 ** 18, False)]:
+        fixed_file = tmp_path / f'day_fixed_work_{fixed_hours}.txt'
+        fixed_file.write_text(f'Monday;{fixed_hours}\n4/1/21;{fixed_hours};Assignment\n')
+        loaded = [(auto_scheduler.load_flexi_tasks(cur_date, str(task_file), use_snapshot=True),
+                   auto_scheduler.load_fixed_tasks(str(fixed_file), use_snapshot=True)) for _ in range(2)]
+        assert loaded[1] == loaded[0]
+        assert loaded[1][0][0].required_hours == 10 ** 8 and loaded[1][1][1]['Monday'] == fixed_hours
+        assert (tmp_path / '.one-off_tasks.snapshot').exists()
+        assert os.path.exists(auto_scheduler.task_snapshot.snapshot_path(str(fixed_file))) == snapshotted
+
+
+def test_remove_fixed_from_flexi_deducts_earliest_first():
+    def task(subtitle: str, required_hours: float, due_day: int) -> Task:
+        return Task('Maths', subtitle, required_hours, auto_scheduler.time_inc, datetime.date(2030, 1, 1),
+                    datetime.date(2030, 1, due_day), datetime.date(2030, 1, due_day))
+
+    flexi = [task('Sheet', 2, 3), task('Exam', 1, 4), task('Sheet', 4, 5)]
+    fixed = {datetime.date(2030, 1, 1): {'Sheet': 3}, datetime.date(2030, 1, 2): {'Sheet': 0.5, 'Essay': 1}}
+    auto_scheduler.remove_fixed_from_flexi(fixed, flexi)
+    # The first sheet only absorbs its own two hours, the rest comes off the next one
+    assert [flexi_task.required_hours for flexi_task in flexi] == [0, 1, 2.5]
+
+
 # Include actual values
 start_date = datetime.date.today()
 fixed_tasks, regular_fixed, one_off_fixed = auto_scheduler.load_fixed_tasks()
@@ -138,6 +266,557 @@ def test_no_missing_time_at_subjects(tasks: List[auto_scheduler.Task], regular_t
     assert math.isclose(total_daily_subjects, total_auto_work) and math.isclose(total_auto_work, total_required_hours)
 
 
+@given(st.lists(st.integers(min_value=0, max_value=24 * 60), min_size=1, max_size=400),
+       st.integers(min_value=0, max_value=500 * 60), st.integers(min_value=1, max_value=4 * 60))
+def test_level_minutes_fills_lowest_days(loads: List[int], required_minutes: int, min_time: int):
+    added = auto_scheduler.level_minutes(loads, required_minutes, min_time)
+    assert sum(added) == required_minutes
+    assert all(minutes == 0 or minutes >= min(min_time, required_minutes) for minutes in added)
+    # Without a minimum chunk size no untouched day should sit below the level reached by the filled days, unless
+    # there are fewer minutes than days tied for the least work, so some of them can't be given any
+    if min_time == 1 and required_minutes >= loads.count(min(loads)):
+        filled_level = min(load + minutes for load, minutes in zip(loads, added) if minutes > 0)
+        assert all(load >= filled_level for load, minutes in zip(loads, added) if minutes == 0)
+
+
+@given(st.lists(st.integers(min_value=0, max_value=24 * 60), min_size=1, max_size=400),
+       st.integers(min_value=0, max_value=500 * 60), st.integers(min_value=1, max_value=4 * 60))
+def test_spread_minutes_fits_capacity(capacities: List[int], required_minutes: int, min_time: int):
+    added = auto_scheduler.spread_minutes(capacities, required_minutes, min_time)
+    assert sum(added) == min(required_minutes, sum(capacities))
+    assert all(0 <= minutes <= capacity for minutes, capacity in zip(added, capacities))
+    # With room to spare on every day, nothing is split into pieces smaller than min_time
+    if all(capacity >= required_minutes for capacity in capacities):
+        assert all(minutes == 0 or minutes >= min(min_time, required_minutes) for minutes in added)
+
+
+def test_spread_minutes_leaves_room_for_later_starts():
+    # Spreading the second task's leftover minutes over its whole window used to take the room the third task needs,
+    # which only starts the day after, missing an hour
+    tasks = [Task('b', 't1', 5, 0.5, datetime.date(2030, 1, 11), datetime.date(2030, 1, 13),
+                  datetime.date(2030, 1, 13)),
+             Task('b', 't0', 5, 1, datetime.date(2030, 1, 10), datetime.date(2030, 1, 14), datetime.date(2030, 1, 14)),
+             Task('a', 't2', 3, 0.5, datetime.date(2030, 1, 11), datetime.date(2030, 1, 14),
+                  datetime.date(2030, 1, 14))]
+    sys.stdout = StringIO()
+    try:
+        auto_work_per_day, _ = auto_scheduler.calc_daily_work(tasks, {weekday: 0 for weekday in weekdays}, {}, True)
+        _, missed_time = auto_scheduler.calc_daily_subjects(tasks, auto_work_per_day)
+    finally:
+        sys.stdout = sys.__stdout__
+    assert round(missed_time * 60) == 0
+
+
+@given(st.lists(task_strategy, min_size=1, max_size=20), st.fixed_dictionaries(weekly_mapping),
+       st.dictionaries(safe_dates, sensible_times, max_size=50), st.booleans(), st.integers(min_value=0, max_value=20))
+@settings(deadline=None)
+def test_stages_resume_from_records(tasks: List[auto_scheduler.Task], regular_tasks: Dict[str, float],
+                                    single_fixed_work: Dict[datetime.date, float], weekends: bool, start: int):
+    # Each stage resumed from its record of a full run gives the same output as the full run
+    tasks = sorted(sorted(tasks, key=lambda x: x.actual_due_date), key=lambda x: x.due_date)
+    start = min(start, len(tasks))
+    records = [auto_scheduler.StageRecord() for _ in range(3)]
+    sys.stdout = StringIO()
+    try:
+        full_work = auto_scheduler.calc_daily_work(tasks, regular_tasks, single_fixed_work, weekends, record=records[0])
+        full_titles, _ = auto_scheduler.calc_daily_subjects(tasks, full_work[0], record=records[1])
+        full_subtitles = auto_scheduler.calc_daily_tasks(tasks, full_titles, record=records[2])
+        resumed_work = auto_scheduler.calc_daily_work(tasks, regular_tasks, single_fixed_work, weekends,
+                                                      record=records[0], start=start)
+        resumed_titles, _ = auto_scheduler.calc_daily_subjects(tasks, resumed_work[0], record=records[1], start=start)
+        resumed_subtitles = auto_scheduler.calc_daily_tasks(tasks, resumed_titles, record=records[2], start=start)
+    finally:
+        sys.stdout = sys.__stdout__
+    assert resumed_work == full_work
+    assert dict(resumed_titles) == dict(full_titles)
+    assert dict(resumed_subtitles) == dict(full_subtitles)
+    assert all(len(record.unplaced_minutes) == len(tasks) for record in records)
+
+
+def rounded_schedule(daily_subtitles: Dict[datetime.date, Dict[str, float]],
+                     work_on_days_to_due: Dict[datetime.date, float]):
+    return ({date: {subtitle: round(hours * 60) for subtitle, hours in subtitles.items() if round(hours * 60) != 0}
+             for date, subtitles in daily_subtitles.items()},
+            {date: round(hours * 60) for date, hours in work_on_days_to_due.items()})
+
+
+@given(st.lists(task_strategy, min_size=1, max_size=10), st.lists(task_strategy, min_size=1, max_size=3),
+       st.integers(min_value=0, max_value=10), st.fixed_dictionaries(small_weekly_mapping), st.booleans())
+@settings(deadline=None)
+def test_incremental_matches_full_run(tasks: List[auto_scheduler.Task], edits: List[auto_scheduler.Task],
+                                      edit_index: int, regular_tasks: Dict[str, float], weekends: bool):
+    tasks = sorted(sorted(tasks, key=lambda x: x.actual_due_date), key=lambda x: x.due_date)
+    edited_tasks = tasks[:edit_index] + edits + tasks[edit_index + 1:]
+    edited_tasks = sorted(sorted(edited_tasks, key=lambda x: x.actual_due_date), key=lambda x: x.due_date)
+
+    sys.stdout = StringIO()
+    state = incremental.reschedule(None, tasks, regular_tasks, {}, weekends)
+    state = incremental.reschedule(state, edited_tasks, regular_tasks, {}, weekends)
+    full_result = auto_scheduler.all_calcs(edited_tasks, regular_tasks, {}, weekends)
+    sys.stdout = sys.__stdout__
+    assert rounded_schedule(*incremental.schedule_results(state)) == rounded_schedule(*full_result)
+
+
+def test_incremental_rerun_is_no_slower_than_full_run(tmp_path):
+    # With nothing edited every stage's saved output is reused, so a rerun never costs more than a full run
+    task_filename, fixed_filename = benchmark.generate_workload(benchmark.workloads['1k'], str(tmp_path))
+    state_filename = str(tmp_path / incremental.state_filename)
+    sys.stdout = StringIO()
+    try:
+        fixed_tasks, regular_fixed, one_off_fixed = auto_scheduler.load_fixed_tasks(fixed_filename)
+        flexi_tasks = auto_scheduler.load_flexi_tasks(benchmark.benchmark_start_date, task_filename)
+        auto_scheduler.remove_fixed_from_flexi(fixed_tasks, flexi_tasks)
+        incremental.incremental_calcs(flexi_tasks, regular_fixed, one_off_fixed, True, state_filename)
+        full_time, full_result = benchmark.time_call(
+            lambda: auto_scheduler.all_calcs(flexi_tasks, regular_fixed, one_off_fixed, True), 3)
+        rerun_time, rerun_result = benchmark.time_call(
+            lambda: incremental.incremental_calcs(flexi_tasks, regular_fixed, one_off_fixed, True, state_filename), 3)
+    finally:
+        sys.stdout = sys.__stdout__
+    assert rerun_time <= full_time
+    assert rounded_schedule(*rerun_result) == rounded_schedule(*full_result)
+
+
+@given(st.lists(task_strategy, min_size=1, max_size=20), st.fixed_dictionaries(weekly_mapping),
+       st.dictionaries(safe_dates, sensible_times, max_size=50), st.booleans())
+@settings(deadline=None)
+def test_optimal_peak_is_lowest_possible(tasks: List[auto_scheduler.Task], regular_tasks: Dict[str, float],
+                                         single_fixed_work: Dict[datetime.date, float], weekends: bool):
+    tasks = sorted(sorted(tasks, key=lambda x: x.actual_due_date), key=lambda x: x.due_date)
+    solution = optimal.solve(tasks, regular_tasks, single_fixed_work, weekends)
+    for task, assignment in zip(tasks, solution.assignments):
+        assert sum(assignment.values()) == max(0, auto_scheduler.hours_to_minutes(task.required_hours))
+        assert set(assignment) <= set(auto_scheduler.get_available_days(task, weekends))
+    assert all(round(hours * 60) <= solution.peak_minutes for hours in solution.work_on_days_to_due.values())
+
+    # No better than the levelling stage, and nothing fits under anything lower
+    _, work_on_days_to_due = auto_scheduler.calc_daily_work(tasks, regular_tasks, single_fixed_work, weekends)
+    assert solution.peak_minutes <= max(round(hours * 60) for hours in work_on_days_to_due.values())
+    calendar = auto_scheduler.FixedCalendar.for_tasks(tasks, regular_tasks, single_fixed_work)
+    network = optimal.build_network(tasks, calendar, weekends)
+    if solution.peak_minutes > network.fixed_peak:
+        assert not optimal.assign_under_peak(network, solution.peak_minutes - 1)
+
+
+def test_schedule_cache_round_trip_and_eviction(tmp_path):
+    task_file = tmp_path / 'one-off_tasks'
+    fixed_file = tmp_path / 'day_fixed_work.txt'
+    task_file.write_text('stuff; 10; 31/12/30\n')
+    fixed_file.write_text('Monday;1\n')
+    cache_dir = str(tmp_path / 'cache')
+    start_date = datetime.date(2021, 1, 1)
+
+    key = schedule_cache.cache_key(start_date, True, str(task_file), str(fixed_file))
+    assert schedule_cache.load_schedule(key, cache_dir) is None
+    schedule_cache.store_schedule(key, ({start_date: {'stuff': 1.0}}, {start_date: 2.0}), cache_dir)
+    assert schedule_cache.load_schedule(key, cache_dir) == ({start_date: {'stuff': 1.0}}, {start_date: 2.0})
+
+    # Any change to the inputs or options gives a different key
+    assert schedule_cache.cache_key(start_date, False, str(task_file), str(fixed_file)) != key
+    task_file.write_text('stuff; 11; 31/12/30\n')
+    assert schedule_cache.cache_key(start_date, True, str(task_file), str(fixed_file)) != key
+
+    # Eviction keeps the most recently used entries that fit in the size limit
+    for index in range(5):
+        schedule_cache.store_schedule(f'entry{index}', bytes(1000), cache_dir, max_bytes=2500)
+    assert sorted(os.listdir(cache_dir)) == ['entry3', 'entry4']
+    assert sum(os.path.getsize(os.path.join(cache_dir, name)) for name in os.listdir(cache_dir)) <= 2500
+
+
+def test_benchmark_workload_parses_and_compares(tmp_path):
+    workload = benchmark.Workload('test', 50, 60, 14, (15, 30), False)
+    task_filename, fixed_filename = benchmark.generate_workload(workload, str(tmp_path))
+    sys.stdout = StringIO()
+    flexi_tasks = auto_scheduler.load_flexi_tasks(benchmark.benchmark_start_date, task_filename, workload.weekends)
+    auto_scheduler.load_fixed_tasks(fixed_filename)
+    sys.stdout = sys.__stdout__
+    assert len(flexi_tasks) == workload.num_tasks
+
+    baseline = {'version': benchmark.benchmark_version, 'results': {'test': {'calc_daily_work': 1.0}}}
+    assert benchmark.compare_results(baseline, baseline) == []
+    slower = {'version': benchmark.benchmark_version, 'results': {'test': {'calc_daily_work': 1.5}}}
+    assert len(benchmark.compare_results(slower, baseline)) == 1
+    assert benchmark.compare_results(slower, baseline, threshold=0.6) == []
+
+
+def test_batch_writes_output_per_directory(tmp_path):
+    # Once in this process and once across a pool of workers
+    for jobs in [1, 2]:
+        for name in ['first', 'second']:
+            (tmp_path / str(jobs) / name).mkdir(parents=True)
+            (tmp_path / str(jobs) / name / batch.task_filename).write_text(f'{name}; 2; 1/1/30-5/1/30\n')
+            (tmp_path / str(jobs) / name / batch.fixed_filename).write_text('Monday;1\n')
+        directories = [str(tmp_path / str(jobs) / name) for name in ['first', 'second', 'missing']]
+
+        results = batch.schedule_directories(directories, datetime.date(2029, 12, 31), jobs=jobs)
+        assert [result.succeeded for result in results] == [True, True, False]
+        for name in ['first', 'second']:
+            output = (tmp_path / str(jobs) / name / batch.output_filename).read_text()
+            assert name in output and '\x1b' not in output
+            assert (tmp_path / str(jobs) / name / batch.diagnostics_filename).exists()
+
+
+def test_results_render_and_export(tmp_path):
+    daily_subtitles = {datetime.date(2030, 1, 7): {'Sheet, part 1': 1.5, 'Essay': 0.25},
+                       datetime.date(2030, 1, 8): {'Essay': 0.75}}
+    work_on_days_to_due = {datetime.date(2030, 1, 7): 2.75, datetime.date(2030, 1, 8): 2}
+    weekly_work = {weekday: 1 for weekday in weekdays}
+    sys.stdout = StringIO()
+    auto_scheduler.print_results(daily_subtitles, work_on_days_to_due, weekly_work, {}, False)
+    output = sys.stdout.getvalue()
+    sys.stdout = sys.__stdout__
+    assert '\nMonday 2030-01-07 (1:45 auto/2:45 total)\n' in output
+    assert 'Sheet, part 1: 1:30\nEssay: 0:15\n' in output
+    assert 'Missing 0:15 hours of work' in output and output.index('2030-01-07') < output.index('2030-01-08')
+
+    for extension in export.export_formats:
+        export.export_schedule(str(tmp_path / f'schedule{extension}'), daily_subtitles, work_on_days_to_due,
+                               weekly_work, {})
+    lines = (tmp_path / 'schedule.jsonl').read_text().splitlines()
+    assert [json.loads(line)['total_minutes'] for line in lines] == [165, 120]
+    assert json.loads(lines[0])['tasks'][0] == {'subtitle': 'Sheet, part 1', 'minutes': 90}
+    with open(tmp_path / 'schedule.csv', newline='') as csv_file:
+        assert list(csv.reader(csv_file))[1:] == [['2030-01-07', 'Sheet, part 1', '90'], ['2030-01-07', 'Essay', '15'],
+                                                  ['2030-01-08', 'Essay', '45']]
+    calendar = (tmp_path / 'schedule.ics').read_bytes().decode()
+    assert calendar.count('BEGIN:VEVENT') == 3 and 'SUMMARY:Sheet\\, part 1 (1:30)\r\n' in calendar
+
+
+def test_schedule_files_collects_diagnostics_silently(tmp_path):
+    task_file = tmp_path / 'one-off_tasks'
+    fixed_file = tmp_path / 'day_fixed_work.txt'
+    task_file.write_text('maths; 2; 1/1/30-5/1/30; 0:30; sheet\nbroken\nhistory; 1; 20/12/29\nart; 100; 2/1/30\n')
+    fixed_file.write_text('Monday;1\nnot a day;1\n')
+
+    sys.stdout = StringIO()
+    result = auto_scheduler.schedule_files(datetime.date(2029, 12, 31), str(task_file), str(fixed_file))
+    output = sys.stdout.getvalue()
+    sys.stdout = sys.__stdout__
+    assert output == ''
+
+    diagnostics = result.diagnostics
+    assert [line.split(':')[0] for line in diagnostics.invalid_lines] == ['Line 2', 'Line 2']
+    assert [task.subtitle for task in diagnostics.overdue_tasks] == ['history']
+    assert diagnostics.missed_time == 0 and diagnostics.unassigned_hours == {}
+    assert sum(hours for subtitles in result.daily_subtitles.values() for subtitle, hours in subtitles.items()
+               if subtitle.endswith('sheet')) == 2
+
+    # Batch runs report the same through the incremental engine, and again when reusing its saved state
+    for _ in range(2):
+        sys.stdout = StringIO()
+        assert batch.schedule_directory(str(tmp_path), datetime.date(2029, 12, 31)).succeeded
+        output = sys.stdout.getvalue()
+        sys.stdout = sys.__stdout__
+        assert output == ''
+        assert (tmp_path / batch.diagnostics_filename).read_text() == auto_scheduler.format_diagnostics(diagnostics)
+        shutil.rmtree(tmp_path / schedule_cache.cache_dir)
+
+
+def test_sync_against_fake_drive(tmp_path, monkeypatch):
+    from google.auth.credentials import AnonymousCredentials
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'one-off_tasks').write_text('local tasks\n')
+    (tmp_path / 'day_fixed_work.txt').write_text('old fixed\n')
+    os.utime('day_fixed_work.txt', (0, 0))
+
+    with fake_drive.FakeDrive() as drive:
+        drive.add_file('day_fixed_work.txt', b'newer fixed\n',
+                       datetime.datetime(2030, 1, 1, tzinfo=datetime.timezone.utc))
+        sys.stdout = StringIO()
+        sync.update(AnonymousCredentials(), drive.api_endpoint)
+        sys.stdout = sys.__stdout__
+
+        assert drive.file_named('one-off_tasks')['content'] == b'local tasks\n'
+        assert (tmp_path / 'day_fixed_work.txt').read_text() == 'newer fixed\n'
+        assert sorted(drive.requests) == ['GET /drive/v3/files', 'GET /drive/v3/files/file0',
+                                          'POST /upload/drive/v3/files']
+
+        # Touching a file without changing it, or skewed clocks, don't cause transfers
+        os.utime('one-off_tasks', (2, 2))
+        drive.files['file0']['modifiedTime'] = fake_drive.format_time(
+            datetime.datetime(2040, 1, 1, tzinfo=datetime.timezone.utc))
+        drive.requests.clear()
+        sys.stdout = StringIO()
+        sync.update(AnonymousCredentials(), drive.api_endpoint)
+        sys.stdout = sys.__stdout__
+        assert drive.requests == ['GET /drive/v3/files']
+
+        # Only the side that changed since the last sync is transferred, whatever the clocks say
+        (tmp_path / 'day_fixed_work.txt').write_text('edited fixed\n')
+        os.utime('day_fixed_work.txt', (0, 0))
+        sys.stdout = StringIO()
+        sync.update(AnonymousCredentials(), drive.api_endpoint)
+        sys.stdout = sys.__stdout__
+        assert drive.file_named('day_fixed_work.txt')['content'] == b'edited fixed\n'
+
+    # A recent sync is only reused while the files are as it left them
+    assert sync.sync_is_fresh(10)
+    (tmp_path / 'one-off_tasks').write_text('another edit\n')
+    assert not sync.sync_is_fresh(10)
+
+
+def test_sync_holds_back_downloads_and_local_errors(tmp_path, monkeypatch):
+    from google.auth.credentials import AnonymousCredentials
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'day_fixed_work.txt').write_text('old fixed\n')
+    os.utime('day_fixed_work.txt', (0, 0))
+    with fake_drive.FakeDrive() as drive:
+        drive.add_file('day_fixed_work.txt', b'newer fixed\n',
+                       datetime.datetime(2030, 1, 1, tzinfo=datetime.timezone.utc))
+        sys.stdout = StringIO()
+        sync.save_manifest({'day_fixed_work.txt': sync.local_entry('day_fixed_work.txt', None)})
+        os.utime(sync.manifest_filename, (0, 0))
+        # Once the files are being read a download is left for the next sync, which fetches it again straight away
+        # rather than after the TTL
+        gate = sync.DownloadGate()
+        gate.close()
+        sync.update(AnonymousCredentials(), drive.api_endpoint, gate=gate)
+        assert (tmp_path / 'day_fixed_work.txt').read_text() == 'old fixed\n'
+        assert sorted(os.listdir(tmp_path)) == ['.sync_manifest.json', 'day_fixed_work.txt']
+        assert not sync.sync_is_fresh(sync.default_ttl_minutes)
+        assert sync.safe_sync(sync.default_ttl_minutes, creds=AnonymousCredentials(), api_endpoint=drive.api_endpoint)
+        sys.stdout = sys.__stdout__
+        assert (tmp_path / 'day_fixed_work.txt').read_text() == 'newer fixed\n'
+        assert sync.sync_is_fresh(sync.default_ttl_minutes)
+
+    # Only connection problems count as being offline
+    def fail_locally(*args):
+        raise PermissionError('read-only')
+    monkeypatch.setattr(sync, 'update', fail_locally)
+    try:
+        sync.safe_sync(creds=AnonymousCredentials())
+        assert False, 'local errors should be raised'
+    except PermissionError:
+        pass
+    assert not os.path.exists(sync.journal_filename)
+
+    # Background syncs need credentials that work without signing in again
+    assert not sync.can_sync_in_background()
+    token = {'token': 'access', 'client_id': 'id', 'client_secret': 'secret', 'expiry': '2000-01-01T00:00:00Z'}
+    (tmp_path / 'token.json').write_text(json.dumps(token))
+    assert not sync.can_sync_in_background()
+    (tmp_path / 'token.json').write_text(json.dumps(dict(token, refresh_token='refresh')))
+    assert sync.can_sync_in_background()
+
+
+def test_scheduling_does_not_import_google():
+    imported = subprocess.run([sys.executable, '-c', 'import sys, auto_scheduler; '
+                               'print(any(name.split(".")[0].startswith("google") for name in sys.modules))'],
+                              cwd=os.path.dirname(os.path.abspath(auto_scheduler.__file__)), capture_output=True,
+                              text=True)
+    assert imported.stdout.strip() == 'False'
+
+
+def test_offline_sync_journals_and_flushes(tmp_path, monkeypatch):
+    from google.auth.credentials import AnonymousCredentials
+
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / 'one-off_tasks').write_text('offline edit\n')
+    with fake_drive.FakeDrive() as drive:
+        unreachable_endpoint = drive.api_endpoint
+    sys.stdout = StringIO()
+    assert not sync.safe_sync(creds=AnonymousCredentials(), api_endpoint=unreachable_endpoint, timeout=1)
+    journal = sync.load_manifest(sync.journal_filename)
+    assert journal['pending'] == ['one-off_tasks'] and journal['retry_after'] > time.time()
+
+    # Further runs while backing off don't touch the network
+    update = sync.update
+    monkeypatch.setattr(sync, 'update', None)
+    assert not sync.safe_sync(creds=AnonymousCredentials(), api_endpoint=unreachable_endpoint, timeout=1)
+    monkeypatch.setattr(sync, 'update', update)
+
+    sync.save_manifest(dict(journal, retry_after=0), sync.journal_filename)
+    with fake_drive.FakeDrive() as drive:
+        assert sync.safe_sync(creds=AnonymousCredentials(), api_endpoint=drive.api_endpoint)
+        assert drive.file_named('one-off_tasks')['content'] == b'offline edit\n'
+    sys.stdout = sys.__stdout__
+    assert not os.path.exists(sync.journal_filename)
+
+
+def wait_for(condition, timeout: float = 10) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def test_watch_rewrites_schedule_on_save(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / batch.task_filename).write_text('first; 2; 1/1/40\n')
+    (tmp_path / batch.fixed_filename).write_text('Monday;1\n')
+    schedule_file = tmp_path / batch.output_filename
+
+    stop = threading.Event()
+    watcher = threading.Thread(target=watch.watch, kwargs={'sync_files': False, 'debounce': 0.1,
+                                                           'poll_interval': 0.05, 'stop': stop})
+    watcher.start()
+    try:
+        assert wait_for(lambda: schedule_file.exists() and 'first' in schedule_file.read_text())
+        (tmp_path / batch.task_filename).write_text('first; 2; 1/1/40\nsecond; 1; 1/1/40\n')
+        assert wait_for(lambda: 'second' in schedule_file.read_text())
+        assert '\x1b' not in schedule_file.read_text()
+    finally:
+        stop.set()
+        watcher.join()
+
+    polling_watcher = watch.PollingWatcher(str(tmp_path), [batch.fixed_filename], 0.01)
+    assert not polling_watcher.wait(0.05)
+    (tmp_path / batch.fixed_filename).write_text('Monday;2\n')
+    assert polling_watcher.wait(1)
+
+
+def test_profile_counts_stages_and_tasks():
+    tasks = [Task('maths', 'sheet', 3, 1, datetime.date(2030, 1, 1), datetime.date(2030, 1, 4),
+                  datetime.date(2030, 1, 4)),
+             Task('maths', 'exam', 2, 2, datetime.date(2030, 1, 1), datetime.date(2030, 1, 3),
+                  datetime.date(2030, 1, 3))]
+    sys.stdout = StringIO()
+    profile = instrumentation.start()
+    try:
+        auto_scheduler.all_calcs(tasks, {weekday: 1 for weekday in auto_scheduler.weekday_conversion.values()}, {},
+                                 True)
+    finally:
+        instrumentation.stop()
+        sys.stdout = sys.__stdout__
+    assert instrumentation.active is None
+
+    report = profile.report()
+    assert set(report['stage_seconds']) == {'calc_daily_work', 'calc_daily_subjects', 'calc_daily_tasks'}
+    assert report['counters']['leveling_iterations'] > 0
+    assert report['counters']['sorts'] > 0
+    assert [record['subtitle'] for record in report['slowest_tasks']['calc_daily_work']].count('sheet') == 1
+
+
+def test_task_table_stands_in_for_a_task_list():
+    tasks = [Task('maths', 'sheet', 3, 1, datetime.date(2030, 1, 1), datetime.date(2030, 1, 4),
+                  datetime.date(2030, 1, 4)),
+             Task('physics', 'lab', 2, 0.5, datetime.date(2030, 1, 1), datetime.date(2030, 1, 3),
+                  datetime.date(2029, 12, 30)),
+             Task('maths', 'exam', 1, 1, datetime.date(2030, 1, 2), datetime.date(2030, 1, 5),
+                  datetime.date(2030, 1, 5))]
+    table = auto_scheduler.TaskTable(tasks)
+    assert table == tasks and list(table) == tasks and table[-1] == tasks[2] and table[1:] == tasks[1:]
+    assert table.titles.strings == ['maths', 'physics'] and list(table.title_ids) == [0, 1, 0]
+
+    auto_scheduler.remove_fixed_from_flexi({datetime.date(2030, 1, 1): {'sheet': 1}}, table)
+    assert table[0] == replace(tasks[0], required_hours=2) and table[1:] == tasks[1:]
+    table[2] = replace(tasks[2], subtitle='mock exam')
+    assert table[2].subtitle == 'mock exam' and len(table) == 3
+
+
+def test_daily_stages_index_titles_and_days():
+    tasks = auto_scheduler.TaskTable([
+        Task('maths', 'sheet', 3, 1, datetime.date(2030, 1, 1), datetime.date(2030, 1, 4), datetime.date(2030, 1, 4)),
+        Task('physics', 'lab', 2, 1, datetime.date(2030, 1, 1), datetime.date(2030, 1, 3), datetime.date(2030, 1, 3)),
+        Task('maths', 'exam', 1, 1, datetime.date(2030, 1, 2), datetime.date(2030, 1, 4), datetime.date(2030, 1, 4))])
+    auto_work_per_day = {datetime.date(2030, 1, 1): 2, datetime.date(2030, 1, 2): 2, datetime.date(2030, 1, 3): 2}
+    daily_titles, missed_time = auto_scheduler.calc_daily_subjects(
+        tasks, auto_work_per_day, diagnostics=auto_scheduler.Diagnostics())
+    assert missed_time == 0 and daily_titles.titles is tasks.titles
+    assert list(daily_titles.first_ordinals) == [datetime.date(2030, 1, 1).toordinal()] * 2
+    assert [sum(minutes) for minutes in daily_titles.minutes] == [240, 120]
+    assert auto_scheduler.DailyTitles.from_dict(dict(daily_titles.items())) == daily_titles
+    assert list(daily_titles) == sorted(auto_work_per_day) and len(daily_titles.day_title_ids) == 5
+
+    daily_subtitles = auto_scheduler.calc_daily_tasks(tasks, daily_titles)
+    assert daily_subtitles == auto_scheduler.calc_daily_tasks(list(tasks), dict(daily_titles.items()))
+    assert list(daily_subtitles) == sorted(auto_work_per_day) and len(daily_subtitles.task_indices) >= 3
+    assert sum(map(len, daily_subtitles.values())) == len(daily_subtitles.task_indices)
+    assert datetime.date(2030, 1, 4) not in daily_subtitles and datetime.date(2030, 1, 4) not in daily_titles
+    assert sum(daily_subtitles[datetime.date(2030, 1, 3)].values()) == 2
+    assert '(DUE NEXT DAY) (Complete) exam' in daily_subtitles[datetime.date(2030, 1, 3)]
+
+
+def test_stages_share_inputs_without_changing_them():
+    tasks = [Task('maths', 'sheet', 3, 1, datetime.date(2030, 1, 1), datetime.date(2030, 1, 4),
+                  datetime.date(2030, 1, 4)),
+             Task('physics', 'lab', 2, 2, datetime.date(2030, 1, 1), datetime.date(2030, 1, 3),
+                  datetime.date(2030, 1, 3))]
+    regular_fixed = {weekday: 1 for weekday in auto_scheduler.weekday_conversion.values()}
+    sys.stdout = StringIO()
+    try:
+        flexi_per_day, _ = auto_scheduler.calc_daily_work(tasks, regular_fixed, {}, True)
+        expected_flexi_per_day = dict(flexi_per_day)
+        daily_titles, _ = auto_scheduler.calc_daily_subjects(tasks, flexi_per_day)
+        expected_daily_titles = {date: dict(titles) for date, titles in daily_titles.items()}
+        daily_subtitles = auto_scheduler.calc_daily_tasks(tasks, daily_titles)
+    finally:
+        sys.stdout = sys.__stdout__
+
+    assert flexi_per_day == expected_flexi_per_day
+    assert daily_titles == expected_daily_titles
+    assert sum(sum(subtitles.values()) for subtitles in daily_subtitles.values()) == 5
+    try:
+        tasks[0].required_hours = 0
+        assert False, 'Tasks should be immutable'
+    except FrozenInstanceError:
+        pass
+
+
+def test_allocation_events_replay_schedule(tmp_path):
+    tasks = [Task('maths', 'sheet', 3, 1, datetime.date(2030, 1, 1), datetime.date(2030, 1, 4),
+                  datetime.date(2030, 1, 4)),
+             Task('physics', 'lab', 2, 0.5, datetime.date(2030, 1, 2), datetime.date(2030, 1, 6),
+                  datetime.date(2030, 1, 6))]
+    regular_fixed = {weekday: 1 for weekday in weekdays}
+    events_file = str(tmp_path / 'events')
+    sys.stdout = StringIO()
+    try:
+        # A tiny chunk size so the file holds several chunks
+        with allocation_events.AllocationEvents(events_file, chunk_events=2) as events:
+            daily_subtitles, _ = auto_scheduler.all_calcs(tasks, regular_fixed, {}, True, events)
+    finally:
+        sys.stdout = sys.__stdout__
+
+    recorded = list(allocation_events.read_events(events_file))
+    for stage in allocation_events.stage_names:
+        for task_id, task in enumerate(tasks):
+            assert sum(minutes for event_task, _, minutes, event_stage in recorded
+                       if event_task == task_id and event_stage == stage) == task.required_hours * 60
+    # The last stage's events add up to the schedule itself
+    for date, subtitles in daily_subtitles.items():
+        assert sum(event[2] for event in allocation_events.events_on_day(iter(recorded), date)
+                   if event[3] == allocation_events.tasks_stage) == round(sum(subtitles.values()) * 60)
+
+
+def test_allocation_events_hold_more_minutes_than_32_bits(tmp_path):
+    # A hundred million hours on one day is more minutes than a 32-bit integer holds
+    tasks = [Task('maths', 'sheet', 10 ** 8, 1, datetime.date(2030, 1, 1), datetime.date(2030, 1, 2),
+                  datetime.date(2030, 1, 2))]
+    events_file = str(tmp_path / 'events')
+    sys.stdout = StringIO()
+    try:
+        with allocation_events.AllocationEvents(events_file) as events:
+            auto_scheduler.all_calcs(tasks, {weekday: 0 for weekday in weekdays}, {}, True, events)
+    finally:
+        sys.stdout = sys.__stdout__
+
+    recorded = list(allocation_events.read_events(events_file))
+    assert [(minutes, stage) for _, _, minutes, stage in recorded] == \
+           [(6 * 10 ** 9, stage) for stage in allocation_events.stage_names]
+
+
+def test_plot_history_replays_daily_work():
+    tasks = [Task('maths', 'sheet', 3, 1, datetime.date(2030, 1, 1), datetime.date(2030, 1, 4),
+                  datetime.date(2030, 1, 4)),
+             Task('physics', 'lab', 2, 0.5, datetime.date(2030, 1, 2), datetime.date(2030, 1, 6),
+                  datetime.date(2030, 1, 6))]
+    regular_fixed = {weekday: 1 for weekday in weekdays}
+    one_off_fixed = {datetime.date(2030, 1, 2): 2}
+    history = plot_auto_scheduler.record_allocations(tasks, regular_fixed, one_off_fixed, True)
+    _, work_on_days_to_due = auto_scheduler.calc_daily_work(tasks, regular_fixed, one_off_fixed, True)
+
+    assert [subtitle for subtitle, _ in history.steps] == ['sheet', 'lab']
+    assert [sum(added.values()) for _, added in history.steps] == [180, 120]
+    final_minutes = history.final_minutes()
+    for date, hours in work_on_days_to_due.items():
+        assert final_minutes[(date - history.start_date).days] == auto_scheduler.hours_to_minutes(hours)
+
+
 def prettify_task_list(input_list: list):
     output = '['
     for task in input_list:
@@ -209,12 +888,16 @@ def test_current_shrink_fails():
                 prev_min_time = task.min_time
                 bounds: List[float] = [0, task.required_hours]
                 bound_vals = [None, None]
-                task.required_hours = bounds[0]
-                task.min_time = min(prev_min_time, task.required_hours)
+
+                def set_required_hours(required_hours: float) -> None:
+                    # Tasks are immutable, so swap in a changed copy
+                    flexi_tasks[index] = replace(flexi_tasks[index], required_hours=required_hours,
+                                                 min_time=min(prev_min_time, required_hours))
+
+                set_required_hours(bounds[0])
                 bound_vals[0] = calc_missed_time(flexi_tasks, regular_fixed, one_off_fixed, fixed_tasks)
                 if bound_vals[0] != 0:
-                    task.required_hours = bounds[0]
-                    task.min_time = min(prev_min_time, task.required_hours)
+                    set_required_hours(bounds[0])
                     tasks_to_remove.append(index)
                     print(f'Will remove {task.subtitle}, index {index}')
                 else:
@@ -223,17 +906,16 @@ def test_current_shrink_fails():
                         print(f'Bounds: {bounds}')
                         print(f'Bound vals: {bound_vals}')
                         mid_pos = auto_scheduler.round_hours_to_minute((bounds[0] + bounds[1]) / 2)
-                        task.required_hours = mid_pos
-                        task.min_time = min(prev_min_time, task.required_hours)
+                        set_required_hours(mid_pos)
                         mid_val = calc_missed_time(flexi_tasks, regular_fixed, one_off_fixed, fixed_tasks)
                         print(f'Mid val: {mid_val}')
                         if mid_val == 0:
                             bounds[0] = mid_pos
                         else:
                             bounds[1] = mid_pos
-                    task.required_hours = bounds[1]
-                    task.min_time = min(prev_min_time, task.required_hours)
+                    set_required_hours(bounds[1])
 
+                task = flexi_tasks[index]
                 missed_time = calc_missed_time(flexi_tasks, regular_fixed, one_off_fixed, fixed_tasks)
                 if prev_required_hours != task.required_hours:
                     print(f'Reducing {task.subtitle} from {prev_required_hours} to {task.required_hours} resulted in'
@@ -0,0 +1,145 @@
+import ctypes
+import datetime
+import os
+import select
+import struct
+import sys
+import threading
+import time
+from typing import Dict, Iterable, Optional, Tuple
+
+import auto_scheduler
+import batch
+import sync
+
+# Keeps the rendered schedule up to date while the task files are edited, so viewing it is just a file read
+watched_files = [batch.task_filename, batch.fixed_filename]
+
+in_close_write = 0x8
+in_moved_to = 0x80
+in_create = 0x100
+in_delete = 0x200
+inotify_event_struct = struct.Struct('iIII')
+
+
+class PollingWatcher:
+    def __init__(self, directory: str, filenames: Iterable[str], poll_interval: float = 1.0):
+        self.paths = [os.path.join(directory, filename) for filename in filenames]
+        self.poll_interval = poll_interval
+        self.signatures = self.current_signatures()
+
+    def current_signatures(self) -> Dict[str, Optional[Tuple[int, int]]]:
+        signatures = {}
+        for path in self.paths:
+            try:
+                path_stat = os.stat(path)
+                signatures[path] = (path_stat.st_mtime_ns, path_stat.st_size)
+            except FileNotFoundError:
+                signatures[path] = None
+        return signatures
+
+    def wait(self, timeout: float) -> bool:
+        # Whether any file changed within the timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            signatures = self.current_signatures()
+            if signatures != self.signatures:
+                self.signatures = signatures
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.poll_interval, remaining))
+
+    def close(self) -> None:
+        pass
+
+
+class InotifyWatcher:
+    def __init__(self, directory: str, filenames: Iterable[str]):
+        # Watch the directory rather than the files, as editors often save by replacing the file
+        self.filenames = set(filenames)
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory),
+                                  in_close_write | in_moved_to | in_create | in_delete) < 0:
+            error = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(error, 'inotify_add_watch failed')
+
+    def wait(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            ready, _, _ = select.select([self.fd], [], [], remaining)
+            if not ready:
+                return False
+            events = os.read(self.fd, 64 * 1024)
+            offset = 0
+            while offset < len(events):
+                _, _, _, name_length = inotify_event_struct.unpack_from(events, offset)
+                offset += inotify_event_struct.size
+                name = os.fsdecode(events[offset:offset + name_length].rstrip(b'\0'))
+                offset += name_length
+                if name in self.filenames:
+                    return True
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+def make_watcher(directory: str, filenames: Iterable[str], poll_interval: float = 1.0):
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(directory, filenames)
+        except (OSError, AttributeError):
+            pass
+    return PollingWatcher(directory, filenames, poll_interval)
+
+
+def reschedule(start_date: datetime.date, weekends: bool, reverse_output: bool) -> None:
+    # Rendered the same way as a batch directory, so the schedule file has no colour codes for whatever views it
+    result = batch.schedule_directory('.', start_date, weekends, reverse_output)
+    if result.succeeded:
+        print(f'{datetime.datetime.now():%H:%M:%S} Rescheduled from {start_date}, see {batch.output_filename}')
+    else:
+        print(f'{datetime.datetime.now():%H:%M:%S} {result.message}, see {batch.diagnostics_filename}')
+
+
+def watch(include_today: bool = True, weekends: bool = True, reverse_output: bool = True, sync_files: bool = True,
+          sync_delay: float = 30, debounce: float = 0.5, poll_interval: float = 1.0,
+          stop: Optional[threading.Event] = None) -> None:
+    # Reschedule the task files in the current directory whenever they're saved or the day changes, and sync them
+    # once edits have settled for sync_delay seconds
+    watcher = make_watcher('.', watched_files, poll_interval)
+    start_date = auto_scheduler.input_start_date(include_today)
+    reschedule(start_date, weekends, reverse_output)
+    sync_due: Optional[float] = None
+    try:
+        while stop is None or not stop.is_set():
+            timeout = 1.0 if sync_due is None else min(1.0, max(0.0, sync_due - time.monotonic()))
+            if watcher.wait(timeout):
+                # Let a burst of writes finish before reading the files
+                while watcher.wait(debounce):
+                    pass
+                start_date = auto_scheduler.input_start_date(include_today)
+                reschedule(start_date, weekends, reverse_output)
+                if sync_files:
+                    sync_due = time.monotonic() + sync_delay
+            elif auto_scheduler.input_start_date(include_today) != start_date:
+                start_date = auto_scheduler.input_start_date(include_today)
+                reschedule(start_date, weekends, reverse_output)
+            if sync_due is not None and time.monotonic() >= sync_due:
+                sync_due = None
+                # Downloads show up as file changes and reschedule on the next pass. Signing in needs the terminal,
+                # which the watch loop doesn't have
+                if sync.can_sync_in_background():
+                    sync.safe_sync(sync.default_ttl_minutes, interactive=False)
+                else:
+                    print('Not signed in to Google Drive, run once without --watch to sync')
+    finally:
+        watcher.close()